@@ -0,0 +1,5 @@
+"""
+Benchmarks of the pipeline on synthetic listings: synthetic generates datasets with the
+schema of the samples at any size, run times the steps on them offline and saves the results
+as JSON, compare puts the results of two commits side by side
+"""
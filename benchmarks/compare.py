@@ -0,0 +1,72 @@
+"""
+Compare the results of benchmarks.run on two commits: for every size benchmarked by both,
+the timings and throughputs of the base and the new results, with their ratio
+
+    python -m benchmarks.compare benchmarks/results/<base>.json benchmarks/results/<new>.json
+"""
+import argparse
+import json
+import logging
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Suffixes of the measurements compared. For the throughputs (rows_per_s) a ratio above 1
+# is an improvement, for the durations (_s) and the sizes (_mb) one below 1
+METRIC_SUFFIXES = ("_s", "_rows_per_s", "_mb")
+
+
+def load_results(path):
+    """
+    :param path: JSON file written by benchmarks.run
+    :return: tuple (report, DataFrame of the results indexed by number of rows)
+    """
+    with open(path) as fp:
+        report = json.load(fp)
+    results = pd.DataFrame(report["results"]).set_index("rows")
+    metrics = [c for c in results.columns if c.endswith(METRIC_SUFFIXES)]
+    return report, results[metrics]
+
+
+def compare(base_path, new_path):
+    """
+    :return: DataFrame with one row per size and metric, with the base value, the new value
+             and new / base
+    """
+    base_report, base = load_results(base_path)
+    new_report, new = load_results(new_path)
+    for name, report in [("base", base_report), ("new", new_report)]:
+        logger.info(
+            f"{name}: commit {report['commit']}{' (with changes)' if report['dirty'] else ''}, {report['date']}, "
+            f"{report['machine']['cpu_count']} CPUs"
+        )
+    if base_report["parameters"] != new_report["parameters"]:
+        logger.warning("The benchmarks ran with different parameters, see the parameters in the two files")
+
+    base = base.stack().rename("base")
+    new = new.stack().rename("new")
+    comparison = pd.concat([base, new], axis=1, join="inner")
+    comparison["ratio"] = comparison["new"] / comparison["base"]
+    comparison.index.names = ["rows", "metric"]
+    return comparison
+
+
+def go(args):
+    comparison = compare(args.base, args.new)
+    logger.info(f"Comparison:\n{comparison.to_string(float_format='{:.3f}'.format)}")
+    if args.output_path is not None:
+        comparison.to_csv(args.output_path)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+
+    parser = argparse.ArgumentParser(description="Compare the benchmark results of two commits")
+    parser.add_argument("base", type=str, help="Results of the reference commit")
+    parser.add_argument("new", type=str, help="Results of the commit to compare")
+    parser.add_argument("--output_path", type=str, default=None,
+                        help="Optional path of a CSV file where the comparison is saved")
+    args = parser.parse_args()
+
+    go(args)
@@ -0,0 +1,333 @@
+"""
+Time the pipeline on synthetic listings (see synthetic) of several sizes, without network:
+W&B runs offline and the artifacts live in a local store (see wandb_utils.artifact_store) in
+a scratch directory. For each size this times basic_cleaning, data_check (the expectations and
+their tests), the train/test split, and the fit, prediction and export of the inference
+pipeline of train_random_forest. The steps run in this interpreter, on copies of their
+directories, with the parameters of config.yaml. The results go to a JSON file named after the
+commit, to compare commits with benchmarks.compare
+
+    python -m benchmarks.run --rows 10k 100k 1M
+"""
+import argparse
+import datetime
+import importlib
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+
+from omegaconf import OmegaConf
+
+from benchmarks.synthetic import DEFAULT_SAMPLE, ListingProfile, parse_rows, write_listings
+from pipeline.inprocess import load_step, step_context
+
+logger = logging.getLogger(__name__)
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STEP_DIRS = {
+    "basic_cleaning": os.path.join(PROJECT_DIR, "src", "basic_cleaning"),
+    "data_check": os.path.join(PROJECT_DIR, "src", "data_check"),
+    "data_split": os.path.join(PROJECT_DIR, "train_val_test_split"),
+    "train_random_forest": os.path.join(PROJECT_DIR, "src", "train_random_forest"),
+}
+
+
+def git_commit():
+    """
+    :return: tuple (hash of the checked out commit, whether the working tree has changes),
+             (None, None) outside of a git repository
+    """
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=PROJECT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        status = subprocess.run(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=PROJECT_DIR, capture_output=True, text=True, check=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, status.strip() != ""
+
+
+def offline_environment(work_dir):
+    """
+    Environment of the steps: offline W&B run, local artifact store and MLflow tracking
+    in the scratch directory
+    """
+    return {
+        "WANDB_MODE": "offline",
+        "WANDB_SILENT": "true",
+        "WANDB_DIR": work_dir,
+        "WANDB_PROJECT": "nyc_airbnb_benchmark",
+        "ARTIFACT_STORE": "local",
+        "ARTIFACT_STORE_DIR": os.path.join(work_dir, "store"),
+        "ARTIFACT_STORE_MIRROR": "false",
+        "MLFLOW_TRACKING_URI": f"file:{os.path.join(work_dir, 'mlruns')}",
+    }
+
+
+def load_steps(steps):
+    """
+    Import the steps and the dependencies they import only when they run (their
+    DEFERRED_IMPORTS), so that the first size benchmarked does not pay for the imports
+
+    :param steps: maps the name of each step to its directory
+    """
+    for step_dir in steps.values():
+        module = load_step(step_dir)
+        with step_context(step_dir):
+            for name in getattr(module, "DEFERRED_IMPORTS", []):
+                importlib.import_module(name)
+
+
+def run_step(step_dir, **parameters):
+    """
+    Run the go function of a step, like InProcessRunner but without handing DataFrames
+    over: every step reads its inputs from the store, like with mlflow.run
+
+    :return: seconds spent in go
+    """
+    import wandb
+
+    module = load_step(step_dir)
+    with step_context(step_dir):
+        start = time.perf_counter()
+        try:
+            module.go(argparse.Namespace(**parameters))
+        finally:
+            wandb.finish()
+        return time.perf_counter() - start
+
+
+def benchmark_model(step_dir, store, config, rf_config):
+    """
+    Fit, predict and export the inference pipeline of train_random_forest
+
+    :return: dictionary with the measurements
+    """
+    import mlflow.sklearn
+    from sklearn.model_selection import train_test_split
+
+    from wandb_utils.datasets import read_dataset
+
+    module = load_step(step_dir)
+    modeling = config["modeling"]
+    with step_context(step_dir):
+        X = read_dataset(store.artifact("trainval_data:latest").file())
+        y = X.pop("price")
+        stratify = X[modeling["stratify_by"]] if modeling["stratify_by"] != "none" else None
+        X_train, X_val, y_train, y_val = train_test_split(
+            X, y, test_size=modeling["val_size"], stratify=stratify, random_state=modeling["random_seed"]
+        )
+
+        sk_pipe, _ = module.get_inference_pipeline(
+            dict(rf_config, random_state=modeling["random_seed"]),
+            modeling["max_tfidf_features"],
+            OmegaConf.to_container(modeling["landmarks"]),
+            modeling["feature_format"],
+        )
+        start = time.perf_counter()
+        sk_pipe.fit(X_train, y_train)
+        fit_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        sk_pipe.predict(X_val)
+        predict_time = time.perf_counter() - start
+
+        export_dir = os.path.join(step_dir, "random_forest_dir")
+        shutil.rmtree(export_dir, ignore_errors=True)
+        start = time.perf_counter()
+        mlflow.sklearn.save_model(
+            sk_pipe,
+            export_dir,
+            input_example=X_train.iloc[:5],
+            code_paths=["feature_engineering.py", "compact_forest.py", "fast_predictor.py"],
+        )
+        export_time = time.perf_counter() - start
+
+    model_size = sum(
+        os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(export_dir) for f in files
+    )
+    return {
+        "train_rows": len(X_train),
+        "fit_s": fit_time,
+        "fit_rows_per_s": len(X_train) / fit_time,
+        "predict_s": predict_time,
+        "predict_rows_per_s": len(X_val) / predict_time,
+        "export_s": export_time,
+        "model_size_mb": model_size / 1024 ** 2,
+    }
+
+
+def benchmark(n_rows, profile, steps, work_dir, config, rf_config, chunksize, seed):
+    """
+    Run the steps on n_rows synthetic listings
+
+    :param n_rows: number of listings
+    :param profile: the synthetic.ListingProfile the listings are drawn from
+    :param steps: maps the name of each step to its directory
+    :param work_dir: scratch directory, the artifact store of this size is created in it
+    :param config: configuration of the pipeline
+    :param rf_config: configuration of the random forest
+    :param chunksize: chunk size of basic_cleaning and data_check (0 for in memory)
+    :param seed: seed of the generator
+    :return: dictionary with the measurements
+    """
+    from wandb_utils.artifact_store import open_store
+
+    etl = config["etl"]
+    artifact_format = config["main"]["artifact_format"]
+    store_dir = os.path.join(work_dir, f"store_{n_rows}")
+    os.environ["ARTIFACT_STORE_DIR"] = store_dir
+    store = open_store()
+    results = {"rows": n_rows}
+
+    sample_path = os.path.join(store_dir, "sample.csv")
+    os.makedirs(store_dir, exist_ok=True)
+    start = time.perf_counter()
+    write_listings(profile, sample_path, n_rows, seed)
+    results["generate_s"] = time.perf_counter() - start
+    results["sample_mb"] = os.path.getsize(sample_path) / 1024 ** 2
+    store.log_artifact("sample.csv", "raw_data", "Synthetic listings", [sample_path])
+    os.remove(sample_path)
+
+    logger.info(f"{n_rows} rows: basic_cleaning")
+    results["basic_cleaning_s"] = run_step(
+        steps["basic_cleaning"],
+        input_artifact="sample.csv:latest",
+        output_artifact="clean_sample.csv",
+        output_type="clean_sample",
+        output_description="Cleaned synthetic listings",
+        min_price=etl["min_price"],
+        max_price=etl["max_price"],
+        artifact_format=artifact_format,
+        chunksize=chunksize,
+    )
+    clean = store.artifact("clean_sample.csv:latest")
+    results["clean_rows_per_s"] = n_rows / results["basic_cleaning_s"]
+
+    # The data is checked against itself: the drift checks cost the same whatever they find
+    store.set_alias("clean_sample.csv", clean.digest, "reference")
+    logger.info(f"{n_rows} rows: data_check")
+    results["data_check_s"] = run_step(
+        steps["data_check"],
+        csv="clean_sample.csv:latest",
+        ref="clean_sample.csv:reference",
+        kl_threshold=config["data_check"]["kl_threshold"],
+        min_price=etl["min_price"],
+        max_price=etl["max_price"],
+        profile_cache_dir="none",
+        chunksize=chunksize,
+    )
+    # Expected to include row_count below 15k and above 1M rows
+    with open(os.path.join(steps["data_check"], "data_check_report.json")) as fp:
+        report = json.load(fp)
+    results["data_check_failed"] = [
+        name for name, result in report["expectations"].items() if not result["passed"]
+    ]
+
+    logger.info(f"{n_rows} rows: data_split")
+    results["data_split_s"] = run_step(
+        steps["data_split"],
+        input_artifact="clean_sample.csv:latest",
+        test_size=config["modeling"]["test_size"],
+        random_seed=config["modeling"]["random_seed"],
+        stratify_by=config["modeling"]["stratify_by"],
+        artifact_format=artifact_format,
+    )
+
+    logger.info(f"{n_rows} rows: train_random_forest")
+    results.update(benchmark_model(steps["train_random_forest"], store, config, rf_config))
+
+    # Peak of the whole process so far, so it covers this size and the smaller ones
+    results["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    shutil.rmtree(store_dir)
+    return results
+
+
+def go(args):
+    config = OmegaConf.load(args.config)
+    rf_config = OmegaConf.to_container(config["modeling"]["random_forest"])
+    if args.rf_config is not None:
+        with open(args.rf_config) as fp:
+            rf_config = json.load(fp)
+    chunksize = args.chunksize if args.chunksize is not None else config["etl"]["chunksize"]
+
+    commit, dirty = git_commit()
+    output = args.output or os.path.join(PROJECT_DIR, "benchmarks", "results", f"{(commit or 'unknown')[:12]}.json")
+
+    work_dir = tempfile.mkdtemp(prefix="nyc_airbnb_benchmark_", dir=args.work_dir)
+    try:
+        os.environ.update(offline_environment(work_dir))
+        # The steps write their outputs in their directory, so they run from copies
+        steps = {}
+        for name, step_dir in STEP_DIRS.items():
+            steps[name] = os.path.join(work_dir, "steps", name)
+            shutil.copytree(step_dir, steps[name], ignore=shutil.ignore_patterns("__pycache__"))
+
+        load_steps(steps)
+        profile = ListingProfile.from_sample(args.sample)
+        results = []
+        for n_rows in args.rows:
+            results.append(benchmark(n_rows, profile, steps, work_dir, config, rf_config, chunksize, args.seed))
+            logger.info(f"{n_rows} rows: {json.dumps(results[-1])}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "parameters": {
+            "rf_config": rf_config,
+            "chunksize": chunksize,
+            "seed": args.seed,
+            "sample": os.path.relpath(args.sample, PROJECT_DIR),
+            "artifact_format": config["main"]["artifact_format"],
+            "max_tfidf_features": config["modeling"]["max_tfidf_features"],
+            "feature_format": config["modeling"]["feature_format"],
+        },
+        "results": results,
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as fp:
+        json.dump(report, fp, indent=2)
+    logger.info(f"Results saved to {output}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline on synthetic listings, offline")
+    parser.add_argument("--rows", type=parse_rows, nargs="+", default=[10_000, 100_000, 1_000_000, 10_000_000],
+                        help="Dataset sizes, like 10k 100k 1M 10M")
+    parser.add_argument("--config", type=str, default=os.path.join(PROJECT_DIR, "config.yaml"),
+                        help="Configuration of the pipeline, for the parameters of the steps")
+    parser.add_argument("--rf_config", type=str, default=None,
+                        help="Optional JSON file replacing modeling.random_forest of the configuration "
+                        "(use a smaller forest to benchmark the largest sizes)")
+    parser.add_argument("--chunksize", type=int, default=None,
+                        help="Chunk size of basic_cleaning and data_check, instead of etl.chunksize")
+    parser.add_argument("--sample", type=str, default=DEFAULT_SAMPLE,
+                        help="Sample of real listings the synthetic ones are drawn like")
+    parser.add_argument("--seed", type=int, default=42, help="Seed for random number generator")
+    parser.add_argument("--work_dir", type=str, default=None,
+                        help="Where the scratch directory is created (default: the system temporary directory)")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Path of the JSON results (default: benchmarks/results/<commit>.json)")
+    args = parser.parse_args()
+
+    go(args)
@@ -0,0 +1,184 @@
+"""
+Synthetic Airbnb listings with the schema of the samples of the download step. The
+distributions are learned from a sample (by default the one shipped with get_data): the
+neighbourhoods with their frequency and location, the price of each room type, the review
+activity and dates, and the words of the names. Any number of rows can be generated, chunk by
+chunk, so 10 million rows do not need to fit in memory
+
+    python -m benchmarks.synthetic --rows 1M --output listings_1M.csv
+"""
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from wandb_utils.datasets import DatasetWriter, read_dataset
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SAMPLE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "components", "get_data", "data", "sample1.csv"
+)
+
+_SUFFIXES = {"k": 10 ** 3, "m": 10 ** 6}
+
+
+def parse_rows(value):
+    """
+    Number of rows, like 10000, 10k or 1M
+    """
+    value = value.strip().lower()
+    if value[-1:] in _SUFFIXES:
+        return int(float(value[:-1]) * _SUFFIXES[value[-1]])
+    return int(value)
+
+
+class ListingProfile:
+    """
+    Distributions of the columns of a sample of listings, from which new listings are drawn.
+    The categorical columns, the counts and the activity of the hosts are resampled from the
+    sample, the price follows a log-normal distribution per room type, the coordinates a
+    normal distribution around the center of each neighbourhood, and the names are made of
+    words drawn with their frequency in the names of the sample
+
+    :param sample: DataFrame of listings, with the columns of the samples of get_data
+    """
+
+    def __init__(self, sample):
+        self.columns = list(sample.columns)
+
+        neighbourhoods = sample.groupby(["neighbourhood_group", "neighbourhood", "room_type"]).size()
+        self.neighbourhoods = neighbourhoods.index.to_frame(index=False)
+        self.neighbourhood_p = (neighbourhoods / neighbourhoods.sum()).to_numpy()
+
+        # Neighbourhoods with a single listing get a spread of about a kilometer
+        location = sample.groupby("neighbourhood")[["latitude", "longitude"]].agg(["mean", "std"])
+        self.location = location.fillna(0.01)
+
+        positive = sample[sample["price"] > 0]
+        log_price = np.log(positive["price"]).groupby(positive["room_type"]).agg(["mean", "std"])
+        self.log_price = log_price.fillna(log_price["std"].mean())
+        self.free_fraction = float((sample["price"] == 0).mean())
+
+        self.minimum_nights = sample["minimum_nights"].to_numpy()
+        self.availability_365 = sample["availability_365"].to_numpy()
+        self.host_listings = sample["calculated_host_listings_count"].to_numpy()
+        self.host_names = sample["host_name"].to_numpy()
+        self.host_id_range = (int(sample["host_id"].min()), int(sample["host_id"].max()))
+        self.first_id = int(sample["id"].max()) + 1
+
+        # The last review and the reviews per month are missing for the listings never reviewed
+        reviewed = sample[sample["number_of_reviews"] > 0].dropna(subset=["last_review", "reviews_per_month"])
+        last_review = pd.to_datetime(reviewed["last_review"])
+        self.number_of_reviews = sample["number_of_reviews"].to_numpy()
+        self.latest_review = last_review.max()
+        self.review_age_days = (self.latest_review - last_review).dt.days.to_numpy()
+        self.reviews_per_month = reviewed["reviews_per_month"].to_numpy()
+
+        words = sample["name"].dropna().str.split()
+        counts = words.explode().value_counts()
+        self.words = counts.index.to_numpy(dtype=object)
+        self.word_p = (counts / counts.sum()).to_numpy()
+        self.name_lengths = words.str.len().to_numpy()
+        self.missing_name_fraction = float(sample["name"].isna().mean())
+
+    @classmethod
+    def from_sample(cls, path=DEFAULT_SAMPLE):
+        """
+        :param path: path to a sample of listings (CSV or Parquet)
+        """
+        return cls(read_dataset(path))
+
+    def _names(self, rng, n_rows):
+        lengths = rng.choice(self.name_lengths, n_rows)
+        words = self.words[rng.choice(len(self.words), size=lengths.sum(), p=self.word_p)]
+        names = np.array([" ".join(name) for name in np.split(words, np.cumsum(lengths)[:-1])], dtype=object)
+        names[rng.random(n_rows) < self.missing_name_fraction] = None
+        return names
+
+    def sample(self, n_rows, rng, first_id=None):
+        """
+        Draw listings
+
+        :param n_rows: number of listings
+        :param rng: numpy random Generator
+        :param first_id: id of the first listing, the following ones are consecutive
+        :return: DataFrame with the columns of the sample
+        """
+        first_id = self.first_id if first_id is None else first_id
+        df = self.neighbourhoods.iloc[rng.choice(len(self.neighbourhoods), n_rows, p=self.neighbourhood_p)]
+        df = df.reset_index(drop=True)
+
+        location = self.location.loc[df["neighbourhood"]]
+        df["latitude"] = rng.normal(location[("latitude", "mean")], location[("latitude", "std")])
+        df["longitude"] = rng.normal(location[("longitude", "mean")], location[("longitude", "std")])
+
+        log_price = self.log_price.loc[df["room_type"]]
+        price = np.round(np.exp(rng.normal(log_price["mean"], log_price["std"])))
+        price[rng.random(n_rows) < self.free_fraction] = 0
+        df["price"] = price.astype(int)
+
+        number_of_reviews = rng.choice(self.number_of_reviews, n_rows)
+        reviewed = number_of_reviews > 0
+        review_age = pd.to_timedelta(rng.choice(self.review_age_days, n_rows), unit="D")
+        last_review = (self.latest_review - review_age).strftime("%Y-%m-%d").to_numpy(dtype=object)
+        last_review[~reviewed] = None
+
+        df["id"] = np.arange(first_id, first_id + n_rows)
+        df["name"] = self._names(rng, n_rows)
+        df["host_id"] = rng.integers(*self.host_id_range, size=n_rows, endpoint=True)
+        df["host_name"] = rng.choice(self.host_names, n_rows)
+        df["minimum_nights"] = rng.choice(self.minimum_nights, n_rows)
+        df["number_of_reviews"] = number_of_reviews
+        df["last_review"] = last_review
+        df["reviews_per_month"] = np.where(reviewed, rng.choice(self.reviews_per_month, n_rows), np.nan)
+        df["calculated_host_listings_count"] = rng.choice(self.host_listings, n_rows)
+        df["availability_365"] = rng.choice(self.availability_365, n_rows)
+        return df[self.columns]
+
+
+def write_listings(profile, path, n_rows, seed=42, chunksize=500_000):
+    """
+    Generate listings into a file, chunksize rows at a time. The same seed and chunksize
+    give the same file
+
+    :param profile: a ListingProfile
+    :param path: output file (CSV or Parquet, from the extension)
+    :param n_rows: number of listings
+    :param seed: seed of the random number generator
+    :param chunksize: number of listings generated at a time
+    :return: path
+    """
+    rng = np.random.default_rng(seed)
+    with DatasetWriter(path) as writer:
+        for start in range(0, n_rows, chunksize):
+            writer.write(profile.sample(min(chunksize, n_rows - start), rng, profile.first_id + start))
+    return path
+
+
+def go(args):
+    profile = ListingProfile.from_sample(args.sample)
+    start = time.perf_counter()
+    write_listings(profile, args.output, args.rows, args.seed, args.chunksize)
+    logger.info(f"Generated {args.rows} listings in {args.output} in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+
+    parser = argparse.ArgumentParser(description="Generate synthetic Airbnb listings")
+    parser.add_argument("--rows", type=parse_rows, required=True,
+                        help="Number of listings, like 10000, 100k or 10M")
+    parser.add_argument("--output", type=str, required=True,
+                        help="Output file, CSV or Parquet depending on the extension")
+    parser.add_argument("--sample", type=str, default=DEFAULT_SAMPLE,
+                        help="Sample of real listings the distributions are learned from")
+    parser.add_argument("--seed", type=int, default=42, help="Seed for random number generator")
+    parser.add_argument("--chunksize", type=int, default=500_000,
+                        help="Number of listings generated (and held in memory) at a time")
+    args = parser.parse_args()
+
+    go(args)
@@ -3,37 +3,153 @@
 This script download a URL to a local destination
 """
 import argparse
+import base64
+import concurrent.futures
+import glob
+import hashlib
 import logging
 import os
 
-import wandb
-
+from wandb_utils.artifact_store import ArtifactNotFound, open_store
+from wandb_utils.datasets import dataset_columns
 from wandb_utils.log_artifact import log_artifact
+from wandb_utils.publisher import ArtifactPublisher
+from wandb_utils.startup import add_profile_startup_argument
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
 logger = logging.getLogger()
 
+# Imported by go only, see --profile_startup
+DEFERRED_IMPORTS = ["wandb"]
+
+# Size of the blocks read to hash the samples
+_BLOCK_SIZE = 1024 * 1024
 
-def go(args):
+
+def go(args, frames=None):
+    import wandb
 
     run = wandb.init(job_type="download_file")
     run.config.update(args)
 
-    logger.info(f"Returning sample {args.sample}")
-    logger.info(f"Uploading {args.artifact_name} to Weights & Biases")
-    log_artifact(
-        args.artifact_name,
-        args.artifact_type,
-        args.artifact_description,
-        os.path.join("data", args.sample),
-        run,
-    )
+    paths = resolve_samples(args.sample)
+    logger.info(f"Returning samples {[os.path.basename(path) for path in paths]}")
+
+    # Validating a sample means reading its header and hashing its whole content, which
+    # are I/O bound (hashlib releases the GIL on large blocks), so threads are enough
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.max_workers) as executor:
+        samples = list(executor.map(inspect_sample, paths))
+    check_columns(samples)
+
+    # A single artifact, with one file per sample
+    store = open_store(run)
+    changed = changed_samples(store, args.artifact_name, samples)
+    if changed is None:
+        logger.info(f"{args.artifact_name} is identical to its latest version, skipping the upload")
+        store.use_artifact(f"{args.artifact_name}:latest")
+    else:
+        # The new version lists all the samples, but the stores only upload the content of
+        # the files they do not have yet (W&B and the local store deduplicate by digest)
+        logger.info(
+            f"Publishing a new version of {args.artifact_name}, uploading "
+            f"{[os.path.basename(sample['path']) for sample in changed]}"
+        )
+        with ArtifactPublisher(store, max_workers=args.max_workers) as publisher:
+            log_artifact(
+                args.artifact_name,
+                args.artifact_type,
+                args.artifact_description,
+                [sample["path"] for sample in samples],
+                run,
+                publisher=publisher,
+            )
+
+    run.summary["n_samples"] = len(samples)
+    run.summary["n_samples_uploaded"] = len(changed or [])
+
+
+def resolve_samples(sample):
+    """
+    :param sample: name of a sample in the data directory, a glob pattern (like "sample*.csv")
+                   or a comma-separated list of names and patterns
+    :return: list of paths of the matching samples
+    """
+    paths = []
+    for pattern in sample.split(","):
+        matches = sorted(glob.glob(os.path.join("data", pattern.strip())))
+        if not matches:
+            raise ValueError(f"No sample matches {pattern}")
+        paths.extend(matches)
+    # The same sample could match several patterns
+    return list(dict.fromkeys(paths))
+
+
+def inspect_sample(path):
+    """
+    Validate a sample and hash its content
+
+    :param path: path of the sample
+    :return: dictionary with the path, the columns and the MD5 digest of the sample (base64
+             encoded, like the digests of the files of W&B artifacts)
+    """
+    if os.path.getsize(path) == 0:
+        raise ValueError(f"The sample {path} is empty")
+    columns = dataset_columns(path)
+
+    md5 = hashlib.md5()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(_BLOCK_SIZE), b""):
+            md5.update(block)
+
+    return {"path": path, "columns": columns, "digest": base64.b64encode(md5.digest()).decode()}
+
+
+def check_columns(samples):
+    """
+    All the samples must have the same columns, to be used as parts of the same dataset
+    """
+    columns = samples[0]["columns"]
+    for sample in samples[1:]:
+        if sample["columns"] != columns:
+            raise ValueError(
+                f"The columns of {sample['path']} ({sample['columns']}) differ from the ones of "
+                f"{samples[0]['path']} ({columns})"
+            )
+
+
+def changed_samples(store, name, samples):
+    """
+    Compare the samples with the files of the latest version of an artifact, one by one
+
+    :param store: artifact store of the run
+    :param name: name of the artifact
+    :param samples: the samples, as returned by inspect_sample
+    :return: the samples that are new or whose content changed, or None when the latest
+             version contains exactly these samples (and no other file)
+    """
+    try:
+        latest = store.artifact(f"{name}:latest")
+    except ArtifactNotFound:
+        # No version yet
+        return samples
+
+    digests = {path: entry.digest for path, entry in latest.manifest.entries.items()}
+    changed = [sample for sample in samples if digests.get(os.path.basename(sample["path"])) != sample["digest"]]
+    if not changed and len(digests) == len(samples):
+        return None
+    # Samples removed since the latest version also need a new version, without them
+    return changed
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Download URL to a local destination")
 
-    parser.add_argument("sample", type=str, help="Name of the sample to download")
+    parser.add_argument(
+        "sample",
+        type=str,
+        help="Name of the sample to download. Can be a glob pattern (like 'sample*.csv') or a "
+        "comma-separated list, to publish several samples",
+    )
 
     parser.add_argument("artifact_name", type=str, help="Name for the output artifact")
 
@@ -43,6 +159,15 @@ if __name__ == "__main__":
         "artifact_description", type=str, help="A brief description of this artifact"
     )
 
+    parser.add_argument(
+        "--max_workers",
+        type=int,
+        default=4,
+        help="Number of samples validated, hashed and uploaded at the same time",
+    )
+
+    add_profile_startup_argument(parser, DEFERRED_IMPORTS)
+
     args = parser.parse_args()
 
     go(args)
@@ -13,6 +13,7 @@ setup(
     ],
     install_requires=[
         "mlflow",
-        "wandb"
+        "wandb",
+        "pandas"
     ]
 )
@@ -4,47 +4,67 @@ This step takes the best model, tagged with the "prod" tag, and tests it against
 """
 import argparse
 import logging
-import wandb
-import mlflow
-import pandas as pd
-from sklearn.metrics import mean_absolute_error
 
+from wandb_utils.artifact_store import open_store
+from wandb_utils.batch_inference import predict_batches
+from wandb_utils.datasets import common_dtypes, iter_dataset
 from wandb_utils.log_artifact import log_artifact
+from wandb_utils.startup import add_profile_startup_argument
 
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
 logger = logging.getLogger()
 
+# Imported by go only, see --profile_startup
+DEFERRED_IMPORTS = ["wandb", "mlflow.sklearn"]
+
 
 def go(args):
+    import mlflow.sklearn
+    import wandb
 
     run = wandb.init(job_type="test_model")
     run.config.update(args)
+    store = open_store(run)
 
     logger.info("Downloading artifacts")
     # Download input artifact. This will also log that this script is using this
     # particular version of the artifact
-    model_local_path = run.use_artifact(args.mlflow_model).download()
+    model_local_path = store.use_artifact(args.mlflow_model).download()
 
     # Download test dataset
-    test_dataset_path = run.use_artifact(args.test_dataset).file()
-
-    # Read test dataset
-    X_test = pd.read_csv(test_dataset_path)
-    y_test = X_test.pop("price")
+    test_dataset_path = store.use_artifact(args.test_dataset).file()
 
     logger.info("Loading model and performing inference on test set")
     sk_pipe = mlflow.sklearn.load_model(model_local_path)
-    y_pred = sk_pipe.predict(X_test)
 
-    logger.info("Scoring")
-    r_squared = sk_pipe.score(X_test, y_test)
+    # Read the test dataset in chunks (only the columns used by the model), with the same
+    # column types in every chunk as if the whole file was read at once
+    columns = list(sk_pipe.feature_names_in_) + ["price"]
+    dtype = common_dtypes(test_dataset_path, args.chunksize, columns=columns)
+    chunks = iter_dataset(test_dataset_path, args.chunksize, columns=columns, dtype=dtype)
 
-    mae = mean_absolute_error(y_test, y_pred)
+    # A single prediction pass gives both metrics (sk_pipe.score would predict again)
+    logger.info("Scoring")
+    predictions_path = "predictions.parquet" if args.predictions_artifact != "none" else None
+    metrics = predict_batches(
+        chunks, sk_pipe, model_local_path, n_workers=args.n_workers, target="price", output_path=predictions_path
+    )
+    r_squared = metrics.r2
+    mae = metrics.mae
 
     logger.info(f"Score: {r_squared}")
     logger.info(f"MAE: {mae}")
 
+    if predictions_path is not None:
+        log_artifact(
+            args.predictions_artifact,
+            "predictions",
+            "Predictions of the model on the test dataset",
+            predictions_path,
+            run,
+        )
+
     # Log MAE and r2
     run.summary['r2'] = r_squared
     run.summary['mae'] = mae
@@ -68,6 +88,29 @@ if __name__ == "__main__":
         required=True
     )
 
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        help="Number of rows predicted at a time",
+        default=100000
+    )
+
+    parser.add_argument(
+        "--n_workers",
+        type=int,
+        help="Number of processes predicting chunks in parallel (-1 for one per core)",
+        default=1
+    )
+
+    parser.add_argument(
+        "--predictions_artifact",
+        type=str,
+        help="Name for the artifact with the predictions (in Parquet format), or 'none'",
+        default="none"
+    )
+
+    add_profile_startup_argument(parser, DEFERRED_IMPORTS)
+
     args = parser.parse_args()
 
     go(args)
@@ -4,27 +4,35 @@ This script splits the provided dataframe in test and remainder
 """
 import argparse
 import logging
-import pandas as pd
-import wandb
+import os
 import tempfile
-from sklearn.model_selection import train_test_split
+from wandb_utils.artifact_store import open_store
+from wandb_utils.datasets import dataset_filename, read_dataset, write_dataset
 from wandb_utils.log_artifact import log_artifact
+from wandb_utils.publisher import ArtifactPublisher
+from wandb_utils.startup import add_profile_startup_argument
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
 logger = logging.getLogger()
 
+# Imported by go only, see --profile_startup
+DEFERRED_IMPORTS = ["wandb", "sklearn.model_selection"]
+
 
 def go(args):
+    import wandb
+    from sklearn.model_selection import train_test_split
 
     run = wandb.init(job_type="train_val_test_split")
     run.config.update(args)
+    store = open_store(run)
 
     # Download input artifact. This will also note that this script is using this
     # particular version of the artifact
     logger.info(f"Fetching artifact {args.input}")
-    artifact_local_path = run.use_artifact(args.input).file()
+    artifact_local_path = store.use_artifact(args.input).file()
 
-    df = pd.read_csv(artifact_local_path)
+    df = read_dataset(artifact_local_path)
 
     logger.info("Splitting trainval and test")
     trainval, test = train_test_split(
@@ -34,19 +42,22 @@ def go(args):
         stratify=df[args.stratify_by] if args.stratify_by != 'none' else None,
     )
 
-    # Save to output files
-    for df, k in zip([trainval, test], ['trainval', 'test']):
-        logger.info(f"Uploading {k}_data.csv dataset")
-        with tempfile.NamedTemporaryFile("w") as fp:
+    # Save to output files. The test split is written while the trainval one is uploaded, and
+    # the files are kept until the publisher is done with them
+    with tempfile.TemporaryDirectory() as tmp_dir, ArtifactPublisher(store) as publisher:
+        for df, k in zip([trainval, test], ['trainval', 'test']):
+            logger.info(f"Uploading {k}_data.csv dataset")
 
-            df.to_csv(fp.name, index=False)
+            filename = os.path.join(tmp_dir, dataset_filename(f"{k}_data.csv", args.artifact_format))
+            write_dataset(df, filename)
 
             log_artifact(
                 f"{k}_data.csv",
                 f"{k}_data",
                 f"{k} split of dataset",
-                fp.name,
+                filename,
                 run,
+                publisher=publisher,
             )
 
 
@@ -67,6 +78,12 @@ if __name__ == "__main__":
         "--stratify_by", type=str, help="Column to use for stratification", default='none', required=False
     )
 
+    parser.add_argument(
+        "--artifact_format", type=str, help="Format of the output files (csv or parquet)", default='csv', required=False
+    )
+
+    add_profile_startup_argument(parser, DEFERRED_IMPORTS)
+
     args = parser.parse_args()
 
     go(args)
@@ -0,0 +1,393 @@
+"""
+Where the artifacts exchanged by the steps live. The steps fetch their inputs and publish
+their outputs through a store, chosen with the ARTIFACT_STORE environment variable:
+
+- "wandb" (the default): the artifacts are logged to and downloaded from W&B
+- "local": the artifacts are kept in a content-addressed directory on the local disk
+  (ARTIFACT_STORE_DIR), so a step reads the outputs of the previous one at disk speed and
+  the pipeline runs without network. With ARTIFACT_STORE_MIRROR=true, every artifact is
+  also logged to W&B, without waiting for the upload
+
+Both stores understand the same references ("name:alias", like "clean_sample.csv:latest")
+and give artifacts with the same interface as the W&B ones (file, download, digest,
+metadata, save, manifest.entries), so the steps do not depend on the backend. wandb is
+imported only by the code talking to W&B, so opening a local store does not pay for it
+"""
+import argparse
+import base64
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from types import SimpleNamespace
+
+STORE_ENV = "ARTIFACT_STORE"
+STORE_DIR_ENV = "ARTIFACT_STORE_DIR"
+MIRROR_ENV = "ARTIFACT_STORE_MIRROR"
+
+BACKENDS = ["wandb", "local"]
+
+DEFAULT_STORE_DIR = "~/.local/share/nyc_airbnb/artifacts"
+
+_BLOCK_SIZE = 1024 * 1024
+
+
+class ArtifactNotFound(LookupError):
+    """
+    The reference does not match any artifact version
+    """
+
+
+def open_store(run=None, project=None):
+    """
+    Open the store selected by the environment
+
+    :param run: W&B run of the step, used for the lineage of the artifacts and to log them
+                to W&B. Without a run, the store can only be used to look artifacts up
+    :param project: W&B project of the artifacts, when there is no run
+    :return: a WandbStore or a LocalStore
+    """
+    backend = os.environ.get(STORE_ENV, "wandb")
+    if backend == "wandb":
+        return WandbStore(run, project)
+    if backend == "local":
+        return LocalStore(
+            os.environ.get(STORE_DIR_ENV, DEFAULT_STORE_DIR),
+            run,
+            project,
+            mirror=os.environ.get(MIRROR_ENV, "false").lower() == "true",
+        )
+    raise ValueError(f"Unknown artifact store {backend}, expected one of {BACKENDS}")
+
+
+def _parse_reference(reference):
+    # W&B references can be prefixed with the entity and the project
+    name, _, alias = reference.rpartition("/")[2].partition(":")
+    return name, alias or "latest"
+
+
+def _add_paths(artifact, paths):
+    for path in paths:
+        if os.path.isdir(path):
+            artifact.add_dir(path)
+        else:
+            artifact.add_file(path)
+
+
+class WandbStore:
+    """
+    The artifacts live in W&B
+
+    :param run: W&B run of the step
+    :param project: W&B project, when there is no run
+    """
+
+    def __init__(self, run=None, project=None):
+        self.run = run
+        self.project = project or (run.project if run is not None else None)
+        self._api = None
+
+    def use_artifact(self, reference):
+        """
+        Artifact used as an input of the run
+
+        :param reference: like "clean_sample.csv:latest"
+        """
+        return self.run.use_artifact(reference)
+
+    def artifact(self, reference):
+        """
+        Look an artifact up, without recording it as an input of a run
+        """
+        import wandb
+
+        if self._api is None:
+            self._api = wandb.Api()
+        try:
+            return self._api.artifact(f"{self.project}/{reference}")
+        except wandb.errors.CommError as e:
+            raise ArtifactNotFound(reference) from e
+
+    def log_artifact(self, name, artifact_type, description, paths, metadata=None, aliases=None, wait=False):
+        """
+        Publish a new version of an artifact
+
+        :param name: name of the artifact
+        :param artifact_type: type of the artifact
+        :param description: description of the artifact
+        :param paths: files and directories of the artifact. The files of a directory are
+                      added with their path relative to it
+        :param metadata: dictionary stored with the artifact
+        :param aliases: aliases of the new version, besides "latest"
+        :param wait: wait until the version is available to the following steps
+        :return: the artifact
+        """
+        import wandb
+
+        artifact = wandb.Artifact(name, type=artifact_type, description=description, metadata=metadata)
+        _add_paths(artifact, paths)
+        self.run.log_artifact(artifact, aliases=aliases)
+        if wait:
+            artifact.wait()
+        return artifact
+
+
+class LocalArtifact:
+    """
+    A version of an artifact of a LocalStore
+
+    :param path: directory of the version
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "manifest.json")) as fp:
+            manifest = json.load(fp)
+        self.name = manifest["name"]
+        self.type = manifest["type"]
+        self.description = manifest["description"]
+        self.metadata = manifest["metadata"]
+        self.digest = manifest["digest"]
+        self.version = manifest["version"]
+        self.manifest = SimpleNamespace(
+            entries={name: SimpleNamespace(path=name, digest=digest) for name, digest in manifest["entries"].items()}
+        )
+        self._manifest = manifest
+
+    def file(self):
+        """
+        :return: path of the only file of the artifact
+        """
+        if len(self.manifest.entries) != 1:
+            raise ValueError(f"{self.name} has {len(self.manifest.entries)} files, use download")
+        return os.path.join(self.path, "files", next(iter(self.manifest.entries)))
+
+    def download(self, root=None):
+        """
+        :param root: directory where the files are linked, if they are needed somewhere else
+                     than in the store
+        :return: directory with the files of the artifact
+        """
+        files_dir = os.path.join(self.path, "files")
+        if root is None:
+            return files_dir
+        for name in self.manifest.entries:
+            target = os.path.join(root, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if os.path.exists(target):
+                os.remove(target)
+            _link(os.path.join(files_dir, name), target)
+        return root
+
+    def save(self):
+        """
+        Save the changes to the metadata
+        """
+        self._manifest["metadata"] = self.metadata
+        _write_json(os.path.join(self.path, "manifest.json"), self._manifest)
+
+
+class LocalStore:
+    """
+    Content-addressed store of the artifacts on the local disk:
+
+    - objects/: the content of every file, once, named after its MD5 and read-only
+    - artifacts/<name>/<digest>/: a version of an artifact, with its manifest and its files,
+      hard links to the objects (so using a version never copies data)
+    - artifacts/<name>/aliases/<alias>: the digest of the version with this alias. Every
+      version is also reachable as "v<n>", like in W&B
+
+    Publishing the same content again gives the same version, and just moves the aliases
+
+    :param root: directory of the store
+    :param run: W&B run of the step, needed to mirror the artifacts to W&B
+    :param project: W&B project, to pull artifacts from W&B when there is no run
+    :param mirror: also log the artifacts to W&B (the upload goes on in the background, and
+                   the W&B run waits for it when it finishes)
+    """
+
+    def __init__(self, root, run=None, project=None, mirror=False):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.run = run
+        self.project = project or (run.project if run is not None else None)
+        self.mirror = mirror and run is not None
+        os.makedirs(os.path.join(self.root, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(self.root, "artifacts"), exist_ok=True)
+
+    def _artifact_dir(self, name):
+        return os.path.join(self.root, "artifacts", name)
+
+    def artifact(self, reference):
+        """
+        Look an artifact up, without recording it as an input of the run
+        """
+        # The version is an alias, or directly the digest of the version
+        name, version = _parse_reference(reference)
+        alias_path = os.path.join(self._artifact_dir(name), "aliases", version)
+        if os.path.exists(alias_path):
+            with open(alias_path) as fp:
+                version = fp.read().strip()
+        version_dir = os.path.join(self._artifact_dir(name), version)
+        if not os.path.exists(os.path.join(version_dir, "manifest.json")):
+            raise ArtifactNotFound(reference)
+        return LocalArtifact(version_dir)
+
+    def use_artifact(self, reference):
+        """
+        Artifact used as an input of the run. The lineage is recorded in W&B only when
+        mirroring
+        """
+        artifact = self.artifact(reference)
+        if self.mirror:
+            self.run.use_artifact(reference)
+        return artifact
+
+    def log_artifact(self, name, artifact_type, description, paths, metadata=None, aliases=None, wait=False):
+        """
+        Publish a new version of an artifact. See WandbStore.log_artifact for the parameters:
+        the version is available as soon as this returns, so wait only matters for the mirror
+        """
+        artifact = self._publish(name, artifact_type, description, paths, metadata, ["latest"] + list(aliases or []))
+        if self.mirror:
+            import wandb
+
+            mirror = wandb.Artifact(name, type=artifact_type, description=description, metadata=metadata)
+            for entry in artifact.manifest.entries:
+                mirror.add_file(os.path.join(artifact.path, "files", entry), name=entry)
+            self.run.log_artifact(mirror, aliases=aliases)
+            if wait:
+                mirror.wait()
+        return artifact
+
+    def pull(self, reference):
+        """
+        Copy an artifact version from W&B into the store, under the same alias. For the
+        artifacts published to W&B only, like the ones of the steps of other repositories
+
+        :param reference: like "sample.csv:latest"
+        :return: the artifact
+        """
+        remote = WandbStore(project=self.project).artifact(reference)
+        name, alias = _parse_reference(reference)
+        with tempfile.TemporaryDirectory(dir=self.root, prefix=".tmp") as tmp_dir:
+            remote.download(root=tmp_dir)
+            return self._publish(name, remote.type, remote.description, [tmp_dir], remote.metadata, [alias])
+
+    def _publish(self, name, artifact_type, description, paths, metadata, aliases):
+        entries = {}
+        for path in paths:
+            if os.path.isdir(path):
+                for root, _, files in os.walk(path):
+                    for f in files:
+                        file_path = os.path.join(root, f)
+                        entries[os.path.relpath(file_path, path)] = file_path
+            else:
+                entries[os.path.basename(path)] = path
+
+        digests = {entry: self._add_object(file_path) for entry, file_path in sorted(entries.items())}
+        digest = hashlib.md5(json.dumps(digests, sort_keys=True).encode()).hexdigest()
+
+        artifact_dir = self._artifact_dir(name)
+        version_dir = os.path.join(artifact_dir, digest)
+        if not os.path.isdir(version_dir):
+            self._add_version(name, artifact_type, description, metadata, digest, digests)
+        for alias in aliases:
+            self.set_alias(name, digest, alias)
+        return LocalArtifact(version_dir)
+
+    def set_alias(self, name, digest, alias):
+        """
+        Point an alias (like "reference" or "prod") of an artifact to one of its versions
+        """
+        aliases_dir = os.path.join(self._artifact_dir(name), "aliases")
+        os.makedirs(aliases_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=aliases_dir, prefix=".tmp")
+        with os.fdopen(fd, "w") as fp:
+            fp.write(digest)
+        os.replace(tmp_path, os.path.join(aliases_dir, alias))
+
+    def _add_object(self, path):
+        md5 = hashlib.md5()
+        with open(path, "rb") as fp:
+            for block in iter(lambda: fp.read(_BLOCK_SIZE), b""):
+                md5.update(block)
+
+        object_path = self._object_path(md5.hexdigest())
+        if not os.path.exists(object_path):
+            # The file is copied (and not linked): the step could write to it again later
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(object_path), prefix=".tmp")
+            os.close(fd)
+            shutil.copyfile(path, tmp_path)
+            os.chmod(tmp_path, 0o444)
+            os.replace(tmp_path, object_path)
+
+        # Same format as the digests of the files of W&B artifacts
+        return base64.b64encode(md5.digest()).decode()
+
+    def _object_path(self, hexdigest):
+        return os.path.join(self.root, "objects", hexdigest[:2], hexdigest)
+
+    def _add_version(self, name, artifact_type, description, metadata, digest, digests):
+        artifact_dir = self._artifact_dir(name)
+        os.makedirs(artifact_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=artifact_dir, prefix=".tmp")
+        for entry, file_digest in digests.items():
+            target = os.path.join(tmp_dir, "files", entry)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            _link(self._object_path(base64.b64decode(file_digest).hex()), target)
+
+        versions = [d for d in os.listdir(artifact_dir) if not d.startswith(".") and d != "aliases"]
+        _write_json(os.path.join(tmp_dir, "manifest.json"), {
+            "name": name,
+            "type": artifact_type,
+            "description": description,
+            "metadata": metadata or {},
+            "digest": digest,
+            "version": f"v{len(versions)}",
+            "entries": digests,
+            "created": time.time(),
+        })
+        try:
+            os.rename(tmp_dir, os.path.join(artifact_dir, digest))
+        except OSError:
+            # Published at the same time by another process
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.set_alias(name, digest, f"v{len(versions)}")
+
+
+def _link(source, target):
+    # Hard links need the same file system, otherwise the file is copied
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def _write_json(path, content):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+    with os.fdopen(fd, "w") as fp:
+        json.dump(content, fp)
+    os.replace(tmp_path, path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the aliases of the local artifact store")
+    parser.add_argument("reference", type=str, help="Artifact version, like clean_sample.csv:latest")
+    parser.add_argument("alias", type=str, nargs="?", default=None,
+                        help="Alias to point to this version, like reference or prod")
+    parser.add_argument("--pull", action="store_true", help="Copy the version from W&B first")
+    parser.add_argument("--project", type=str, default=os.environ.get("WANDB_PROJECT", "nyc_airbnb"),
+                        help="W&B project to pull from")
+    parser.add_argument("--root", type=str, default=os.environ.get(STORE_DIR_ENV, DEFAULT_STORE_DIR),
+                        help="Directory of the store")
+    args = parser.parse_args()
+
+    store = LocalStore(args.root, project=args.project)
+    version = store.pull(args.reference) if args.pull else store.artifact(args.reference)
+    if args.alias is not None:
+        store.set_alias(version.name, version.digest, args.alias)
+    print(f"{version.name}:{args.alias or _parse_reference(args.reference)[1]} -> {version.version} ({version.digest})")
@@ -0,0 +1,180 @@
+import collections
+import concurrent.futures
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from .datasets import DatasetWriter
+
+logger = logging.getLogger(__name__)
+
+# Model loaded by each worker process of predict_batches
+_worker_model = None
+
+
+class RegressionMetrics:
+    """
+    MAE and R² of a regression computed incrementally, one batch of predictions at a time,
+    so that they never need all the predictions in memory. The sums of squares are merged
+    with the parallel algorithm of Chan et al., which stays accurate on large datasets
+    """
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        # Sum of the squared deviations of the target from its mean
+        self.m2 = 0.0
+        self.sum_absolute_error = 0.0
+        self.sum_squared_error = 0.0
+
+    def update(self, y_true, y_pred):
+        """
+        Add a batch of targets and predictions
+
+        :param y_true: array of targets
+        :param y_pred: array of predictions
+        """
+        y_true = np.asarray(y_true, dtype=float)
+        y_pred = np.asarray(y_pred, dtype=float)
+        n = len(y_true)
+        if n == 0:
+            return
+
+        mean = y_true.mean()
+        m2 = ((y_true - mean) ** 2).sum()
+        delta = mean - self.mean
+        total = self.n + n
+        self.m2 += m2 + delta ** 2 * self.n * n / total
+        self.mean += delta * n / total
+        self.n = total
+
+        error = y_true - y_pred
+        self.sum_absolute_error += np.abs(error).sum()
+        self.sum_squared_error += (error ** 2).sum()
+
+    @property
+    def mae(self):
+        """
+        Mean absolute error, NaN without any prediction
+        """
+        if self.n == 0:
+            return float("nan")
+        return self.sum_absolute_error / self.n
+
+    @property
+    def r2(self):
+        """
+        Coefficient of determination, NaN without any prediction or when the target is
+        constant (it is not defined then)
+        """
+        if self.n == 0 or self.m2 == 0:
+            return float("nan")
+        return 1 - self.sum_squared_error / self.m2
+
+
+def _init_worker(model_path):
+    global _worker_model
+    import mlflow.sklearn
+
+    _worker_model = mlflow.sklearn.load_model(model_path)
+    # The parallelism is across the worker processes, each model uses one core
+    estimator = _worker_model.steps[-1][1] if hasattr(_worker_model, "steps") else _worker_model
+    if "n_jobs" in estimator.get_params():
+        estimator.set_params(n_jobs=1)
+
+
+def _predict_chunk(X):
+    return _worker_model.predict(X)
+
+
+def predict_batches(chunks, model, model_path, n_workers=1, target="price", id_column=None, output_path=None):
+    """
+    Predict a dataset one chunk at a time, each chunk in a single call to predict, and
+    compute the metrics of the predictions on the fly
+
+    :param chunks: iterable of DataFrames with the features used by the model (plus the
+                   target column, if present, and the id column)
+    :param model: the loaded model, used when n_workers <= 1
+    :param model_path: path to the MLflow model, loaded by each worker process when
+                       n_workers > 1
+    :param n_workers: number of worker processes predicting the chunks in parallel (-1 for
+                      one per core). At most twice this many chunks are in memory at a time
+    :param target: name of the target column. If it is missing, only the predictions are
+                   computed
+    :param id_column: optional column copied next to the predictions, to identify the rows
+    :param output_path: optional path of a dataset (see write_dataset for the formats) where
+                        the predictions are written, in the same order as the input rows
+    :return: the RegressionMetrics of the predictions (empty without a target)
+    """
+    if n_workers < 0:
+        n_workers = os.cpu_count() or 1
+    metrics = RegressionMetrics()
+
+    def output_columns(columns):
+        return ([id_column] if id_column is not None else []) + ["prediction"] + (
+            [target] if target in columns else []
+        )
+
+    # Without any row (like a CSV file with only a header), the output is still written, empty
+    writer = DatasetWriter(output_path, columns=output_columns([target])) if output_path is not None else None
+
+    def empty(chunk):
+        # The models refuse to predict 0 rows, the chunk only tells whether there is a target
+        if len(chunk) > 0:
+            return False
+        if writer is not None:
+            writer.columns = output_columns(chunk.columns)
+        return True
+
+    def collect(chunk, y_pred):
+        y_true = chunk[target] if target in chunk.columns else None
+        if y_true is not None:
+            metrics.update(y_true, y_pred)
+        if writer is not None:
+            predictions = pd.DataFrame({"prediction": y_pred}, index=chunk.index)
+            if id_column is not None:
+                predictions.insert(0, id_column, chunk[id_column])
+            if y_true is not None:
+                predictions[target] = y_true
+            writer.write(predictions)
+
+    def features(chunk):
+        return chunk.drop(columns=[c for c in (target, id_column) if c is not None and c in chunk.columns])
+
+    n_rows = 0
+    try:
+        if n_workers <= 1:
+            for chunk in chunks:
+                if empty(chunk):
+                    continue
+                collect(chunk, model.predict(features(chunk)))
+                n_rows += len(chunk)
+        else:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=n_workers, initializer=_init_worker, initargs=(model_path,)
+            ) as executor:
+                # The results are collected in submission order, so the output follows the
+                # input. Bounding the pending chunks bounds the memory when reading is faster
+                # than predicting
+                pending = collections.deque()
+                for chunk in chunks:
+                    if empty(chunk):
+                        continue
+                    pending.append((chunk, executor.submit(_predict_chunk, features(chunk))))
+                    if len(pending) >= 2 * n_workers:
+                        done_chunk, future = pending.popleft()
+                        collect(done_chunk, future.result())
+                        n_rows += len(done_chunk)
+                while pending:
+                    done_chunk, future = pending.popleft()
+                    collect(done_chunk, future.result())
+                    n_rows += len(done_chunk)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    logger.info(f"Predicted {n_rows} rows")
+    return metrics
+
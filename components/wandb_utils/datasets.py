@@ -0,0 +1,220 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+# Formats in which the datasets can be exchanged between steps, with their file extension
+FORMATS = {"csv": ".csv", "parquet": ".parquet"}
+
+
+def dataset_filename(name, artifact_format):
+    """
+    Return the file name to use for a dataset in the given format. Artifact names in the
+    pipeline carry the .csv extension (like clean_sample.csv) for historical reasons, so
+    the extension is replaced with the one of the format
+
+    :param name: name of the artifact (or of the file)
+    :param artifact_format: one of the keys of FORMATS
+    :return: the file name
+    """
+    if artifact_format not in FORMATS:
+        raise ValueError(f"Unknown artifact format {artifact_format}, expected one of {list(FORMATS)}")
+    stem, ext = os.path.splitext(name)
+    if ext not in FORMATS.values():
+        stem = name
+    return stem + FORMATS[artifact_format]
+
+
+def dataset_parts(path):
+    """
+    Files making up a dataset: the file itself, or the dataset files of a directory (a
+    dataset split in parts, like an artifact with several samples), sorted by name
+
+    :param path: path to a file or to a directory
+    :return: list of paths
+    """
+    if not os.path.isdir(path):
+        return [path]
+    parts = sorted(
+        os.path.join(root, name)
+        for root, _, names in os.walk(path) for name in names
+        if os.path.splitext(name)[1] in FORMATS.values()
+    )
+    if not parts:
+        raise ValueError(f"No dataset file in {path}")
+    return parts
+
+
+def artifact_path(artifact):
+    """
+    Download an artifact containing a dataset
+
+    :param artifact: the artifact, as returned by use_artifact (see artifact_store)
+    :return: the path of its file, or of the directory of its files if it has several parts
+    """
+    if len(artifact.manifest.entries) == 1:
+        return artifact.file()
+    return artifact.download()
+
+
+def read_dataset(path, columns=None):
+    """
+    Read a dataset written by write_dataset. The format is inferred from the extension
+
+    :param path: path to the file, or to a directory with the parts of the dataset
+    :param columns: if provided, read only these columns
+    :return: a pandas DataFrame
+    """
+    if os.path.isdir(path):
+        return pd.concat([read_dataset(part, columns) for part in dataset_parts(path)], ignore_index=True)
+    if path.endswith(FORMATS["parquet"]):
+        return pd.read_parquet(path, columns=columns)
+    else:
+        return pd.read_csv(path, usecols=columns)
+
+
+def dataset_columns(path):
+    """
+    Names of the columns of a dataset, without reading its content
+
+    :param path: path to the file (or to a directory with the parts of the dataset)
+    :return: list of column names
+    """
+    path = dataset_parts(path)[0]
+    if path.endswith(FORMATS["parquet"]):
+        import pyarrow.parquet as pq
+
+        return pq.read_schema(path).names
+    else:
+        return list(pd.read_csv(path, nrows=0).columns)
+
+
+def write_dataset(df, path):
+    """
+    Write a dataset. The format is inferred from the extension (see dataset_filename).
+    Parquet files are compressed and keep the column types, so that the consumers do not
+    need to infer them again
+
+    :param df: pandas DataFrame to write
+    :param path: destination path
+    """
+    if path.endswith(FORMATS["parquet"]):
+        df.to_parquet(path, index=False, compression="zstd")
+    else:
+        df.to_csv(path, index=False)
+
+
+def iter_dataset(path, chunksize, columns=None, dtype=None):
+    """
+    Read a dataset in chunks of at most chunksize rows
+
+    :param path: path to the file (or to a directory with the parts of the dataset, which are
+                 read one after the other)
+    :param chunksize: number of rows per chunk
+    :param columns: if provided, read only these columns
+    :param dtype: optional mapping column -> dtype (used for CSV files only, Parquet files
+                  already store the types)
+    :return: iterator over pandas DataFrames
+    """
+    if os.path.isdir(path):
+        for part in dataset_parts(path):
+            yield from iter_dataset(part, chunksize, columns, dtype)
+        return
+    if path.endswith(FORMATS["parquet"]):
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, usecols=columns, dtype=dtype, chunksize=chunksize)
+
+
+def common_dtypes(path, chunksize, columns=None):
+    """
+    Find the type of each column over the whole dataset, reading it in chunks. When a CSV
+    file is read in chunks the types are inferred chunk by chunk (an integer column is read
+    as float only in the chunks with missing values), while reading the whole file at once
+    gives one type per column. Passing the result of this function as dtype to iter_dataset
+    makes every chunk use the same types as a full read
+
+    :param path: path to the file
+    :param chunksize: number of rows per chunk
+    :param columns: if provided, only look at these columns
+    :return: mapping column -> dtype, for the columns whose type needs to be fixed
+    """
+    if all(part.endswith(FORMATS["parquet"]) for part in dataset_parts(path)):
+        return {}
+
+    chunk_dtypes = {}
+    for chunk in iter_dataset(path, chunksize, columns=columns):
+        for column, dtype in chunk.dtypes.items():
+            chunk_dtypes.setdefault(column, set()).add(dtype)
+
+    dtypes = {}
+    for column, column_dtypes in chunk_dtypes.items():
+        numeric = [pd.api.types.is_numeric_dtype(dtype) for dtype in column_dtypes]
+        if all(numeric):
+            dtypes[column] = np.result_type(*column_dtypes)
+        elif any(numeric):
+            # Mix of numbers and text: a full read would give an object column
+            dtypes[column] = object
+
+    return dtypes
+
+
+class DatasetWriter:
+    """
+    Write a dataset one chunk at a time, so that it never needs to be in memory all at
+    once. The format is inferred from the extension, like in write_dataset. Use it as a
+    context manager:
+
+        with DatasetWriter(path) as writer:
+            for chunk in chunks:
+                writer.write(chunk)
+
+    :param path: path of the dataset
+    :param columns: optional columns of the file written on close when no chunk was, so that
+                    an empty dataset still gives a file that can be read
+    """
+
+    def __init__(self, path, columns=None):
+        self.path = path
+        self.columns = columns
+        self._parquet_writer = None
+        self._schema = None
+        self._n_chunks = 0
+
+    def write(self, df):
+        if self.path.endswith(FORMATS["parquet"]):
+            self._write_parquet(df)
+        else:
+            df.to_csv(self.path, index=False, mode="w" if self._n_chunks == 0 else "a", header=self._n_chunks == 0)
+        self._n_chunks += 1
+
+    def _write_parquet(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._parquet_writer is None:
+            schema = pa.Schema.from_pandas(df, preserve_index=False)
+            # A column with only missing values in the first chunk has no type yet
+            for i, field in enumerate(schema):
+                if pa.types.is_null(field.type):
+                    schema = schema.set(i, field.with_type(pa.string()))
+            self._schema = schema
+            self._parquet_writer = pq.ParquetWriter(self.path, schema, compression="zstd")
+
+        table = pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+        self._parquet_writer.write_table(table)
+
+    def close(self):
+        if self._n_chunks == 0 and self.columns is not None:
+            self.write(pd.DataFrame(columns=self.columns))
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,28 +1,31 @@
-import wandb
-import mlflow
+from wandb_utils.artifact_store import open_store
 
 
-def log_artifact(artifact_name, artifact_type, artifact_description, filename, wandb_run):
+def log_artifact(artifact_name, artifact_type, artifact_description, filename, wandb_run, publisher=None):
     """
-    Log the provided filename as an artifact in W&B, and add the artifact path to the MLFlow run
-    so it can be retrieved by subsequent steps in a pipeline
+    Log the provided filename as an artifact in the artifact store of the pipeline (W&B by
+    default, see artifact_store), so it can be retrieved by subsequent steps in a pipeline
 
     :param artifact_name: name for the artifact
     :param artifact_type: type for the artifact (just a string like "raw_data", "clean_data" and so on)
     :param artifact_description: a brief description of the artifact
-    :param filename: local filename for the artifact
+    :param filename: local filename for the artifact, or list of filenames for an artifact made
+                     of several files
     :param wandb_run: current Weights & Biases run
-    :return: None
+    :param publisher: if provided, the artifact is uploaded in the background by this
+                      ArtifactPublisher (see publisher.py), and the step must flush it
+    :return: None, or the Future of the upload with a publisher
     """
-    # Log to W&B
-    artifact = wandb.Artifact(
+    filenames = [filename] if isinstance(filename, str) else filename
+    if publisher is not None:
+        return publisher.publish(artifact_name, artifact_type, artifact_description, filenames)
+
+    # We need to wait before we can use the version below. This will wait until the
+    # artifact is loaded into the store and a version is assigned
+    open_store(wandb_run).log_artifact(
         artifact_name,
-        type=artifact_type,
-        description=artifact_description,
+        artifact_type,
+        artifact_description,
+        filenames,
+        wait=True,
     )
-    artifact.add_file(filename)
-    wandb_run.log_artifact(artifact)
-    # We need to call this .wait() method before we can use the
-    # version below. This will wait until the artifact is loaded into W&B and a
-    # version is assigned
-    artifact.wait()
@@ -0,0 +1,115 @@
+"""
+Publish artifacts in the background. Uploading an artifact (and waiting for W&B to give it a
+version) used to block the step; with a publisher the step queues the artifact and goes on
+computing, while a small pool of threads uploads it. The step flushes the publisher before it
+finishes, so the following steps always find the new versions
+"""
+import concurrent.futures
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ArtifactPublisher:
+    """
+    Queue of artifacts uploaded by a pool of threads. The files of an artifact must not change
+    until its upload is done (flush returns)
+
+    :param store: the artifact store of the step (see artifact_store)
+    :param max_workers: number of artifacts uploaded at the same time
+    :param retries: number of attempts after a failed upload
+    :param backoff: seconds before the first new attempt, doubled at every attempt
+    """
+
+    def __init__(self, store, max_workers=2, retries=3, backoff=1.0):
+        self.store = store
+        self.retries = retries
+        self.backoff = backoff
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="artifact_publisher"
+        )
+        # (name, future, durations) of each queued artifact
+        self._pending = []
+
+    def publish(self, name, artifact_type, description, paths, metadata=None, aliases=None):
+        """
+        Queue an artifact. See the log_artifact method of the stores for the parameters
+
+        :return: a Future, giving the published artifact (with its version and digest)
+        """
+        durations = {}
+        future = self._executor.submit(
+            self._upload, durations, name, artifact_type, description, paths, metadata, aliases
+        )
+        self._pending.append((name, future, durations))
+        return future
+
+    def _upload(self, durations, name, artifact_type, description, paths, metadata, aliases):
+        start = time.perf_counter()
+        for attempt in range(self.retries + 1):
+            try:
+                artifact = self.store.log_artifact(
+                    name, artifact_type, description, paths, metadata=metadata, aliases=aliases, wait=True
+                )
+                break
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                logger.warning(f"Upload of {name} failed ({e}), retrying in {delay:.1f} s")
+                time.sleep(delay)
+        durations["upload"] = time.perf_counter() - start
+        return artifact
+
+    def flush(self):
+        """
+        Wait for all the queued artifacts to be published, and log how long the step would
+        have waited for each upload without the publisher
+
+        :return: seconds saved on the critical path of the step
+        """
+        start = time.perf_counter()
+        errors = []
+        for name, future, durations in self._pending:
+            wait_start = time.perf_counter()
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Could not publish {name}: {e}")
+                errors.append(e)
+                continue
+            waited = time.perf_counter() - wait_start
+            logger.info(
+                f"Published {name} in {durations['upload']:.2f} s, the step waited {waited:.2f} s for it"
+            )
+
+        # Without the publisher, the step would have waited for every upload in turn
+        uploads = sum(durations.get("upload", 0.0) for _, _, durations in self._pending)
+        saved = max(uploads - (time.perf_counter() - start), 0.0)
+        if uploads > 0:
+            logger.info(f"Artifact uploads took {uploads:.2f} s, {saved:.2f} s off the critical path")
+        self._pending = []
+
+        if errors:
+            raise errors[0]
+        return saved
+
+    def close(self):
+        """
+        Flush, then stop the threads
+        """
+        try:
+            return self.flush()
+        finally:
+            self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # The step failed already: do not hide its error behind the uploads
+            self._executor.shutdown(wait=True, cancel_futures=True)
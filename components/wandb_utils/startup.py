@@ -0,0 +1,149 @@
+"""
+Startup profiling of the steps. The steps import their heavy dependencies (wandb, mlflow,
+matplotlib, ...) in the functions that need them, so that a run failing on its arguments,
+or a caller only building the inference pipeline, does not pay for them. The
+--profile_startup flag of a step reports how long loading its script takes, and how long the
+deferred imports take when the step actually runs, broken down by package
+"""
+import argparse
+import collections
+import logging
+import os
+import subprocess
+import sys
+
+logger = logging.getLogger(__name__)
+
+# Written to stderr between the import of the script and the deferred imports
+_PHASE_MARKER = "profile_startup: deferred"
+# Written to stderr, followed by the module and the error, when a deferred import fails
+_FAILED_MARKER = "profile_startup: failed"
+
+# Each deferred import is attempted on its own, so that a missing package is reported
+# and the others are still measured
+_DEFERRED_IMPORT = """
+for name in {deferred!r}:
+    try:
+        __import__(name)
+    except Exception as e:
+        sys.stderr.write(f"{marker} {{name}}: {{type(e).__name__}}: {{e}}\\n")
+"""
+
+
+def import_times(script, deferred=()):
+    """
+    Import a script in a fresh interpreter with -X importtime. The deferred imports that fail
+    are logged and left out of the result
+
+    :param script: path of the script of the step
+    :param deferred: modules imported by the step only when it runs
+    :return: tuple (script, deferred) of dictionaries mapping each top-level package to the
+             seconds spent importing it, in each phase
+    :raises RuntimeError: if the script itself cannot be imported
+    """
+    script_dir, filename = os.path.split(os.path.abspath(script))
+    module = os.path.splitext(filename)[0]
+    code = "\n".join([
+        f"import {module}",
+        f"import sys; sys.stderr.write({_PHASE_MARKER!r} + '\\n')",
+        _DEFERRED_IMPORT.format(deferred=list(deferred), marker=_FAILED_MARKER),
+    ])
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=script_dir,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    if completed.returncode != 0:
+        # The traceback, without the timings of the modules imported before the failure
+        error = "\n".join(
+            line for line in completed.stderr.splitlines() if not line.startswith("import time:")
+        )
+        logger.error(f"Importing {filename} failed:\n{error}")
+        raise RuntimeError(f"Could not import {script} (exit code {completed.returncode})")
+
+    phases = (collections.Counter(), collections.Counter())
+    phase = 0
+    # -X importtime lists the modules imported by a module before the module itself
+    pending = collections.Counter()
+    failed = set()
+    for line in completed.stderr.splitlines():
+        if line.startswith(_PHASE_MARKER):
+            phase = 1
+            continue
+        if line.startswith(_FAILED_MARKER):
+            failure = line[len(_FAILED_MARKER):].strip()
+            logger.error(f"Could not import the deferred module {failure}")
+            failed.add(failure.split(":")[0].split(".")[0])
+            continue
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        if not cumulative_us.strip().isdigit():
+            continue
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        package = name.strip().split(".")[0]
+
+        if phase == 1:
+            # The deferred imports are listed at the top level, their dependencies nested
+            if depth == 0:
+                phases[1][package] += int(cumulative_us) / 1e6
+        elif depth == 1:
+            # Imported by the script (or by the startup of the interpreter, like site)
+            pending[package] += int(cumulative_us) / 1e6
+        elif depth == 0:
+            if name.strip() == module:
+                phases[0].update(pending)
+                phases[0][module] += int(self_us) / 1e6
+            pending.clear()
+
+    for package in failed:
+        phases[1].pop(package, None)
+    return tuple(dict(counter.most_common()) for counter in phases)
+
+
+def report_import_times(script, deferred=(), top=15):
+    """
+    Log the import-time breakdown of a script (see import_times)
+
+    :param script: path of the script of the step
+    :param deferred: modules imported by the step only when it runs
+    :param top: number of packages listed in each phase
+    """
+    phases = import_times(script, deferred)
+    for title, times in zip(["Loading " + os.path.basename(script), "Deferred imports"], phases):
+        logger.info(f"{title}: {sum(times.values()):.3f} s")
+        for package, seconds in list(times.items())[:top]:
+            logger.info(f"  {package:<30} {seconds:8.3f} s")
+
+
+class ProfileStartupAction(argparse.Action):
+    """
+    Like --version: report the import times of the running script, then exit without
+    requiring the other arguments
+    """
+
+    def __init__(self, option_strings, dest, deferred=(), **kwargs):
+        super().__init__(option_strings, dest, nargs=0, default=argparse.SUPPRESS, **kwargs)
+        self.deferred = deferred
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        report_import_times(sys.argv[0], self.deferred)
+        parser.exit()
+
+
+def add_profile_startup_argument(parser, deferred=()):
+    """
+    Add the --profile_startup (or --profile-startup) flag to the parser of a step
+
+    :param parser: the argparse parser of the step
+    :param deferred: modules imported by the step only when it runs
+    """
+    parser.add_argument(
+        "--profile_startup",
+        "--profile-startup",
+        action=ProfileStartupAction,
+        deferred=list(deferred),
+        help="Report the time spent importing the modules of the step, then exit",
+    )
@@ -1,10 +1,16 @@
+import functools
+import glob
 import json
-import mlflow
 import tempfile
 import os
-import wandb
 import hydra
-from omegaconf import DictConfig
+from omegaconf import DictConfig, OmegaConf
+
+from pipeline.inprocess import InProcessRunner
+from pipeline.scheduler import Step, run_dag
+from pipeline.step_cache import StepCache
+from pipeline.worker import WorkerClient
+from wandb_utils.artifact_store import MIRROR_ENV, STORE_DIR_ENV, STORE_ENV, open_store
 
 _steps = [
     "download",
@@ -12,12 +18,67 @@ _steps = [
     "data_check",
     "data_split",
     "train_random_forest",
+    # NOTE: the gradient boosting model is an alternative to the random forest, run it
+    # explicitly to compare the two
+    # "train_gbm",
     # NOTE: We do not include this in the steps so it is not run by mistake.
     # You first need to promote a model export to "prod" before you can run this,
     # then you need to run this step explicitly
     # "test_regression_model"
 ]
 
+# Ways of executing the steps that are part of this repository
+_execution_modes = ["mlflow", "inprocess", "worker"]
+
+
+def _run_step(runner, cache, step, uri, parameters, inputs=(), outputs=(), version=None, sources=()):
+    """
+    Run a step either with mlflow.run (each step in its own conda environment) or, if a
+    runner is provided and the step is a local directory, in this interpreter or in the
+    worker daemon.
+
+    If a step cache is provided, the step is skipped when it already ran with the same
+    parameters, source code and input artifacts (listed in inputs). The artifacts the step
+    produces must be listed in outputs, so that they can be cached. Source files used by the
+    step from outside its directory must be listed in sources.
+    """
+    key = None
+    if cache is not None:
+        key = cache.key(uri, parameters, inputs, sources)
+        if cache.lookup(step, key):
+            return
+
+    if runner is not None and os.path.isdir(uri):
+        runner.run(uri, parameters)
+    else:
+        # Imported only when a step is handed to mlflow, starting the pipeline does not need it
+        import mlflow
+
+        mlflow.run(uri, "main", version=version, env_manager="conda", parameters=parameters)
+
+    if os.environ[STORE_ENV] == "local" and not os.path.isdir(uri):
+        # Steps from other repositories only publish to W&B
+        store = open_store(project=os.environ["WANDB_PROJECT"])
+        for name in outputs:
+            store.pull(f"{name}:latest")
+
+    if cache is not None:
+        cache.store(step, key, outputs)
+
+
+def _make_step(runner, cache, step, uri, parameters, inputs=(), outputs=(), version=None, sources=()):
+    """
+    Declare a step of the DAG, with the artifacts it reads and writes. See _run_step for
+    the meaning of the parameters
+    """
+    # Steps running in-process change the working directory, so local paths must be absolute
+    if os.path.isdir(uri):
+        uri = os.path.abspath(uri)
+    sources = [os.path.abspath(source) for source in sources]
+    run = functools.partial(_run_step, runner, cache, step, uri, parameters, inputs, outputs, version, sources)
+    return Step(step, run, inputs=inputs, outputs=outputs)
+
+
 @hydra.main(config_path=".", config_name="config", version_base=None)
 def go(config: DictConfig):
     # Ensure Hydra doesn't change the working directory
@@ -25,32 +86,69 @@ def go(config: DictConfig):
     # Setup the wandb experiment. All runs will be grouped under this name
     os.environ["WANDB_PROJECT"] = config["main"]["project_name"]
     os.environ["WANDB_RUN_GROUP"] = config["main"]["experiment_name"]
+    # Where the steps read and write their artifacts (the steps run with mlflow.run inherit
+    # the environment)
+    os.environ[STORE_ENV] = config["main"]["artifact_store"]["backend"]
+    os.environ[STORE_DIR_ENV] = os.path.expanduser(config["main"]["artifact_store"]["dir"])
+    os.environ[MIRROR_ENV] = str(config["main"]["artifact_store"]["mirror"]).lower()
 
     # Steps to execute
     steps_par = config['main']['steps']
     active_steps = steps_par.split(",") if steps_par != "all" else _steps
 
+    execution_mode = config["main"]["execution_mode"]
+    if execution_mode not in _execution_modes:
+        raise ValueError(f"Unknown execution_mode {execution_mode}, expected one of {_execution_modes}")
+    runner = None
+    if execution_mode == "inprocess":
+        runner = InProcessRunner()
+    elif execution_mode == "worker":
+        runner = WorkerClient(
+            config["main"]["worker"]["socket"],
+            preload=config["main"]["worker"]["preload"],
+            max_jobs=config["main"]["worker"]["max_jobs"],
+            max_memory_mb=config["main"]["worker"]["max_memory_mb"],
+        )
+
+    cache = None
+    if config["main"]["step_cache"]["enabled"]:
+        cache = StepCache(
+            config["main"]["step_cache"]["dir"],
+            config["main"]["step_cache"]["max_size_mb"],
+            config["main"]["project_name"],
+        )
+
+    # Steps are declared here, in pipeline order, and run as a DAG below: steps whose
+    # inputs are available run concurrently, up to max_workers at the same time
+    steps = []
+
     # Move to a temporary directory
     with tempfile.TemporaryDirectory() as tmp_dir:
         if "download" in active_steps:
-            _ = mlflow.run(
-                f"{config['main']['components_repository']}/get_data",
-                "main",
-                version='main',
-                env_manager="conda",
+            get_data_dir = os.path.join(os.path.dirname(__file__), "components", "get_data")
+            steps.append(_make_step(
+                runner,
+                cache,
+                "download",
+                get_data_dir,
                 parameters={
                     "sample": config["etl"]["sample"],
                     "artifact_name": "sample.csv",
                     "artifact_type": "raw_data",
-                    "artifact_description": "Raw file as downloaded"
+                    "artifact_description": "Raw file as downloaded",
+                    "max_workers": config["etl"]["max_workers"],
                 },
-            )
+                outputs=["sample.csv"],
+                # The samples are part of the step, a new or changed sample must run it again
+                sources=sorted(glob.glob(os.path.join(get_data_dir, "data", "*"))),
+            ))
 
         if "basic_cleaning" in active_steps:
-            _ = mlflow.run(
+            steps.append(_make_step(
+                runner,
+                cache,
+                "basic_cleaning",
                 os.path.join("src", "basic_cleaning"),
-                "main",
-                env_manager="conda",
                 parameters={
                     "input_artifact": "sample.csv:latest",
                     "output_artifact": "clean_sample.csv",
@@ -58,44 +156,64 @@ def go(config: DictConfig):
                     "output_description": "Cleaned data ready for analysis",
                     "min_price": config["etl"]["min_price"],
                     "max_price": config["etl"]["max_price"],
+                    "artifact_format": config["main"]["artifact_format"],
+                    "chunksize": config["etl"]["chunksize"],
                 },
-            )
+                inputs=["sample.csv:latest"],
+                outputs=["clean_sample.csv"],
+            ))
 
         if "data_check" in active_steps:
-            _ = mlflow.run(
+            steps.append(_make_step(
+                runner,
+                cache,
+                "data_check",
                 os.path.join("src", "data_check"),
-                "main",
-                env_manager="conda",
                 parameters={
                     "csv": "clean_sample.csv:latest",
                     "ref": "clean_sample.csv:reference",
                     "kl_threshold": config["data_check"]["kl_threshold"],
                     "min_price": config["etl"]["min_price"],
-                    "max_price": config["etl"]["max_price"]
+                    "max_price": config["etl"]["max_price"],
+                    "profile_cache_dir": config["data_check"]["profile_cache_dir"],
+                    "chunksize": config["etl"]["chunksize"],
                 },
-            )
+                inputs=["clean_sample.csv:latest", "clean_sample.csv:reference"],
+            ))
 
         if "data_split" in active_steps:
-            _ = mlflow.run(
+            steps.append(_make_step(
+                runner,
+                cache,
+                "data_split",
                 os.path.join(os.path.dirname(__file__), "train_val_test_split"),
-                "main",
-                env_manager="conda",
                 parameters={
                     "input_artifact": "clean_sample.csv:latest",
                     "test_size": config["modeling"]["test_size"],
                     "random_seed": config["modeling"]["random_seed"],
-                    "stratify_by": config["modeling"]["stratify_by"]
+                    "stratify_by": config["modeling"]["stratify_by"],
+                    "artifact_format": config["main"]["artifact_format"],
                 },
-            )
+                inputs=["clean_sample.csv:latest"],
+                outputs=["trainval_data", "test_data"],
+            ))
 
         if "train_random_forest" in active_steps:
             rf_config = os.path.abspath("rf_config.json")
             with open(rf_config, "w+") as fp:
                 json.dump(dict(config["modeling"]["random_forest"].items()), fp)
-            _ = mlflow.run(
+
+            sweep_config = "none"
+            if config["modeling"]["sweep"]["enabled"]:
+                sweep_config = os.path.abspath("sweep_config.json")
+                with open(sweep_config, "w+") as fp:
+                    json.dump(OmegaConf.to_container(config["modeling"]["sweep"]), fp)
+
+            steps.append(_make_step(
+                runner,
+                cache,
+                "train_random_forest",
                 os.path.join("src", "train_random_forest"),
-                "main",
-                env_manager="conda",
                 parameters={
                     "trainval_artifact": "trainval_data:latest",
                     "val_size": config["modeling"]["val_size"],
@@ -103,21 +221,67 @@ def go(config: DictConfig):
                     "stratify_by": config["modeling"]["stratify_by"],
                     "rf_config": rf_config,
                     "max_tfidf_features": config["modeling"]["max_tfidf_features"],
+                    "landmarks": json.dumps(OmegaConf.to_container(config["modeling"]["landmarks"])),
+                    "feature_format": config["modeling"]["feature_format"],
+                    "sweep_config": sweep_config,
+                    "feature_cache_dir": (
+                        config["modeling"]["feature_cache"]["dir"] if config["modeling"]["feature_cache"]["enabled"]
+                        else "none"
+                    ),
+                    "feature_cache_max_size_mb": config["modeling"]["feature_cache"]["max_size_mb"],
+                    "export_format": config["modeling"]["export"]["format"],
+                    "top_k_trees": config["modeling"]["export"]["top_k_trees"],
                     "output_artifact": config["modeling"]["output_artifact"],
                 },
-            )
+                inputs=["trainval_data:latest"],
+                outputs=[config["modeling"]["output_artifact"]],
+            ))
+
+        if "train_gbm" in active_steps:
+            gbm_config = os.path.abspath("gbm_config.json")
+            with open(gbm_config, "w+") as fp:
+                json.dump(OmegaConf.to_container(config["modeling"]["gbm"]), fp)
+            steps.append(_make_step(
+                runner,
+                cache,
+                "train_gbm",
+                os.path.join("src", "train_gbm"),
+                parameters={
+                    "trainval_artifact": "trainval_data:latest",
+                    "val_size": config["modeling"]["val_size"],
+                    "random_seed": config["modeling"]["random_seed"],
+                    "stratify_by": config["modeling"]["stratify_by"],
+                    "gbm_config": gbm_config,
+                    "max_tfidf_features": config["modeling"]["max_tfidf_features"],
+                    "landmarks": json.dumps(OmegaConf.to_container(config["modeling"]["landmarks"])),
+                    "output_artifact": config["modeling"]["gbm_output_artifact"],
+                },
+                inputs=["trainval_data:latest"],
+                outputs=[config["modeling"]["gbm_output_artifact"]],
+                sources=[os.path.join("src", "train_random_forest", "feature_engineering.py")],
+            ))
 
         if "test_regression_model" in active_steps:
-            _ = mlflow.run(
+            steps.append(_make_step(
+                runner,
+                cache,
+                "test_regression_model",
                 os.path.join("src", "test_regression_model"),
-                "main",
-                env_manager="conda",
                 parameters={
-                    "model_export": "random_forest_export:prod",
+                    "model_export": f"{config['modeling']['production_model']}:prod",
                     "test_artifact": "test_data:latest",
-                    "output_artifact": "test_results"
-            },
-        )
+                    "output_artifact": "test_results",
+                    "chunksize": config["modeling"]["batch_inference"]["chunksize"],
+                    "n_workers": config["modeling"]["batch_inference"]["n_workers"],
+                },
+                inputs=[f"{config['modeling']['production_model']}:prod", "test_data:latest"],
+                outputs=["test_results"],
+            ))
+
+        run_dag(steps, config["main"]["max_workers"])
+
+    if cache is not None:
+        cache.log_report()
 
 
 if __name__ == "__main__":
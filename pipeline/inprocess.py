@@ -0,0 +1,101 @@
+"""
+Run the local pipeline steps inside the current interpreter instead of going through
+mlflow.run, so that a full run pays the import and environment cost only once
+"""
+import argparse
+import contextlib
+import importlib.util
+import logging
+import os
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Step modules already imported, keyed by the absolute path of the step directory
+_loaded_steps = {}
+
+# The W&B run is global to the interpreter: every wandb.init/finish made in this process (the
+# steps run in-process, the restores of the step cache) must hold this lock
+wandb_run_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def step_context(step_dir):
+    """
+    Mimic the environment that mlflow.run gives to a step: the working directory is the
+    step directory, and the step directory is importable (for sibling modules such as
+    feature_engineering.py)
+
+    :param step_dir: directory containing the run.py of the step
+    """
+    cwd = os.getcwd()
+    os.chdir(step_dir)
+    sys.path.insert(0, step_dir)
+    try:
+        yield
+    finally:
+        sys.path.remove(step_dir)
+        os.chdir(cwd)
+
+
+def load_step(step_dir):
+    """
+    Import the run.py module of a step. All the steps call their entry point run.py, so
+    each one is imported under a name derived from its directory to avoid clashes
+
+    :param step_dir: directory containing the run.py of the step
+    :return: the imported module
+    """
+    step_dir = os.path.abspath(step_dir)
+    if step_dir not in _loaded_steps:
+        module_name = f"_step_{os.path.basename(step_dir)}"
+        spec = importlib.util.spec_from_file_location(module_name, os.path.join(step_dir, "run.py"))
+        module = importlib.util.module_from_spec(spec)
+        with step_context(step_dir):
+            spec.loader.exec_module(module)
+        _loaded_steps[step_dir] = module
+
+    return _loaded_steps[step_dir]
+
+
+class InProcessRunner:
+    """
+    Calls the go(args) function of each step directly. The DataFrames produced by a step
+    are kept in memory and handed to the following steps, so they do not need to
+    download and parse again what the previous step has just written
+    """
+
+    def __init__(self):
+        # Maps an artifact reference (like "clean_sample.csv:latest") to its DataFrame
+        self.frames = {}
+        # The working directory and the W&B run are global to the interpreter, so only
+        # one step at a time can run in-process
+        self._lock = wandb_run_lock
+
+    def run(self, step_dir, parameters):
+        """
+        Run one step
+
+        :param step_dir: directory containing the run.py of the step
+        :param parameters: the same parameters that would be passed to mlflow.run
+        """
+        import wandb
+
+        args = argparse.Namespace(**parameters)
+
+        with self._lock:
+            module = load_step(step_dir)
+            logger.info(f"Running {step_dir} in-process")
+            with step_context(os.path.abspath(step_dir)):
+                try:
+                    outputs = module.go(args, frames=self.frames)
+                finally:
+                    # Not all the steps finish their run, and a run left open would be
+                    # resumed by the wandb.init of the next step
+                    wandb.finish()
+
+        # Only the latest version of an artifact is ever produced by the pipeline, other
+        # aliases (like "reference" or "prod") still need to be fetched from W&B
+        for artifact_name, df in (outputs or {}).items():
+            self.frames[f"{artifact_name}:latest"] = df
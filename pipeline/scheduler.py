@@ -0,0 +1,94 @@
+"""
+Run the pipeline steps as a DAG: a step starts as soon as the steps producing its inputs
+are done, so independent steps can run concurrently
+"""
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+logger = logging.getLogger(__name__)
+
+
+class Step:
+    """
+    A step of the pipeline, with the artifacts it reads and writes
+
+    :param name: name of the step
+    :param run: callable executing the step
+    :param inputs: artifact references read by the step, like "clean_sample.csv:latest"
+    :param outputs: names of the artifacts written by the step, like "clean_sample.csv"
+    """
+
+    def __init__(self, name, run, inputs=(), outputs=()):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+
+    def reads_latest(self, artifact_name):
+        return f"{artifact_name}:latest" in self.inputs
+
+
+def dependencies(steps):
+    """
+    Compute the dependencies between the steps, given in pipeline order. A step depends on
+    a previous step if it reads the latest version of an artifact the previous step writes
+    (or writes an artifact the previous step reads). Inputs with other aliases, like
+    "reference" or "prod", are not produced by the pipeline and do not create dependencies.
+
+    :param steps: list of Step instances
+    :return: dictionary mapping each step name to the set of names of the steps it needs
+    """
+    deps = {step.name: set() for step in steps}
+    for i, step in enumerate(steps):
+        for previous in steps[:i]:
+            if any(step.reads_latest(output) for output in previous.outputs) or \
+                    any(previous.reads_latest(output) for output in step.outputs):
+                deps[step.name].add(previous.name)
+    return deps
+
+
+def run_dag(steps, max_workers):
+    """
+    Run the steps, up to max_workers at the same time. If a step fails no new step is
+    started, the running ones are waited for and the exception is re-raised
+
+    :param steps: list of Step instances, in pipeline order
+    :param max_workers: maximum number of steps running concurrently
+    """
+    deps = dependencies(steps)
+    pending = list(steps)
+    done = set()
+    running = {}
+    start_times = {}
+    failure = None
+    pipeline_start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if failure is None:
+                for step in [s for s in pending if deps[s.name] <= done]:
+                    if len(running) >= max_workers:
+                        break
+                    logger.info(f"Starting step {step.name}")
+                    pending.remove(step)
+                    start_times[step.name] = time.perf_counter()
+                    running[executor.submit(step.run)] = step
+            elif not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                elapsed = time.perf_counter() - start_times[step.name]
+                if future.exception() is not None:
+                    logger.error(f"Step {step.name} failed after {elapsed:.1f}s")
+                    failure = failure or future.exception()
+                else:
+                    logger.info(f"Step {step.name} done in {elapsed:.1f}s")
+                    done.add(step.name)
+
+    if failure is not None:
+        raise failure
+
+    logger.info(f"Pipeline done in {time.perf_counter() - pipeline_start:.1f}s")
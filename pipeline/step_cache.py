@@ -0,0 +1,229 @@
+"""
+Local cache of pipeline steps. A step is identified by a hash of its parameters, of the
+digests of its input artifacts and of its source code: if nothing changed since a previous
+run, the step is skipped and the output artifacts of that run are reused instead
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+from pipeline.inprocess import wandb_run_lock
+from wandb_utils.artifact_store import open_store
+
+logger = logging.getLogger(__name__)
+
+# Files that make up the source code of a step (outputs written by the steps in their own
+# directory, like clean_sample/ or random_forest_dir/, must not be part of the hash)
+_source_patterns = ["*.py", "MLproject", "conda.yml"]
+
+# Package shared by all the local steps (artifact store, datasets, publisher, ...): a change
+# to it can change the outputs of any of them
+_SHARED_SOURCES_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "components", "wandb_utils"
+)
+
+
+class StepCache:
+    """
+    Content-addressed cache of the step outputs, with size-based LRU eviction.
+
+    Each entry is a directory named after the step key, containing a manifest.json and a
+    copy of the files of every output artifact of the step.
+    """
+
+    def __init__(self, cache_dir, max_size_mb, project):
+        """
+        :param cache_dir: directory where the entries are stored
+        :param max_size_mb: the least recently used entries are evicted above this size
+        :param project: W&B project where the artifacts live
+        """
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size = max_size_mb * 1024 * 1024
+        self.project = project
+        self.report = {}
+        self._store = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @property
+    def artifact_store(self):
+        if self._store is None:
+            self._store = open_store(project=self.project)
+        return self._store
+
+    def _artifact(self, reference):
+        return self.artifact_store.artifact(reference)
+
+    def key(self, uri, parameters, inputs, sources=()):
+        """
+        Compute the key of a step, or None if the step cannot be cached
+
+        :param uri: directory of the step
+        :param parameters: parameters of the step. Parameters pointing to an existing file
+                           (like the rf_config) are hashed by content
+        :param inputs: artifact references (like "sample.csv:latest") read by the step
+        :param sources: source files used by the step from outside its directory
+        :return: hex digest identifying this execution of the step
+        """
+        # Remote steps (from another repository) can change under the same version, so
+        # there is no way to tell whether they changed
+        if not os.path.isdir(uri):
+            return None
+
+        h = hashlib.sha256()
+        for pattern in _source_patterns:
+            for path in sorted(glob.glob(os.path.join(uri, pattern))):
+                h.update(os.path.basename(path).encode())
+                h.update(_file_digest(path).encode())
+
+        for path in sources:
+            h.update(os.path.basename(path).encode())
+            h.update(_file_digest(path).encode())
+
+        for path in sorted(glob.glob(os.path.join(_SHARED_SOURCES_DIR, "*.py"))):
+            h.update(f"wandb_utils/{os.path.basename(path)}".encode())
+            h.update(_file_digest(path).encode())
+
+        for name, value in sorted(parameters.items()):
+            if isinstance(value, str) and os.path.isfile(value):
+                value = _file_digest(value)
+            h.update(json.dumps([name, value], default=str).encode())
+
+        for reference in sorted(inputs):
+            try:
+                digest = self._artifact(reference).digest
+            except Exception as e:
+                logger.warning(f"Cannot resolve input {reference} ({e}), not using the cache")
+                return None
+            h.update(json.dumps([reference, digest]).encode())
+
+        return h.hexdigest()
+
+    def lookup(self, step, key):
+        """
+        Look for a previous execution of the step and, if found, make its outputs the
+        latest version of each output artifact again
+
+        :param step: name of the step (used for reporting only)
+        :param key: key returned by the key method
+        :return: True on a cache hit, False otherwise
+        """
+        manifest_path = os.path.join(self.cache_dir, key or "", "manifest.json")
+        if key is None or not os.path.exists(manifest_path):
+            self.report[step] = "miss"
+            logger.info(f"Step cache miss for {step}")
+            return False
+
+        with open(manifest_path) as fp:
+            manifest = json.load(fp)
+
+        self._restore(key, manifest)
+
+        manifest["last_used"] = time.time()
+        with open(manifest_path, "w") as fp:
+            json.dump(manifest, fp)
+
+        self.report[step] = "hit"
+        logger.info(f"Step cache hit for {step}, reusing the outputs of a previous run")
+        return True
+
+    def _restore(self, key, manifest):
+        # The artifact stores deduplicate artifacts by content: logging again the same files
+        # does not create a new version, it just moves the "latest" alias back to the cached one
+        stale = [
+            (name, output) for name, output in manifest["outputs"].items()
+            if self._artifact(f"{name}:latest").digest != output["digest"]
+        ]
+        if len(stale) == 0:
+            return
+
+        import wandb
+
+        # Steps can run concurrently, and the ones running in-process share the W&B run of
+        # this interpreter with the restores
+        with wandb_run_lock:
+            run = wandb.init(job_type="step_cache_restore")
+            store = open_store(run, self.project)
+            for name, output in stale:
+                logger.info(f"Restoring {name} from the step cache")
+                store.log_artifact(
+                    name,
+                    output["type"],
+                    output["description"],
+                    [os.path.join(self.cache_dir, key, "files", name)],
+                    wait=True,
+                )
+            run.finish()
+
+    def store(self, step, key, outputs):
+        """
+        Save the outputs that the step has just produced
+
+        :param step: name of the step
+        :param key: key returned by the key method
+        :param outputs: names of the artifacts produced by the step
+        """
+        if key is None:
+            return
+
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = f"{entry_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        manifest = {"step": step, "outputs": {}, "last_used": time.time()}
+        for name in outputs:
+            artifact = self._artifact(f"{name}:latest")
+            artifact.download(root=os.path.join(tmp_dir, "files", name))
+            manifest["outputs"][name] = {
+                "digest": artifact.digest,
+                "type": artifact.type,
+                "description": artifact.description,
+            }
+
+        os.makedirs(tmp_dir, exist_ok=True)
+        with open(os.path.join(tmp_dir, "manifest.json"), "w") as fp:
+            json.dump(manifest, fp)
+
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.rename(tmp_dir, entry_dir)
+
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for manifest_path in glob.glob(os.path.join(self.cache_dir, "*", "manifest.json")):
+            entry_dir = os.path.dirname(manifest_path)
+            with open(manifest_path) as fp:
+                last_used = json.load(fp)["last_used"]
+            entries.append((last_used, _dir_size(entry_dir), entry_dir))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            logger.info(f"Evicting {os.path.basename(entry_dir)} from the step cache")
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+
+    def log_report(self):
+        for step, outcome in self.report.items():
+            logger.info(f"Step cache {outcome}: {step}")
+        hits = sum(outcome == "hit" for outcome in self.report.values())
+        logger.info(f"Step cache: {hits} hits, {len(self.report) - hits} misses")
+
+
+def _file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files
+    )
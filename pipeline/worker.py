@@ -0,0 +1,339 @@
+"""
+Warm worker daemon for the local pipeline steps. The daemon imports the heavy dependencies of
+the steps (pandas, scikit-learn, mlflow, wandb, ...) once, then listens on a Unix socket. Each
+step submitted by main.py runs in a child forked from the daemon: it starts with everything
+already imported, but in its own process, so the runs are isolated from each other and from
+the daemon. The daemon replaces itself with a fresh process after a number of jobs, or when
+its memory grows above a threshold.
+
+Start it with ``python -m pipeline.worker`` (main.py starts it when needed) and stop it with
+``python -m pipeline.worker --stop``
+"""
+import argparse
+import importlib
+import json
+import logging
+import os
+import resource
+import selectors
+import socket
+import subprocess
+import sys
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+# Marks the line carrying the outcome of a job, after the output of the step
+_STATUS_PREFIX = b"\x00worker-status "
+
+# Modules imported by the daemon before serving, so that the steps do not import them again
+DEFAULT_PRELOAD = [
+    "numpy",
+    "pandas",
+    "scipy.stats",
+    "sklearn.ensemble",
+    "sklearn.pipeline",
+    "sklearn.feature_extraction.text",
+    "matplotlib.pyplot",
+    "mlflow.sklearn",
+    "wandb",
+    "pytest",
+]
+
+_PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _rss_mb():
+    # Current resident memory of this process, from /proc when available (Linux), else the peak
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run_job(request):
+    """
+    Body of a forked child: run one step with the environment of the client. Never returns
+    """
+    returncode = 0
+    try:
+        os.environ.clear()
+        os.environ.update(request["env"])
+
+        # Imported here, so that the daemon itself does not hold any step state
+        import wandb
+        from pipeline.inprocess import load_step, step_context
+
+        step_dir = request["step_dir"]
+        module = load_step(step_dir)
+        with step_context(step_dir):
+            try:
+                module.go(argparse.Namespace(**request["parameters"]))
+            finally:
+                wandb.finish()
+    except BaseException:
+        traceback.print_exc()
+        returncode = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(returncode)
+
+
+class WorkerDaemon:
+    """
+    Accepts jobs on a Unix socket and runs each one in a forked child. Everything happens in
+    a single thread, so that forking is safe
+
+    :param listener: listening Unix socket
+    :param max_jobs: number of jobs after which the daemon is replaced by a fresh one
+    :param max_memory_mb: the daemon is replaced when its memory grows above this
+    :param argv: command line to start the fresh daemon with
+    """
+
+    def __init__(self, listener, max_jobs, max_memory_mb, argv):
+        self.listener = listener
+        self.max_jobs = max_jobs
+        self.max_memory_mb = max_memory_mb
+        self.argv = argv
+        self.n_jobs = 0
+        # pid -> (connection, start time) of the running jobs
+        self.children = {}
+        self.stopping = False
+
+    def serve(self):
+        selector = selectors.DefaultSelector()
+        selector.register(self.listener, selectors.EVENT_READ)
+        while not (self.stopping or self.should_recycle()) or self.children:
+            accepting = not (self.stopping or self.should_recycle())
+            for _ in selector.select(timeout=0.2) if accepting else []:
+                connection, _ = self.listener.accept()
+                self.handle(connection)
+            if not accepting:
+                time.sleep(0.2)
+            self.reap()
+
+        selector.close()
+        if not self.stopping:
+            self.recycle()
+
+    def should_recycle(self):
+        return self.n_jobs >= self.max_jobs or _rss_mb() > self.max_memory_mb
+
+    def handle(self, connection):
+        with connection.makefile("rb") as fp:
+            request = json.loads(fp.readline())
+
+        if request["command"] == "stop":
+            logger.info("Stopping")
+            self.stopping = True
+            connection.close()
+            return
+
+        self.n_jobs += 1
+        logger.info(f"Job {self.n_jobs}: {request['step_dir']}")
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            # The output of the step goes straight to the client
+            self.listener.close()
+            os.dup2(connection.fileno(), sys.stdout.fileno())
+            os.dup2(connection.fileno(), sys.stderr.fileno())
+            connection.close()
+            _run_job(request)
+        self.children[pid] = (connection, time.perf_counter())
+
+    def reap(self):
+        for pid in list(self.children):
+            finished_pid, status, usage = os.wait4(pid, os.WNOHANG)
+            if finished_pid == 0:
+                continue
+            connection, start = self.children.pop(pid)
+            outcome = {
+                "returncode": os.waitstatus_to_exitcode(status),
+                "duration_s": time.perf_counter() - start,
+                "max_rss_mb": usage.ru_maxrss / 1024,
+            }
+            logger.info(f"Job of pid {pid} done: {outcome}")
+            try:
+                connection.sendall(b"\n" + _STATUS_PREFIX + json.dumps(outcome).encode() + b"\n")
+            except OSError:
+                # The client went away
+                pass
+            connection.close()
+
+    def recycle(self):
+        logger.info(f"Recycling after {self.n_jobs} jobs, memory {_rss_mb():.0f} MB")
+        # The fresh daemon inherits the listening socket, so no client is refused meanwhile
+        os.set_inheritable(self.listener.fileno(), True)
+        argv = [arg for arg in self.argv if not arg.startswith("--fd=")]
+        os.execv(sys.executable, [sys.executable, "-m", "pipeline.worker"] + argv + [f"--fd={self.listener.fileno()}"])
+
+
+class WorkerClient:
+    """
+    Runs the steps in the worker daemon, starting it if it is not running. Same interface as
+    InProcessRunner
+
+    :param socket_path: path of the Unix socket of the daemon
+    :param preload: modules imported by the daemon
+    :param max_jobs: see WorkerDaemon
+    :param max_memory_mb: see WorkerDaemon
+    :param start_timeout: seconds to wait for a new daemon to be ready
+    """
+
+    def __init__(self, socket_path, preload=DEFAULT_PRELOAD, max_jobs=50, max_memory_mb=4096, start_timeout=120):
+        self.socket_path = os.path.abspath(os.path.expanduser(socket_path))
+        self.preload = list(preload)
+        self.max_jobs = max_jobs
+        self.max_memory_mb = max_memory_mb
+        self.start_timeout = start_timeout
+
+    def _connect(self):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.socket_path)
+        except OSError:
+            connection.close()
+            raise
+        return connection
+
+    def _start_daemon(self):
+        logger.info(f"Starting the worker daemon on {self.socket_path}")
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        with open(f"{os.path.splitext(self.socket_path)[0]}.log", "ab") as log:
+            subprocess.Popen(
+                [
+                    sys.executable, "-m", "pipeline.worker",
+                    f"--socket={self.socket_path}",
+                    f"--preload={','.join(self.preload)}",
+                    f"--max_jobs={self.max_jobs}",
+                    f"--max_memory_mb={self.max_memory_mb}",
+                ],
+                cwd=_PROJECT_DIR,
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=log,
+                start_new_session=True,
+            )
+
+        deadline = time.monotonic() + self.start_timeout
+        while True:
+            try:
+                return self._connect()
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"The worker daemon did not start, see its log next to {self.socket_path}")
+                time.sleep(0.2)
+
+    def connect(self):
+        """
+        :return: a connection to the daemon, started if needed
+        """
+        try:
+            return self._connect()
+        except OSError:
+            return self._start_daemon()
+
+    def run(self, step_dir, parameters):
+        """
+        Run one step in a child of the daemon, streaming its output
+
+        :param step_dir: directory containing the run.py of the step
+        :param parameters: the same parameters that would be passed to mlflow.run
+        """
+        request = {
+            "command": "run",
+            "step_dir": os.path.abspath(step_dir),
+            "parameters": parameters,
+            "env": dict(os.environ),
+        }
+        start = time.perf_counter()
+        with self.connect() as connection:
+            connection.sendall(json.dumps(request).encode() + b"\n")
+            outcome = None
+            with connection.makefile("rb") as fp:
+                for line in fp:
+                    if line.startswith(_STATUS_PREFIX):
+                        outcome = json.loads(line[len(_STATUS_PREFIX):])
+                    else:
+                        sys.stdout.write(line.decode(errors="replace"))
+            sys.stdout.flush()
+
+        if outcome is None:
+            raise RuntimeError(f"The worker daemon stopped while running {step_dir}")
+        logger.info(
+            f"{os.path.basename(step_dir)} ran in the worker in {time.perf_counter() - start:.1f}s "
+            f"(peak memory {outcome['max_rss_mb']:.0f} MB)"
+        )
+        if outcome["returncode"] != 0:
+            raise RuntimeError(f"Step {step_dir} failed in the worker with exit code {outcome['returncode']}")
+
+    def stop(self):
+        """
+        Stop the daemon, once its running jobs are done
+        """
+        try:
+            connection = self._connect()
+        except OSError:
+            return
+        with connection:
+            connection.sendall(json.dumps({"command": "stop"}).encode() + b"\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Warm worker daemon for the pipeline steps")
+    parser.add_argument("--socket", type=str, default="~/.cache/nyc_airbnb/worker.sock",
+                        help="Path of the Unix socket")
+    parser.add_argument("--preload", type=str, default=",".join(DEFAULT_PRELOAD),
+                        help="Comma-separated list of modules to import before serving")
+    parser.add_argument("--max_jobs", type=int, default=50,
+                        help="Number of jobs after which the daemon is replaced by a fresh one")
+    parser.add_argument("--max_memory_mb", type=float, default=4096,
+                        help="The daemon is replaced when its memory grows above this")
+    parser.add_argument("--fd", type=int, default=None,
+                        help="Listening socket inherited from the previous daemon (when recycling)")
+    parser.add_argument("--stop", action="store_true", help="Stop the running daemon")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)-15s worker[%(process)d] %(message)s")
+    socket_path = os.path.abspath(os.path.expanduser(args.socket))
+
+    if args.stop:
+        WorkerClient(socket_path).stop()
+        return
+
+    if args.fd is not None:
+        listener = socket.socket(fileno=args.fd)
+    else:
+        if os.path.exists(socket_path):
+            # Left by a daemon that died
+            os.remove(socket_path)
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(socket_path)
+        listener.listen(64)
+    os.set_inheritable(listener.fileno(), False)
+
+    start = time.perf_counter()
+    for module in filter(None, args.preload.split(",")):
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            logger.warning(f"Cannot preload {module}: {e}")
+    logger.info(f"Preloaded {args.preload} in {time.perf_counter() - start:.1f}s, memory {_rss_mb():.0f} MB")
+
+    sys.path.insert(0, _PROJECT_DIR)
+    daemon = WorkerDaemon(listener, args.max_jobs, args.max_memory_mb, sys.argv[1:])
+    daemon.serve()
+
+    if daemon.stopping:
+        listener.close()
+        os.remove(socket_path)
+
+
+if __name__ == "__main__":
+    main()
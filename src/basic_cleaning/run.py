@@ -1,13 +1,56 @@
 import argparse
 import logging
-import pandas as pd
-import wandb
 import os
 
+from wandb_utils.artifact_store import open_store
+from wandb_utils.datasets import (
+    DatasetWriter, artifact_path, common_dtypes, dataset_filename, iter_dataset, read_dataset, write_dataset
+)
+from wandb_utils.publisher import ArtifactPublisher
+from wandb_utils.startup import add_profile_startup_argument
+
 logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
 logger = logging.getLogger()
 
-def go(args):
+# Imported by go only, see --profile_startup
+DEFERRED_IMPORTS = ["wandb"]
+
+
+def clean_data(df, min_price, max_price):
+    """
+    Remove the price outliers, the rows with missing values and the listings outside NYC.
+    Every row is filtered independently of the others, so this can be applied to the whole
+    dataset or to each chunk of it with the same result
+    """
+    df = df[df['price'].between(min_price, max_price)]
+    df = df.dropna()
+    idx = df['longitude'].between(-74.25, -73.50) & df['latitude'].between(40.5, 41.2)
+    return df[idx].copy()
+
+
+def clean_in_chunks(input_path, output_path, min_price, max_price, chunksize):
+    """
+    Clean the input file chunksize rows at a time, appending each cleaned chunk to the output
+    file, so that the peak memory does not depend on the size of the dataset. The input is
+    read twice: a first pass finds the type of each column over the whole file, so that every
+    chunk is written exactly as the in-memory cleaning would write it
+    """
+    dtypes = common_dtypes(input_path, chunksize)
+
+    n_input, n_output = 0, 0
+    with DatasetWriter(output_path) as writer:
+        for chunk in iter_dataset(input_path, chunksize, dtype=dtypes):
+            n_input += len(chunk)
+            chunk = clean_data(chunk, min_price, max_price)
+            n_output += len(chunk)
+            writer.write(chunk)
+
+    return n_input, n_output
+
+
+def go(args, frames=None):
+    import wandb
+
     input_artifact = args.input_artifact
     output_artifact = args.output_artifact
     output_type = args.output_type
@@ -17,58 +60,74 @@ def go(args):
 
     logger.info("Initializing W&B run")
     run = wandb.init(project="nyc_airbnb", group="basic_cleaning")
+    store = open_store(run)
 
-    logger.info("Downloading input artifact: %s", input_artifact)
-    try:
-        artifact = run.use_artifact(input_artifact)
-        artifact_path = artifact.file()
-        logger.info("Artifact downloaded to: %s", artifact_path)
-    except Exception as e:
-        logger.error("Failed to download input artifact: %s", str(e))
-        raise
+    os.makedirs(output_type, exist_ok=True)
+    output_path = f"{output_type}/{dataset_filename(output_artifact, args.artifact_format)}"
 
-    logger.info("Reading input data")
-    try:
-        df = pd.read_csv(artifact_path)
-        logger.info("Input data shape: %s", df.shape)
-    except Exception as e:
-        logger.error("Failed to read input data: %s", str(e))
-        raise
+    # When running in-process the previous step may have left the input in memory
+    frames = frames or {}
+    if args.chunksize > 0 and input_artifact not in frames:
+        logger.info("Downloading input artifact: %s", input_artifact)
+        # The raw data can be a single sample or a directory of samples (see get_data)
+        input_path = artifact_path(store.use_artifact(input_artifact))
 
-    logger.info("Cleaning data")
-    try:
-        df = df[df['price'].between(min_price, max_price)]
-        df = df.dropna()
-        logger.info("Cleaned data shape: %s", df.shape)
-    except Exception as e:
-        logger.error("Failed to clean data: %s", str(e))
-        raise
+        logger.info("Cleaning data in chunks of %d rows", args.chunksize)
+        try:
+            n_input, n_output = clean_in_chunks(input_path, output_path, min_price, max_price, args.chunksize)
+            logger.info("Input rows: %d, cleaned rows: %d", n_input, n_output)
+            logger.info("Cleaned data saved to: %s", output_path)
+        except Exception as e:
+            logger.error("Failed to clean data: %s", str(e))
+            raise
+        # The cleaned dataset is not kept in memory
+        df = None
+    elif input_artifact in frames:
+        logger.info("Using in-memory input artifact: %s", input_artifact)
+        store.use_artifact(input_artifact)
+        df = frames[input_artifact]
+    else:
+        logger.info("Downloading input artifact: %s", input_artifact)
+        try:
+            artifact = store.use_artifact(input_artifact)
+            input_path = artifact_path(artifact)
+            logger.info("Artifact downloaded to: %s", input_path)
+        except Exception as e:
+            logger.error("Failed to download input artifact: %s", str(e))
+            raise
 
-    idx = df['longitude'].between(-74.25, -73.50) & df['latitude'].between(40.5, 41.2)
-    df = df[idx].copy()
+        logger.info("Reading input data")
+        try:
+            df = read_dataset(input_path)
+        except Exception as e:
+            logger.error("Failed to read input data: %s", str(e))
+            raise
 
-    logger.info("Saving cleaned data")
-    try:
-        os.makedirs(output_type, exist_ok=True)
-        output_path = f"{output_type}/{output_artifact}"
-        df.to_csv(output_path, index=False)
-        logger.info("Cleaned data saved to: %s", output_path)
-    except Exception as e:
-        logger.error("Failed to save cleaned data: %s", str(e))
-        raise
+    if df is not None:
+        logger.info("Input data shape: %s", df.shape)
 
-    logger.info("Logging artifact to W&B")
+        logger.info("Cleaning data")
+        try:
+            df = clean_data(df, min_price, max_price)
+            logger.info("Cleaned data shape: %s", df.shape)
+        except Exception as e:
+            logger.error("Failed to clean data: %s", str(e))
+            raise
+
+        logger.info("Saving cleaned data")
+        try:
+            write_dataset(df, output_path)
+            logger.info("Cleaned data saved to: %s", output_path)
+        except Exception as e:
+            logger.error("Failed to save cleaned data: %s", str(e))
+            raise
+
+    logger.info("Logging artifact")
     try:
-        artifact = wandb.Artifact(
-            output_artifact,
-            type=output_type,
-            description=output_description
-        )
-        artifact.add_file(output_path)
-        run.log_artifact(artifact)
-        logger.info("Artifact logged successfully: %s", output_artifact)
-        # Wait for the artifact to be uploaded
-        artifact.wait()
+        # The output is the last thing this step computes, so there is nothing to overlap with
+        # the upload: the step waits for it, the publisher only adds the retries
+        with ArtifactPublisher(store) as publisher:
+            publisher.publish(output_artifact, output_type, output_description, [output_path])
         logger.info("Artifact upload completed: %s", output_artifact)
     except Exception as e:
         logger.error("Failed to log or upload artifact: %s", str(e))
@@ -77,6 +136,8 @@ def go(args):
     logger.info("Finishing W&B run")
     run.finish()
 
+    return {output_artifact: df} if df is not None else {}
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Data cleaning step")
     parser.add_argument("--input_artifact", type=str, help="Name and version of the input artifact to clean (e.g., sample.csv:latest)")
@@ -85,5 +146,8 @@ if __name__ == "__main__":
     parser.add_argument("--output_description", type=str, help="Description of the output artifact")
     parser.add_argument("--min_price", type=float, help="Minimum price threshold for filtering data")
     parser.add_argument("--max_price", type=float, help="Maximum price threshold for filtering data")
+    parser.add_argument("--artifact_format", type=str, default="csv", help="Format of the output file (csv or parquet)")
+    parser.add_argument("--chunksize", type=int, default=0, help="Clean the data this many rows at a time to bound the memory usage (0 to load the whole dataset in memory)")
+    add_profile_startup_argument(parser, DEFERRED_IMPORTS)
     args = parser.parse_args()
     go(args)
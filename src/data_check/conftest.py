@@ -1,6 +1,11 @@
 import pytest
 import wandb
-import pandas as pd
+
+from wandb_utils.artifact_store import open_store
+from wandb_utils.datasets import read_dataset
+
+from data_profile import reference_profile
+from expectations import data_check_suite, validate
 
 def pytest_addoption(parser):
     parser.addoption("--csv", action="store", default=None, help="Path to input CSV artifact")
@@ -8,6 +13,23 @@ def pytest_addoption(parser):
     parser.addoption("--kl_threshold", action="store", type=float, default=0.2, help="KL divergence threshold")
     parser.addoption("--min_price", action="store", type=float, default=10.0, help="Minimum price")
     parser.addoption("--max_price", action="store", type=float, default=350.0, help="Maximum price")
+    parser.addoption("--profile_cache_dir", action="store", default="none",
+                     help="Directory of the local cache of the reference profiles, or none")
+
+@pytest.fixture(scope='session')
+def report(request):
+    # Computed by run.py, in a single pass over the data. When the tests are run on their
+    # own, the data and the reference profile are fetched from the artifact store instead
+    report = getattr(request.config, "data_check_report", None)
+    if report is not None:
+        return report
+    suite = data_check_suite(
+        request.getfixturevalue("ref_profile"),
+        request.getfixturevalue("kl_threshold"),
+        request.getfixturevalue("min_price"),
+        request.getfixturevalue("max_price"),
+    )
+    return validate([request.getfixturevalue("data")], suite)
 
 @pytest.fixture(scope='session')
 def data(request):
@@ -15,21 +37,22 @@ def data(request):
     if not csv_arg:
         raise ValueError("Must provide --csv option with artifact name (e.g., clean_sample.csv:latest)")
     run = wandb.init(job_type="data_tests", resume=True)
-    data_path = run.use_artifact(csv_arg).file()
-    data = pd.read_csv(data_path)
+    data_path = open_store(run).use_artifact(csv_arg).file()
+    data = read_dataset(data_path)
     run.finish()
     return data
 
 @pytest.fixture(scope='session')
-def ref_data(request):
+def ref_profile(request):
     ref_arg = request.config.getoption("--ref")
     if not ref_arg:
         raise ValueError("Must provide --ref option with artifact name (e.g., clean_sample.csv:reference)")
     run = wandb.init(job_type="data_tests", resume=True)
-    data_path = run.use_artifact(ref_arg).file()
-    data = pd.read_csv(data_path)
+    profile = reference_profile(
+        open_store(run), ref_arg, cache_dir=request.config.getoption("--profile_cache_dir")
+    )
     run.finish()
-    return data
+    return profile
 
 @pytest.fixture(scope='session')
 def kl_threshold(request):
@@ -0,0 +1,117 @@
+"""
+Compact summary (profile) of the reference dataset of data_check: row count, column schema,
+frequencies of the categorical columns and quantiles of the numerical ones. The reference
+does not change between runs, so it is summarized once and the tests compare the new data
+with the profile instead of with the full reference dataset
+"""
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from wandb_utils.datasets import read_dataset
+
+from drift import new_sketch
+
+logger = logging.getLogger()
+
+# Bump when the content of the profile changes, so that old profiles are rebuilt
+PROFILE_VERSION = 2
+
+# Columns whose distinct values are counted (the others are too many, like the names)
+CATEGORICAL_COLUMNS = ["neighbourhood", "neighbourhood_group", "room_type"]
+
+# Number of evenly spaced quantiles (including the minimum and the maximum) kept for each
+# numerical column
+N_QUANTILES = 101
+
+
+def build_profile(df):
+    """
+    Summarize a dataset
+
+    :param df: DataFrame
+    :return: dictionary that can be serialized as JSON
+    """
+    categories = {}
+    for column in CATEGORICAL_COLUMNS:
+        if column in df.columns:
+            counts = df[column].value_counts()
+            categories[column] = {
+                "counts": {str(value): int(count) for value, count in counts.items()},
+                "n_missing": int(df[column].isna().sum()),
+            }
+
+    numeric = {}
+    for column in df.select_dtypes(include="number").columns:
+        values = df[column].dropna().to_numpy(dtype=float)
+        numeric[column] = {
+            "n_missing": int(len(df) - len(values)),
+            "quantiles": np.quantile(values, np.linspace(0, 1, N_QUANTILES)).tolist() if len(values) else [],
+        }
+
+    # Mergeable sketches, to measure the drift of the new data (see drift.py)
+    sketches = {
+        column: new_sketch(df[column]).update(df[column]).to_dict()
+        for column in CATEGORICAL_COLUMNS + list(numeric) if column in df.columns
+    }
+
+    return {
+        "version": PROFILE_VERSION,
+        "n_rows": int(len(df)),
+        "schema": {column: str(dtype) for column, dtype in df.dtypes.items()},
+        "categories": categories,
+        "numeric": numeric,
+        "sketches": sketches,
+    }
+
+
+def category_frequencies(profile, column):
+    """
+    Frequencies of the values of a categorical column of the profile, like
+    value_counts(normalize=True) on the original dataset
+
+    :return: Series indexed by the values
+    """
+    counts = pd.Series(profile["categories"][column]["counts"], dtype=float)
+    return counts / counts.sum()
+
+
+def reference_profile(store, reference, frames=None, cache_dir="none"):
+    """
+    Get the profile of the reference artifact: from the local cache (keyed by the digest of
+    the artifact) or else by reading the dataset once. New profiles are stored in the cache
+    only, the reference artifact is shared with the other steps and is left untouched
+
+    :param store: the artifact store of the step (see wandb_utils.artifact_store)
+    :param reference: reference of the artifact (like "clean_sample.csv:reference")
+    :param frames: DataFrames of the artifacts produced in-process by the previous steps
+    :param cache_dir: directory of the local cache of the profiles, or "none"
+    :return: the profile
+    """
+    artifact = store.use_artifact(reference)
+
+    cache_path = None
+    if cache_dir != "none":
+        cache_dir = os.path.expanduser(cache_dir)
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = os.path.join(cache_dir, f"{artifact.digest}-v{PROFILE_VERSION}.json")
+        if os.path.exists(cache_path):
+            logger.info(f"Using the cached profile of {reference}")
+            with open(cache_path) as fp:
+                return json.load(fp)
+
+    logger.info(f"Profiling {reference}")
+    frames = frames or {}
+    df = frames[reference] if reference in frames else read_dataset(artifact.file())
+    profile = build_profile(df)
+
+    if cache_path is not None:
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(profile, fp)
+        os.replace(tmp_path, cache_path)
+
+    return profile
@@ -0,0 +1,272 @@
+"""
+Distribution drift between a reference dataset and new data, computed from small mergeable
+sketches instead of from the datasets themselves: a heavy-hitters sketch (Misra-Gries) for
+the categorical columns and a t-digest for the numerical ones. Sketches built on separate
+chunks or partitions of a dataset are combined with merge, so the data never needs to be in
+memory at once, and the sketch of the reference is stored in its profile (see data_profile).
+
+From two sketches of the same column, column_drift gives the KL divergence and the
+population stability index (PSI) of the new data with respect to the reference, and for
+numerical columns the Kolmogorov-Smirnov statistic
+"""
+import numpy as np
+import pandas as pd
+
+# Probability given to the bins that are empty on one side, so that KL and PSI stay finite
+_EPSILON = 1e-6
+
+# Key of the share of the values that a FrequencySketch did not keep
+OTHER = "__other__"
+
+# Number of bins (quantiles of the reference) on which KL and PSI of numerical columns are
+# computed
+_N_BINS = 10
+
+
+class FrequencySketch:
+    """
+    Approximate counts of the values of a categorical column, keeping at most capacity
+    values (Misra-Gries summary). The values with a frequency above 1 / (capacity + 1) are
+    always kept, and every count is underestimated by at most error
+
+    :param capacity: maximum number of values counted
+    """
+
+    kind = "frequency"
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = {}
+        self.n = 0
+        self.n_missing = 0
+        self.error = 0
+
+    def update(self, values):
+        """
+        Add an array (or Series) of values
+        """
+        values = pd.Series(values)
+        self.n_missing += int(values.isna().sum())
+        counts = values.value_counts()
+        self.n += int(counts.sum())
+        self._add(counts.items(), 0)
+        return self
+
+    def merge(self, other):
+        """
+        Combine with the sketch of another part of the dataset (in place)
+        """
+        self.n += other.n
+        self.n_missing += other.n_missing
+        self._add(other.counts.items(), other.error)
+        return self
+
+    def _add(self, items, error):
+        for value, count in items:
+            self.counts[value] = self.counts.get(value, 0) + int(count)
+        self.error += error
+        if len(self.counts) > self.capacity:
+            # Subtracting the (capacity + 1)-th largest count from all the counts keeps at
+            # most capacity of them
+            threshold = sorted(self.counts.values(), reverse=True)[self.capacity]
+            self.counts = {value: count - threshold for value, count in self.counts.items() if count > threshold}
+            self.error += threshold
+
+    def proportions(self):
+        """
+        :return: Series with the share of each value among the non-missing ones. The share of
+                 the values that were not kept is under the OTHER key
+        """
+        proportions = pd.Series(self.counts, dtype=float) / max(self.n, 1)
+        other = 1 - proportions.sum()
+        if other > 0:
+            proportions[OTHER] = other
+        return proportions
+
+    def to_dict(self):
+        return {
+            "kind": self.kind,
+            "capacity": self.capacity,
+            "counts": {str(value): count for value, count in self.counts.items()},
+            "n": self.n,
+            "n_missing": self.n_missing,
+            "error": self.error,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        sketch = cls(state["capacity"])
+        sketch.counts = dict(state["counts"])
+        sketch.n = state["n"]
+        sketch.n_missing = state["n_missing"]
+        sketch.error = state["error"]
+        return sketch
+
+
+class TDigest:
+    """
+    Approximate distribution of a numerical column: the sorted values are grouped into
+    centroids (mean and weight), small in the tails and larger in the middle, following the
+    scale function of the t-digest. The number of centroids is about compression / 2
+    whatever the number of values, and quantiles are most accurate near 0 and 1
+
+    :param compression: controls the number of centroids, and so the accuracy
+    """
+
+    kind = "tdigest"
+
+    def __init__(self, compression=200):
+        self.compression = compression
+        self.means = np.empty(0)
+        self.weights = np.empty(0)
+        self.min = np.inf
+        self.max = -np.inf
+        self.n_missing = 0
+
+    @property
+    def n(self):
+        return float(self.weights.sum())
+
+    def update(self, values):
+        """
+        Add an array (or Series) of values
+        """
+        values = np.asarray(values, dtype=float)
+        missing = np.isnan(values)
+        self.n_missing += int(missing.sum())
+        values = values[~missing]
+        if len(values):
+            self.min = min(self.min, float(values.min()))
+            self.max = max(self.max, float(values.max()))
+            self._compress(np.concatenate([self.means, values]), np.concatenate([self.weights, np.ones(len(values))]))
+        return self
+
+    def merge(self, other):
+        """
+        Combine with the digest of another part of the dataset (in place)
+        """
+        self.n_missing += other.n_missing
+        if len(other.means):
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self._compress(np.concatenate([self.means, other.means]), np.concatenate([self.weights, other.weights]))
+        return self
+
+    def _compress(self, means, weights):
+        order = np.argsort(means, kind="stable")
+        means, weights = means[order], weights[order]
+        cumulative = np.cumsum(weights)
+        q = (cumulative - weights / 2) / cumulative[-1]
+        # Points whose quantiles fall in the same unit of the scale function form a
+        # centroid: the scale is steep near 0 and 1, so the centroids are small there
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * q - 1)
+        centroid = np.floor(k - k[0]).astype(np.int64)
+        weight = np.bincount(centroid, weights=weights)
+        kept = weight > 0
+        self.means = np.bincount(centroid, weights=weights * means)[kept] / weight[kept]
+        self.weights = weight[kept]
+
+    def cdf(self, x):
+        """
+        :param x: value or array of values
+        :return: estimated fraction of the values below x
+        """
+        if not len(self.means):
+            return np.full(np.shape(x), np.nan)
+        cumulative = np.cumsum(self.weights)
+        q = (cumulative - self.weights / 2) / cumulative[-1]
+        return np.interp(x, np.r_[self.min, self.means, self.max], np.r_[0.0, q, 1.0])
+
+    def quantile(self, q):
+        """
+        :param q: quantile or array of quantiles, between 0 and 1
+        :return: estimated value of the quantiles
+        """
+        if not len(self.means):
+            return np.full(np.shape(q), np.nan)
+        cumulative = np.cumsum(self.weights)
+        centroid_q = (cumulative - self.weights / 2) / cumulative[-1]
+        return np.interp(q, np.r_[0.0, centroid_q, 1.0], np.r_[self.min, self.means, self.max])
+
+    def to_dict(self):
+        return {
+            "kind": self.kind,
+            "compression": self.compression,
+            "means": self.means.tolist(),
+            "weights": self.weights.tolist(),
+            "min": self.min if len(self.means) else None,
+            "max": self.max if len(self.means) else None,
+            "n_missing": self.n_missing,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        digest = cls(state["compression"])
+        digest.means = np.array(state["means"], dtype=float)
+        digest.weights = np.array(state["weights"], dtype=float)
+        if len(digest.means):
+            digest.min = state["min"]
+            digest.max = state["max"]
+        digest.n_missing = state["n_missing"]
+        return digest
+
+
+_SKETCHES = {sketch.kind: sketch for sketch in (FrequencySketch, TDigest)}
+
+
+def sketch_from_dict(state):
+    """
+    Rebuild a sketch from the output of its to_dict
+    """
+    return _SKETCHES[state["kind"]].from_dict(state)
+
+
+def new_sketch(series):
+    """
+    Empty sketch suited to the type of a column
+    """
+    return TDigest() if pd.api.types.is_numeric_dtype(series) else FrequencySketch()
+
+
+def empty_like(sketch):
+    """
+    Empty sketch of the same kind and parameters as another one
+    """
+    if isinstance(sketch, TDigest):
+        return TDigest(sketch.compression)
+    return FrequencySketch(sketch.capacity)
+
+
+def _divergences(actual, expected):
+    actual = (np.asarray(actual, dtype=float) + _EPSILON) / (1 + _EPSILON * len(actual))
+    expected = (np.asarray(expected, dtype=float) + _EPSILON) / (1 + _EPSILON * len(expected))
+    log_ratio = np.log(actual / expected)
+    return float(np.sum(actual * log_ratio)), float(np.sum((actual - expected) * log_ratio))
+
+
+def column_drift(reference, current):
+    """
+    Drift of a column between two sketches of the same kind
+
+    :param reference: sketch of the reference dataset
+    :param current: sketch of the new data
+    :return: dictionary with the KL divergence of the new data from the reference ("kl"), the
+             PSI ("psi") and the Kolmogorov-Smirnov statistic ("ks", numerical columns only)
+    """
+    if isinstance(reference, FrequencySketch):
+        expected = reference.proportions()
+        actual = current.proportions()
+        values = expected.index.union(actual.index, sort=False)
+        kl, psi = _divergences(actual.reindex(values, fill_value=0), expected.reindex(values, fill_value=0))
+        return {"kl": kl, "psi": psi, "ks": None}
+
+    # The bins are the quantiles of the reference, so each one holds about the same share of
+    # the reference. Repeated values (like minimum_nights = 1) can merge some of them
+    edges = np.unique(reference.quantile(np.linspace(0, 1, _N_BINS + 1)[1:-1]))
+    expected = np.diff(np.r_[0.0, reference.cdf(edges), 1.0])
+    actual = np.diff(np.r_[0.0, current.cdf(edges), 1.0])
+    kl, psi = _divergences(actual, expected)
+
+    points = np.union1d(reference.means, current.means)
+    ks = float(np.max(np.abs(reference.cdf(points) - current.cdf(points)), initial=0.0))
+    return {"kl": kl, "psi": psi, "ks": ks}
@@ -0,0 +1,325 @@
+"""
+Declarative data validation. The checks are declared as a list of dictionaries (see
+data_check_suite), compiled into expectations and evaluated together in a single pass over
+the data: every chunk is read once and goes through all the expectations, each of them
+keeping only a small state (counts, failures) between chunks. The result is a structured
+report, that the tests in test_data.py only read
+"""
+import abc
+
+import pandas as pd
+from scipy.stats import ks_2samp
+
+from data_profile import category_frequencies
+from drift import column_drift, empty_like, sketch_from_dict
+
+
+# Columns whose distribution is compared with the one of the reference
+DRIFT_COLUMNS = ["neighbourhood", "room_type", "price", "minimum_nights", "reviews_per_month"]
+
+# Number of failing values quoted in the report of an expectation
+_N_EXAMPLES = 5
+
+
+class Expectation(abc.ABC):
+    """
+    A check accumulated over the chunks of a dataset: update is called with every chunk,
+    then result gives the outcome
+
+    :param name: name of the expectation in the report
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    @abc.abstractmethod
+    def update(self, chunk):
+        """
+        :param chunk: DataFrame with the next rows of the dataset
+        """
+
+    @abc.abstractmethod
+    def result(self):
+        """
+        :return: tuple (passed, message, observed) with the outcome, a message explaining a
+                 failure and the observed values
+        """
+
+
+class ColumnsEqual(Expectation):
+    """
+    The dataset has exactly the given columns (in any order)
+    """
+
+    def __init__(self, name, columns):
+        super().__init__(name)
+        self.columns = set(columns)
+        self.observed = None
+
+    def update(self, chunk):
+        if self.observed is None:
+            self.observed = set(chunk.columns)
+
+    def result(self):
+        observed = self.observed or set()
+        missing = sorted(self.columns - observed)
+        unexpected = sorted(observed - self.columns)
+        return (
+            not missing and not unexpected,
+            f"Column names do not match expected columns (missing: {missing}, unexpected: {unexpected})",
+            {"missing": missing, "unexpected": unexpected},
+        )
+
+
+class RowCount(Expectation):
+    """
+    The number of rows is strictly between min and max
+    """
+
+    def __init__(self, name, min, max):
+        super().__init__(name)
+        self.min = min
+        self.max = max
+        self.n_rows = 0
+
+    def update(self, chunk):
+        self.n_rows += len(chunk)
+
+    def result(self):
+        return (
+            self.min < self.n_rows < self.max,
+            f"Row count {self.n_rows} out of expected range ({self.min}, {self.max})",
+            {"n_rows": self.n_rows},
+        )
+
+
+class Between(Expectation):
+    """
+    All the values of a column are between min and max (inclusive). Missing values fail,
+    like with Series.between
+    """
+
+    def __init__(self, name, column, min, max):
+        super().__init__(name)
+        self.column = column
+        self.min = min
+        self.max = max
+        self.n_failed = 0
+        self.examples = []
+
+    def update(self, chunk):
+        values = chunk[self.column].to_numpy()
+        # Written so that NaN fails
+        failed = ~((values >= self.min) & (values <= self.max))
+        n_failed = int(failed.sum())
+        if n_failed:
+            self.n_failed += n_failed
+            if len(self.examples) < _N_EXAMPLES:
+                self.examples.extend(values[failed][:_N_EXAMPLES - len(self.examples)].tolist())
+
+    def result(self):
+        return (
+            self.n_failed == 0,
+            f"{self.n_failed} values of {self.column} out of [{self.min}, {self.max}], for example {self.examples}",
+            {"n_failed": self.n_failed, "examples": self.examples},
+        )
+
+
+class InSet(Expectation):
+    """
+    All the values of a column belong to a set of known values. Missing values are only
+    accepted with allow_missing
+    """
+
+    def __init__(self, name, column, values, allow_missing=False):
+        super().__init__(name)
+        self.column = column
+        self.values = set(values)
+        self.allow_missing = allow_missing
+        self.unknown = set()
+        self.n_missing = 0
+
+    def update(self, chunk):
+        # Only the distinct values of the chunk are compared with the set
+        column = chunk[self.column]
+        self.n_missing += int(column.isna().sum())
+        self.unknown.update(value for value in column.dropna().unique() if value not in self.values)
+
+    def result(self):
+        unknown = sorted(map(str, self.unknown))
+        passed = not unknown and (self.allow_missing or self.n_missing == 0)
+        return (
+            passed,
+            f"New {self.column} values detected: {unknown[:_N_EXAMPLES]} ({len(unknown)} in total, "
+            f"{self.n_missing} missing values)",
+            {"unknown": unknown, "n_missing": self.n_missing},
+        )
+
+
+class FrequencyDistance(Expectation):
+    """
+    The distribution of the values of a categorical column is similar to a reference: the
+    KS statistic between the two vectors of frequencies is below a threshold
+    """
+
+    def __init__(self, name, column, reference, threshold):
+        super().__init__(name)
+        self.column = column
+        self.reference = pd.Series(reference, dtype=float)
+        self.threshold = threshold
+        self.counts = pd.Series(dtype=float)
+
+    def update(self, chunk):
+        self.counts = self.counts.add(chunk[self.column].value_counts(), fill_value=0)
+
+    def result(self):
+        frequencies = (self.counts / self.counts.sum()).sort_index()
+        statistic = float(ks_2samp(frequencies, self.reference.sort_index()).statistic)
+        return (
+            statistic < self.threshold,
+            f"{self.column} distribution differs too much (KS stat: {statistic}, threshold: {self.threshold})",
+            {"ks_statistic": statistic},
+        )
+
+
+class Drift(Expectation):
+    """
+    The distribution of a column is close to the one of the reference: the KL divergence
+    (and optionally the PSI) computed from the sketches of the two datasets is below a
+    threshold. The sketch of the new data is built chunk by chunk
+
+    :param reference: sketch of the column in the reference (see drift.py), as a dictionary
+    """
+
+    def __init__(self, name, column, reference, max_kl, max_psi=None):
+        super().__init__(name)
+        self.column = column
+        self.reference = sketch_from_dict(reference)
+        self.max_kl = max_kl
+        self.max_psi = max_psi
+        self.sketch = empty_like(self.reference)
+
+    def update(self, chunk):
+        self.sketch.merge(empty_like(self.reference).update(chunk[self.column]))
+
+    def result(self):
+        drift = column_drift(self.reference, self.sketch)
+        passed = drift["kl"] < self.max_kl and (self.max_psi is None or drift["psi"] < self.max_psi)
+        return (
+            passed,
+            f"{self.column} drifted from the reference (KL: {drift['kl']:.4f}, PSI: {drift['psi']:.4f}, "
+            f"thresholds: {self.max_kl}, {self.max_psi})",
+            drift,
+        )
+
+
+_EXPECTATIONS = {
+    "columns_equal": ColumnsEqual,
+    "row_count": RowCount,
+    "between": Between,
+    "in_set": InSet,
+    "frequency_distance": FrequencyDistance,
+    "drift": Drift,
+}
+
+
+def compile_expectations(specs):
+    """
+    :param specs: list of dictionaries, each with the type of the expectation ("expect"),
+                  its name and its parameters
+    :return: list of Expectation
+    """
+    expectations = []
+    for spec in specs:
+        spec = dict(spec)
+        kind = spec.pop("expect")
+        if kind not in _EXPECTATIONS:
+            raise ValueError(f"Unknown expectation {kind}, use one of {list(_EXPECTATIONS)}")
+        expectations.append(_EXPECTATIONS[kind](**spec))
+    return expectations
+
+
+def validate(chunks, specs):
+    """
+    Evaluate all the expectations in a single pass over the data
+
+    :param chunks: iterable of DataFrames (a single DataFrame in a list for in-memory data)
+    :param specs: the declaration of the expectations (see compile_expectations)
+    :return: the report, a dictionary with the overall outcome, the number of rows and the
+             outcome of each expectation
+    """
+    expectations = compile_expectations(specs)
+    n_rows = 0
+    for chunk in chunks:
+        n_rows += len(chunk)
+        for expectation in expectations:
+            expectation.update(chunk)
+
+    results = {}
+    for expectation in expectations:
+        passed, message, observed = expectation.result()
+        results[expectation.name] = {
+            "passed": bool(passed),
+            "message": None if passed else message,
+            "observed": observed,
+        }
+
+    return {
+        "passed": all(result["passed"] for result in results.values()),
+        "n_rows": n_rows,
+        "expectations": results,
+    }
+
+
+def data_check_suite(ref_profile, kl_threshold, min_price, max_price):
+    """
+    The expectations of data_check on the cleaned data
+
+    :param ref_profile: profile of the reference dataset (see data_profile)
+    :param kl_threshold: threshold of the distance between the distributions of neighbourhood
+    :param min_price: minimum price
+    :param max_price: maximum price
+    :return: list of specifications for validate
+    """
+    neighbourhoods = ref_profile["categories"]["neighbourhood"]
+    drift = [
+        {
+            "expect": "drift",
+            "name": f"drift_{column}",
+            "column": column,
+            "reference": ref_profile["sketches"][column],
+            "max_kl": kl_threshold,
+        }
+        for column in DRIFT_COLUMNS
+    ]
+    return drift + [
+        {
+            "expect": "columns_equal",
+            "name": "column_names",
+            "columns": [
+                'id', 'name', 'host_id', 'host_name', 'neighbourhood_group',
+                'neighbourhood', 'latitude', 'longitude', 'room_type', 'price',
+                'minimum_nights', 'number_of_reviews', 'last_review',
+                'reviews_per_month', 'calculated_host_listings_count',
+                'availability_365'
+            ],
+        },
+        {
+            "expect": "in_set",
+            "name": "neighborhood_names",
+            "column": "neighbourhood",
+            "values": list(neighbourhoods["counts"]),
+            "allow_missing": neighbourhoods["n_missing"] > 0,
+        },
+        {"expect": "between", "name": "latitude_bounds", "column": "latitude", "min": 40.5, "max": 41.2},
+        {"expect": "between", "name": "longitude_bounds", "column": "longitude", "min": -74.3, "max": -73.7},
+        {
+            "expect": "frequency_distance",
+            "name": "similar_neigh_distrib",
+            "column": "neighbourhood",
+            "reference": category_frequencies(ref_profile, "neighbourhood").to_dict(),
+            "threshold": kl_threshold,
+        },
+        {"expect": "row_count", "name": "row_count", "min": 15000, "max": 1000000},
+        {"expect": "between", "name": "price_range", "column": "price", "min": min_price, "max": max_price},
+    ]
@@ -1,19 +1,72 @@
 import argparse
-import wandb
-import pytest
+import json
+import logging
 
-def go(args):
+from wandb_utils.artifact_store import open_store
+from wandb_utils.datasets import iter_dataset, read_dataset
+from wandb_utils.startup import add_profile_startup_argument
+
+from data_profile import reference_profile
+from expectations import data_check_suite, validate
+
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+logger = logging.getLogger()
+
+# Imported by go only, see --profile_startup
+DEFERRED_IMPORTS = ["wandb", "pytest"]
+
+
+class DataCheckReport:
+    """
+    pytest plugin handing the report computed by go to the fixtures in conftest.py
+    """
+
+    def __init__(self, report):
+        self.report = report
+
+    def pytest_configure(self, config):
+        config.data_check_report = self.report
+
+
+def go(args, frames=None):
+    import pytest
+    import wandb
+
+    frames = frames or {}
     run = wandb.init(project="nyc_airbnb", job_type="data_check")
-    run.use_artifact(args.csv)
-    run.use_artifact(args.ref)
+    store = open_store(run)
+
+    # Both artifacts are resolved here, once: the tests do not need a W&B run of their own
+    data_artifact = store.use_artifact(args.csv)
+    ref_profile = reference_profile(store, args.ref, frames, args.profile_cache_dir)
+
+    # All the expectations are evaluated together, reading the data only once (chunk by
+    # chunk for datasets that do not fit in memory)
+    if args.csv in frames:
+        chunks = [frames[args.csv]]
+    elif args.chunksize > 0:
+        chunks = iter_dataset(data_artifact.file(), args.chunksize)
+    else:
+        chunks = [read_dataset(data_artifact.file())]
+    report = validate(chunks, data_check_suite(ref_profile, args.kl_threshold, args.min_price, args.max_price))
+
+    for name, result in report["expectations"].items():
+        if not result["passed"]:
+            logger.warning(f"Expectation {name} failed: {result['message']}")
+    with open("data_check_report.json", "w") as fp:
+        json.dump(report, fp, indent=2)
+    run.summary["data_check"] = report
+
     pytest.main([
         "test_data.py",
         f"--csv={args.csv}",
         f"--ref={args.ref}",
         f"--kl_threshold={args.kl_threshold}",
         f"--min_price={args.min_price}",
-        f"--max_price={args.max_price}"
-    ])
+        f"--max_price={args.max_price}",
+        f"--profile_cache_dir={args.profile_cache_dir}",
+    ], plugins=[DataCheckReport(report)])
     run.finish()
 
 if __name__ == "__main__":
@@ -23,5 +76,11 @@ if __name__ == "__main__":
     parser.add_argument("--kl_threshold", type=float, required=True)
     parser.add_argument("--min_price", type=float, required=True)
     parser.add_argument("--max_price", type=float, required=True)
+    parser.add_argument("--profile_cache_dir", type=str, default="none",
+                        help="Directory of the local cache of the reference profiles, or none")
+    parser.add_argument("--chunksize", type=int, default=0,
+                        help="Check the data this many rows at a time to bound the memory usage "
+                        "(0 to load the whole dataset in memory)")
+    add_profile_startup_argument(parser, DEFERRED_IMPORTS)
     args = parser.parse_args()
     go(args)
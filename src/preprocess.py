@@ -3,10 +3,11 @@ import pandas as pd
 import numpy as np
 from sklearn.preprocessing import StandardScaler, OneHotEncoder
 from sklearn.compose import ColumnTransformer
-from geopy.distance import geodesic
 import logging
 import sys
 
+from train_random_forest.feature_engineering import LandmarkDistance
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
@@ -63,9 +64,9 @@ def preprocess_data(input_path, output_path):
     # Derive geographical feature: distance to Times Square
     logging.info("Deriving distance to Times Square")
     times_square = (40.7580, -73.9855)  # Times Square coordinates
-    df['distance_to_times_square'] = df.apply(
-        lambda row: geodesic((row['latitude'], row['longitude']), times_square).miles, axis=1
-    )
+    # Same ellipsoidal distance as geopy's geodesic, computed for all the rows at once
+    distance = LandmarkDistance({'times_square': times_square}, unit='miles')
+    df['distance_to_times_square'] = distance.fit_transform(df[['latitude', 'longitude']])[:, 0]
 
     # Define features for modeling
     numerical_features = ['latitude', 'longitude', 'minimum_nights', 'number_of_reviews', 
@@ -80,6 +81,7 @@ def preprocess_data(input_path, output_path):
             ('num', StandardScaler(), numerical_features),
             ('cat', OneHotEncoder(drop='first', sparse_output=False, handle_unknown='ignore'), 
              categorical_features)
+        ]
     )
 
     # Apply preprocessing
@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+"""
+This script serves the predictions of an exported model over HTTP. The model is loaded from
+a local directory (for example a downloaded random_forest_export:prod), so the server does
+not need W&B
+"""
+import argparse
+import collections
+import concurrent.futures
+import json
+import logging
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import mlflow.sklearn
+import numpy as np
+import pandas as pd
+from mlflow.models import Model
+
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+logger = logging.getLogger()
+
+
+class LatencyStats:
+    """
+    Latency percentiles and throughput of the requests, over a window of the most recent
+    requests
+    """
+
+    def __init__(self, window=10_000):
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=window)
+        self.n_requests = 0
+        self.n_rows = 0
+        self.n_batches = 0
+        self.start = time.monotonic()
+
+    def record_request(self, latency, n_rows):
+        with self.lock:
+            self.latencies.append(latency)
+            self.n_requests += 1
+            self.n_rows += n_rows
+
+    def record_batch(self):
+        with self.lock:
+            self.n_batches += 1
+
+    def snapshot(self):
+        """
+        :return: dictionary with the metrics, latencies in milliseconds
+        """
+        with self.lock:
+            latencies = np.array(self.latencies)
+            elapsed = time.monotonic() - self.start
+            metrics = {
+                "requests": self.n_requests,
+                "rows": self.n_rows,
+                "batches": self.n_batches,
+                "uptime_s": elapsed,
+                "requests_per_s": self.n_requests / elapsed,
+                "rows_per_s": self.n_rows / elapsed,
+            }
+        if len(latencies):
+            metrics["latency_p50_ms"] = float(np.percentile(latencies, 50) * 1000)
+            metrics["latency_p99_ms"] = float(np.percentile(latencies, 99) * 1000)
+        return metrics
+
+
+class MicroBatcher:
+    """
+    Groups the rows of concurrent requests into a single call to predict. A background
+    thread waits for a first request, then for at most max_wait_ms (or until max_batch_size
+    rows are queued) for more, predicts all of them at once and hands each request its
+    predictions
+    """
+
+    def __init__(self, model, stats, max_batch_size=256, max_wait_ms=2.0):
+        self.model = model
+        self.stats = stats
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def predict(self, X):
+        """
+        Predict the rows of a request, together with the rows of other requests submitted
+        at about the same time
+
+        :param X: DataFrame with the rows of the request
+        :return: array of predictions
+        """
+        future = concurrent.futures.Future()
+        self.requests.put((X, future))
+        return future.result()
+
+    def _next_batch(self):
+        batch = [self.requests.get()]
+        n_rows = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while n_rows < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(item)
+            n_rows += len(item[0])
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                X = pd.concat([X for X, _ in batch], ignore_index=True) if len(batch) > 1 else batch[0][0]
+                y_pred = self.model.predict(X)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                else:
+                    # One bad request (like an unknown category) must not fail the others
+                    # batched with it
+                    self._predict_each(batch)
+                continue
+            self.stats.record_batch()
+            start = 0
+            for X, future in batch:
+                future.set_result(y_pred[start:start + len(X)])
+                start += len(X)
+
+    def _predict_each(self, batch):
+        for X, future in batch:
+            try:
+                future.set_result(self.model.predict(X))
+            except Exception as e:
+                future.set_exception(e)
+            self.stats.record_batch()
+
+
+def to_frame(instances, input_example):
+    """
+    Build the DataFrame of a request with the columns and dtypes of the input example, so
+    that the rows look like the ones the model was trained on. JSON nulls become NaN, like
+    the missing values of the training data, so that the imputers replace them
+
+    :param instances: list of dictionaries, one per row
+    :param input_example: DataFrame saved with the model
+    :return: DataFrame
+    """
+    X = pd.DataFrame.from_records(instances, columns=input_example.columns)
+    for column, dtype in input_example.dtypes.items():
+        if pd.api.types.is_numeric_dtype(dtype):
+            X[column] = pd.to_numeric(X[column], errors="coerce")
+        else:
+            X[column] = X[column].where(X[column].notna(), np.nan)
+    return X
+
+
+class PredictionServer(ThreadingHTTPServer):
+    # The default backlog of 5 connections resets clients as soon as a few more of them
+    # connect at the same time
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def make_handler(batcher, stats, input_example, fast_predictor=None):
+
+    class PredictionHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                self._reply(200, stats.snapshot())
+            elif self.path == "/health":
+                self._reply(200, {"status": "ok"})
+            else:
+                self._reply(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._reply(404, {"error": f"Unknown path {self.path}"})
+                return
+
+            start = time.perf_counter()
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                instances = body["instances"] if isinstance(body, dict) else body
+                if not instances:
+                    raise ValueError("no instances to predict")
+                # A single row skips the batching and the sklearn pipeline
+                fast = fast_predictor is not None and len(instances) == 1 and isinstance(instances[0], dict)
+                X = None if fast else to_frame(instances, input_example)
+            except (ValueError, KeyError, TypeError) as e:
+                self._reply(400, {"error": f"Invalid request: {e}"})
+                return
+
+            try:
+                if fast:
+                    y_pred = np.array([fast_predictor.predict_one(instances[0])])
+                else:
+                    y_pred = batcher.predict(X)
+            except (ValueError, KeyError) as e:
+                # Rejected by the model, like a category unknown to the encoders
+                self._reply(400, {"error": f"Invalid request: {e}"})
+                return
+            except Exception as e:
+                logger.exception("Prediction failed")
+                self._reply(500, {"error": str(e)})
+                return
+
+            stats.record_request(time.perf_counter() - start, len(y_pred))
+            self._reply(200, {"predictions": y_pred.tolist()})
+
+        def _reply(self, status, content):
+            data = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            # One log line per request would cost more than the prediction itself
+            pass
+
+    return PredictionHandler
+
+
+def load_model(model_dir, n_warmup):
+    """
+    Load an exported model and run a few predictions on its input example, so that the
+    first requests do not pay for the lazy initializations
+
+    :param model_dir: local directory of the MLflow model
+    :param n_warmup: number of warm-up predictions
+    :return: the model and its input example
+    """
+    logger.info(f"Loading model from {model_dir}")
+    model = mlflow.sklearn.load_model(model_dir)
+    input_example = Model.load(model_dir).load_input_example(model_dir)
+    if input_example is None:
+        raise ValueError(f"The model in {model_dir} has no input example, it is needed to warm it up")
+    # Saved as JSON, so its missing values are read back as None like the ones of the requests
+    input_example = pd.DataFrame(input_example)
+    input_example = to_frame(input_example.to_dict(orient="records"), input_example)
+
+    # The requests are predicted a few rows at a time, so a single core per prediction is
+    # faster than starting a pool of workers
+    estimator = model.steps[-1][1] if hasattr(model, "steps") else model
+    if "n_jobs" in estimator.get_params():
+        estimator.set_params(n_jobs=1)
+
+    logger.info(f"Warming up the model with {n_warmup} predictions")
+    for i in range(n_warmup):
+        model.predict(input_example.iloc[[i % len(input_example)]])
+        model.predict(input_example)
+
+    return model, input_example
+
+
+def load_fast_predictor(model, input_example):
+    """
+    Build the single-row fast path of the model, if the export ships it (see the
+    fast_predictor module of train_random_forest) and if its predictions are identical to
+    the ones of the model on the input example
+
+    :return: the FastPredictor, or None
+    """
+    try:
+        # The code directory of the export is on the path once the model is loaded
+        from fast_predictor import FastPredictor
+    except ImportError:
+        logger.info("The model does not ship the fast predictor, single rows go through the pipeline")
+        return None
+
+    try:
+        fast_predictor = FastPredictor.from_pipeline(model)
+    except ValueError as e:
+        logger.info(f"No fast predictor for this model: {e}")
+        return None
+
+    difference = fast_predictor.verify(model, input_example)
+    if difference != 0.0:
+        logger.warning(f"The fast predictor differs from the model by up to {difference}, not using it")
+        return None
+    return fast_predictor
+
+
+def go(args):
+
+    model, input_example = load_model(args.model_dir, args.n_warmup)
+    fast_predictor = load_fast_predictor(model, input_example) if args.fast_path == "true" else None
+
+    stats = LatencyStats()
+    batcher = MicroBatcher(model, stats, args.max_batch_size, args.max_wait_ms)
+    server = PredictionServer(
+        (args.host, args.port), make_handler(batcher, stats, input_example, fast_predictor)
+    )
+
+    logger.info(f"Serving predictions on http://{args.host}:{args.port}/predict")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info(f"Metrics: {stats.snapshot()}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Serve the predictions of an exported model over HTTP")
+
+    parser.add_argument(
+        "--model_dir",
+        type=str,
+        help="Local directory of the exported model (the content of a model_export artifact)",
+        required=True,
+    )
+
+    parser.add_argument(
+        "--host",
+        type=str,
+        help="Address to listen on",
+        default="127.0.0.1",
+    )
+
+    parser.add_argument(
+        "--port",
+        type=int,
+        help="Port to listen on",
+        default=8080,
+    )
+
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        help="Maximum number of rows predicted in a single call",
+        default=256,
+    )
+
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        help="Maximum time a request waits for other requests to be batched with",
+        default=2.0,
+    )
+
+    parser.add_argument(
+        "--n_warmup",
+        type=int,
+        help="Number of predictions of the input example run before serving",
+        default=10,
+    )
+
+    parser.add_argument(
+        "--fast_path",
+        type=str,
+        choices=["true", "false"],
+        help="Whether requests of a single row use the fast predictor shipped with the model",
+        default="true",
+    )
+
+    args = parser.parse_args()
+
+    go(args)
@@ -4,35 +4,64 @@ This script tests a regression model on a test dataset and logs metrics to W&B.
 """
 import argparse
 import logging
-import pandas as pd
-import wandb
-import mlflow.sklearn
-from sklearn.metrics import mean_absolute_error, r2_score
+
+from wandb_utils.artifact_store import open_store
+from wandb_utils.batch_inference import predict_batches
+from wandb_utils.datasets import common_dtypes, dataset_columns, iter_dataset
+from wandb_utils.startup import add_profile_startup_argument
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
 logger = logging.getLogger()
 
-def go(args):
+# Imported by go only, see --profile_startup
+DEFERRED_IMPORTS = ["wandb", "mlflow.sklearn"]
+
+
+def go(args, frames=None):
+    import mlflow.sklearn
+    import wandb
+
     run = wandb.init(project="nyc_airbnb", job_type="test_regression_model")
     run.config.update(args)
+    store = open_store(run)
 
     # Load the model
     logger.info(f"Fetching model artifact: {args.model_export}")
-    model_path = run.use_artifact(args.model_export).download()
+    model_path = store.use_artifact(args.model_export).download()
     model = mlflow.sklearn.load_model(model_path)
+    # Read only the columns the model uses
+    columns = list(model.feature_names_in_) + ["price"]
 
-    # Load the test dataset
-    logger.info(f"Fetching test artifact: {args.test_artifact}")
-    test_path = run.use_artifact(args.test_artifact).file()
-    test_df = pd.read_csv(test_path)
-    X_test = test_df.drop(columns=["price"])
-    y_test = test_df["price"]
+    # Stream the test dataset in chunks, so that datasets much larger than the held-out
+    # split (millions of listings) can be scored as well
+    frames = frames or {}
+    if args.test_artifact in frames:
+        logger.info(f"Using in-memory test artifact: {args.test_artifact}")
+        store.use_artifact(args.test_artifact)
+        test_df = frames[args.test_artifact]
+        id_column = "id" if "id" in test_df.columns else None
+        columns += [id_column] if id_column else []
+        chunks = (
+            test_df.iloc[start:start + args.chunksize][columns] for start in range(0, len(test_df), args.chunksize)
+        )
+    else:
+        logger.info(f"Fetching test artifact: {args.test_artifact}")
+        test_path = store.use_artifact(args.test_artifact).file()
+        id_column = "id" if "id" in dataset_columns(test_path) else None
+        columns += [id_column] if id_column else []
+        # Same column types in every chunk, as if the whole file was read at once
+        dtype = common_dtypes(test_path, args.chunksize, columns=columns)
+        chunks = iter_dataset(test_path, args.chunksize, columns=columns, dtype=dtype)
 
-    # Evaluate the model
+    # Evaluate the model, with a single prediction pass computing the metrics and the
+    # predictions artifact
     logger.info("Evaluating model on test data")
-    y_pred = model.predict(X_test)
-    mae = mean_absolute_error(y_test, y_pred)
-    r2 = r2_score(y_test, y_pred)
+    metrics = predict_batches(
+        chunks, model, model_path, n_workers=args.n_workers, target="price", id_column=id_column,
+        output_path="predictions.parquet"
+    )
+    mae = metrics.mae
+    r2 = metrics.r2
 
     logger.info(f"Test MAE: {mae}")
     logger.info(f"Test R²: {r2}")
@@ -45,13 +74,12 @@ def go(args):
     logger.info(f"Saving test results as {args.output_artifact}")
     with open("test_results.txt", "w") as f:
         f.write(f"Test MAE: {mae}\nTest R²: {r2}\n")
-    artifact = wandb.Artifact(
-        name=args.output_artifact,
-        type="test_results",
-        description="Test results for regression model"
+    store.log_artifact(
+        args.output_artifact,
+        "test_results",
+        "Test results for regression model",
+        ["test_results.txt", "predictions.parquet"],
     )
-    artifact.add_file("test_results.txt")
-    run.log_artifact(artifact)
 
     run.finish()
 
@@ -72,8 +100,21 @@ if __name__ == "__main__":
     parser.add_argument(
         "--output_artifact",
         type=str,
-        help="Name for the output test results",
+        help="Name for the output test results (metrics and predictions)",
         required=True
     )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        help="Number of rows predicted at a time",
+        default=100000
+    )
+    parser.add_argument(
+        "--n_workers",
+        type=int,
+        help="Number of processes predicting chunks in parallel (-1 for one per core)",
+        default=1
+    )
+    add_profile_startup_argument(parser, DEFERRED_IMPORTS)
     args = parser.parse_args()
     go(args)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+"""
+This script trains a histogram-based gradient boosting model
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.metrics import mean_absolute_error, r2_score
+from sklearn.pipeline import Pipeline
+
+from wandb_utils.artifact_store import open_store
+from wandb_utils.datasets import read_dataset
+from wandb_utils.publisher import ArtifactPublisher
+from wandb_utils.startup import add_profile_startup_argument
+
+# The preprocessing is shared with the random forest, so that the two models see the same
+# features
+FEATURE_ENGINEERING_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "train_random_forest")
+sys.path.append(FEATURE_ENGINEERING_DIR)
+from feature_engineering import get_preprocessor  # noqa: E402
+
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+logger = logging.getLogger()
+
+# Categorical features handled natively by the model (they are encoded as one column of
+# category codes each)
+CATEGORICAL_FEATURES = ["room_type", "neighbourhood_group"]
+
+# Imported by go only, see --profile_startup
+DEFERRED_IMPORTS = ["wandb", "mlflow.sklearn", "sklearn.model_selection"]
+
+
+def go(args, frames=None):
+    import mlflow.sklearn
+    import wandb
+    from sklearn.model_selection import train_test_split
+
+    run = wandb.init(job_type="train_gbm")
+    run.config.update(args)
+
+    # Get the gradient boosting configuration and update W&B
+    with open(args.gbm_config) as fp:
+        gbm_config = json.load(fp)
+    run.config.update(gbm_config)
+
+    # Fix the random seed, so we get reproducible results
+    gbm_config['random_state'] = args.random_seed
+
+    logger.info("Preparing sklearn pipeline")
+
+    landmarks = json.loads(args.landmarks)
+    sk_pipe = get_inference_pipeline(gbm_config, args.max_tfidf_features, landmarks)
+
+    # Only the columns used by the inference pipeline (plus the target and the column used
+    # for stratification) are needed
+    stratify_columns = [args.stratify_by] if args.stratify_by != "none" else []
+    input_columns = [c for _, _, cols in sk_pipe["preprocessor"].transformers for c in cols]
+    columns = list(dict.fromkeys(input_columns + ["price"] + stratify_columns))
+
+    store = open_store(run)
+    frames = frames or {}
+    if args.trainval_artifact in frames:
+        logger.info(f"Using in-memory artifact {args.trainval_artifact}")
+        store.use_artifact(args.trainval_artifact)
+        X = frames[args.trainval_artifact][columns].copy()
+    else:
+        trainval_local_path = store.use_artifact(args.trainval_artifact).file()
+        X = read_dataset(trainval_local_path, columns=columns)
+
+    y = X.pop("price")
+
+    logger.info(f"Minimum price: {y.min()}, Maximum price: {y.max()}")
+
+    stratify = X[args.stratify_by] if args.stratify_by != "none" else None
+    X_train, X_val, y_train, y_val = train_test_split(
+        X, y, test_size=args.val_size, stratify=stratify, random_state=args.random_seed
+    )
+
+    logger.info("Fitting")
+    start = time.perf_counter()
+    sk_pipe.fit(X_train, y_train)
+    fit_time = time.perf_counter() - start
+
+    logger.info("Scoring")
+    start = time.perf_counter()
+    y_pred = sk_pipe.predict(X_val)
+    predict_throughput = len(X_val) / (time.perf_counter() - start)
+
+    r_squared = r2_score(y_val, y_pred)
+    mae = mean_absolute_error(y_val, y_pred)
+    predict_latency = measure_latency(sk_pipe, X_val)
+
+    logger.info(f"Score: {r_squared}")
+    logger.info(f"MAE: {mae}")
+    logger.info(f"Fit time: {fit_time:.2f} s, prediction latency: {predict_latency * 1000:.2f} ms, "
+                f"throughput: {predict_throughput:.0f} rows/s")
+
+    logger.info("Exporting model")
+
+    if os.path.exists("gbm_dir"):
+        shutil.rmtree("gbm_dir")
+
+    # Same format as the random forest export, so that test_regression_model can use either
+    mlflow.sklearn.save_model(
+        sk_pipe,
+        "gbm_dir",
+        input_example=X_train.iloc[:5],
+        # The custom transformers of the pipeline are needed to load the model
+        code_paths=[os.path.join(FEATURE_ENGINEERING_DIR, "feature_engineering.py")]
+    )
+    model_size = sum(
+        os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk("gbm_dir") for f in files
+    )
+
+    # Uploaded in the background, the step waits for it before finishing. The upload does
+    # not overlap the timing of the predictions above, so that it does not skew them
+    with ArtifactPublisher(store) as publisher:
+        publisher.publish(
+            args.output_artifact,
+            'model_export',
+            'Trained histogram-based gradient boosting artifact',
+            ['gbm_dir'],
+            metadata=gbm_config
+        )
+
+        run.summary['r2'] = r_squared
+        run.summary['mae'] = mae
+        run.summary['fit_time'] = fit_time
+        run.summary['predict_latency_ms'] = predict_latency * 1000
+        run.summary['predict_rows_per_s'] = predict_throughput
+        run.summary['model_size_mb'] = model_size / 1024 ** 2
+        run.summary['upload_saved_s'] = publisher.flush()
+
+
+def measure_latency(sk_pipe, X, n_rows=100):
+    """
+    Median time to predict a single row, like when serving one request at a time
+
+    :param sk_pipe: fitted inference pipeline
+    :param X: rows to predict
+    :param n_rows: number of rows to time
+    :return: median latency in seconds
+    """
+    latencies = []
+    for i in range(min(n_rows, len(X))):
+        start = time.perf_counter()
+        sk_pipe.predict(X.iloc[[i]])
+        latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies))
+
+
+def get_inference_pipeline(gbm_config, max_tfidf_features, landmarks=None):
+    # Same preprocessing as the random forest, except that neighbourhood_group is encoded as
+    # category codes instead of being one-hot encoded. The gradient boosting does not accept
+    # sparse input, so the features are dense
+    preprocessor, processed_features = get_preprocessor(
+        max_tfidf_features, landmarks, feature_format="dense", categorical_encoding="ordinal"
+    )
+    # With the ordinal encoding every feature before the TF-IDF of the name is one column
+    categorical_features = [processed_features.index(feature) for feature in CATEGORICAL_FEATURES]
+
+    logger.info(f"gbm_config: {gbm_config}")
+    gbm = HistGradientBoostingRegressor(categorical_features=categorical_features, **gbm_config)
+
+    sk_pipe = Pipeline(
+        steps=[
+            ("preprocessor", preprocessor),
+            ("gbm", gbm)
+        ]
+    )
+
+    return sk_pipe
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Train a histogram-based gradient boosting model")
+
+    parser.add_argument(
+        "--trainval_artifact",
+        type=str,
+        help="Artifact containing the training dataset. It will be split into train and validation"
+    )
+
+    parser.add_argument(
+        "--val_size",
+        type=float,
+        help="Size of the validation split. Fraction of the dataset, or number of items",
+    )
+
+    parser.add_argument(
+        "--random_seed",
+        type=int,
+        help="Seed for random number generator",
+        default=42,
+        required=False,
+    )
+
+    parser.add_argument(
+        "--stratify_by",
+        type=str,
+        help="Column to use for stratification",
+        default="none",
+        required=False,
+    )
+
+    parser.add_argument(
+        "--gbm_config",
+        help="Path to a JSON file with the configuration that will be passed to the scikit-learn "
+        "constructor for HistGradientBoostingRegressor",
+        required=True,
+    )
+
+    parser.add_argument(
+        "--max_tfidf_features",
+        help="Maximum number of words to consider for the TFIDF",
+        default=10,
+        type=int
+    )
+
+    parser.add_argument(
+        "--landmarks",
+        type=str,
+        help="JSON dict mapping a landmark name to its [latitude, longitude]. The distance from "
+        "each landmark is added as a feature",
+        default="{}",
+    )
+
+    parser.add_argument(
+        "--output_artifact",
+        type=str,
+        help="Name for the output serialized model",
+        required=True,
+    )
+
+    add_profile_startup_argument(parser, DEFERRED_IMPORTS)
+
+    args = parser.parse_args()
+
+    go(args)
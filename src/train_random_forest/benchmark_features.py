@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+"""
+Compare the dense and the sparse feature formats of the inference pipeline: memory used
+by the preprocessing, size of the feature matrix, fit time, prediction throughput and
+accuracy, for several numbers of TF-IDF features
+"""
+import argparse
+import json
+import logging
+import time
+import tracemalloc
+
+import pandas as pd
+import scipy.sparse
+from sklearn.metrics import r2_score
+from sklearn.model_selection import train_test_split
+
+from wandb_utils.datasets import read_dataset
+
+from run import get_inference_pipeline
+
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
+logger = logging.getLogger()
+
+
+def matrix_size(X):
+    """
+    Memory used by a dense array or by a sparse matrix, in bytes
+    """
+    if scipy.sparse.issparse(X):
+        return X.data.nbytes + X.indices.nbytes + X.indptr.nbytes
+    return X.nbytes
+
+
+def benchmark(X_train, X_val, y_train, y_val, rf_config, max_tfidf_features, feature_format):
+    """
+    Preprocess, fit and predict with one configuration
+
+    :return: dictionary with the measurements
+    """
+    sk_pipe, _ = get_inference_pipeline(rf_config, max_tfidf_features, feature_format=feature_format)
+    preprocessor = sk_pipe["preprocessor"]
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    Xt_train = preprocessor.fit_transform(X_train)
+    preprocessing_time = time.perf_counter() - start
+    _, preprocessing_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    sk_pipe["random_forest"].fit(Xt_train, y_train)
+    fit_time = time.perf_counter() - start
+
+    # End to end, like at inference time: preprocessing and random forest
+    start = time.perf_counter()
+    y_pred = sk_pipe.predict(X_val)
+    predict_time = time.perf_counter() - start
+
+    return {
+        "max_tfidf_features": max_tfidf_features,
+        "feature_format": feature_format,
+        "n_features": Xt_train.shape[1],
+        "matrix_mb": matrix_size(Xt_train) / 1024 ** 2,
+        "preprocessing_peak_mb": preprocessing_peak / 1024 ** 2,
+        "preprocessing_s": preprocessing_time,
+        "fit_s": fit_time,
+        "predict_rows_per_s": len(X_val) / predict_time,
+        "r2": r2_score(y_val, y_pred),
+    }
+
+
+def go(args):
+
+    X = read_dataset(args.input_path)
+    y = X.pop("price")
+    X_train, X_val, y_train, y_val = train_test_split(X, y, test_size=args.val_size, random_state=args.random_seed)
+
+    with open(args.rf_config) as fp:
+        rf_config = json.load(fp)
+    rf_config["random_state"] = args.random_seed
+
+    results = []
+    for max_tfidf_features in args.max_tfidf_features:
+        for feature_format in ["dense", "sparse"]:
+            logger.info(f"Benchmarking max_tfidf_features={max_tfidf_features} with {feature_format} features")
+            results.append(
+                benchmark(X_train, X_val, y_train, y_val, rf_config, max_tfidf_features, feature_format)
+            )
+
+    results = pd.DataFrame(results)
+    logger.info(f"Results:\n{results.to_string(index=False, float_format='{:.3f}'.format)}")
+    if args.output_path is not None:
+        results.to_csv(args.output_path, index=False)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare the dense and the sparse feature formats")
+
+    parser.add_argument(
+        "--input_path",
+        type=str,
+        help="Path to a cleaned dataset (CSV or Parquet), like the content of trainval_data",
+        required=True,
+    )
+
+    parser.add_argument(
+        "--rf_config",
+        type=str,
+        help="Path to a JSON file with the configuration of the RandomForestRegressor",
+        required=True,
+    )
+
+    parser.add_argument(
+        "--max_tfidf_features",
+        type=int,
+        nargs="+",
+        help="Numbers of TF-IDF features to compare",
+        default=[5, 50, 500, 5000],
+    )
+
+    parser.add_argument(
+        "--val_size",
+        type=float,
+        help="Fraction of the dataset used to measure the prediction throughput and the accuracy",
+        default=0.2,
+    )
+
+    parser.add_argument(
+        "--random_seed",
+        type=int,
+        help="Seed for random number generator",
+        default=42,
+    )
+
+    parser.add_argument(
+        "--output_path",
+        type=str,
+        help="Optional path of a CSV file where the results are saved",
+        default=None,
+    )
+
+    args = parser.parse_args()
+
+    go(args)
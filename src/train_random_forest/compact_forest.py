@@ -0,0 +1,152 @@
+"""
+Compact storage of a fitted random forest. The nodes of all the trees are stored in a few
+flat arrays (float32 thresholds and leaf values, int32 children and features), compressed
+when the model is pickled, and the predictions walk all the trees at once with NumPy
+"""
+import io
+
+import numpy as np
+import scipy.sparse
+from sklearn.base import BaseEstimator, RegressorMixin
+
+# Rows predicted at a time, to bound the memory used by the (rows, trees) arrays of nodes
+_BATCH_SIZE = 10_000
+
+
+def oob_tree_errors(forest, X, y):
+    """
+    Mean squared error of each tree of a forest on the samples left out of its bootstrap
+    sample (its out-of-bag samples)
+
+    :param forest: fitted RandomForestRegressor (with bootstrap=True)
+    :param X: the matrix the forest was fitted on
+    :param y: the target the forest was fitted on
+    :return: array with the error of each tree
+    """
+    y = np.asarray(y)
+    errors = []
+    # estimators_samples_ gives the rows drawn for each tree, the other ones are out of bag
+    for tree, samples in zip(forest.estimators_, forest.estimators_samples_):
+        oob = np.ones(y.shape[0], dtype=bool)
+        oob[samples] = False
+        errors.append(np.mean((tree.predict(X[oob]) - y[oob]) ** 2))
+    return np.array(errors)
+
+
+class CompactForestRegressor(BaseEstimator, RegressorMixin):
+    """
+    Prediction-only version of a fitted RandomForestRegressor, built with from_forest. The
+    thresholds are rounded down to float32 (the trees compare float32 features, so the
+    decisions do not change) and the leaf values are stored as float32
+    """
+
+    @classmethod
+    def from_forest(cls, forest, trees=None):
+        """
+        :param forest: fitted RandomForestRegressor
+        :param trees: optional indices of the trees to keep (all of them by default)
+        :return: the compact forest
+        """
+        estimators = forest.estimators_ if trees is None else [forest.estimators_[i] for i in trees]
+
+        roots, left, right, feature, threshold, value = [], [], [], [], [], []
+        depth = 0
+        offset = 0
+        for estimator in estimators:
+            tree = estimator.tree_
+            is_leaf = tree.children_left == -1
+            own = np.arange(tree.node_count)
+            roots.append(offset)
+            # Leaves point to themselves and always go left, so that all the rows can take
+            # the same number of steps whatever the depth of their leaf
+            left.append(np.where(is_leaf, own, tree.children_left) + offset)
+            right.append(np.where(is_leaf, own, tree.children_right) + offset)
+            feature.append(np.where(is_leaf, 0, tree.feature))
+            threshold.append(np.where(is_leaf, np.inf, tree.threshold))
+            value.append(tree.value[:, 0, 0])
+            depth = max(depth, tree.max_depth)
+            offset += tree.node_count
+
+        # Only the features used by some split need to be read at prediction time
+        feature = np.concatenate(feature)
+        features_used, feature = np.unique(feature, return_inverse=True)
+
+        compact = cls()
+        compact.n_features_in_ = forest.n_features_in_
+        compact.max_depth_ = depth
+        compact.features_used_ = features_used.astype(np.int32)
+        compact.roots_ = np.array(roots, dtype=np.int32)
+        compact.left_ = np.concatenate(left).astype(np.int32)
+        compact.right_ = np.concatenate(right).astype(np.int32)
+        compact.feature_ = feature.astype(np.int32)
+        compact.threshold_ = _floor_float32(np.concatenate(threshold))
+        compact.value_ = np.concatenate(value).astype(np.float32)
+        return compact
+
+    @property
+    def n_trees(self):
+        return len(self.roots_)
+
+    def fit(self, X, y=None):
+        raise TypeError("A CompactForestRegressor is built from a fitted forest with from_forest")
+
+    def predict(self, X):
+        return np.concatenate(
+            [self._predict_batch(X[start:start + _BATCH_SIZE]) for start in range(0, X.shape[0], _BATCH_SIZE)]
+        )
+
+    def _predict_batch(self, X):
+        X = X[:, self.features_used_]
+        X = X.toarray() if scipy.sparse.issparse(X) else np.asarray(X)
+        X = X.astype(np.float32)
+
+        # One row per sample, one column per tree: all the trees go down one level at a time
+        node = np.tile(self.roots_, (X.shape[0], 1))
+        rows = np.arange(X.shape[0])[:, None]
+        for _ in range(self.max_depth_):
+            go_left = X[rows, self.feature_[node]] <= self.threshold_[node]
+            node = np.where(go_left, self.left_[node], self.right_[node])
+
+        return self.value_[node].mean(axis=1, dtype=np.float64)
+
+    def to_bytes(self):
+        """
+        Serialize the arrays of the forest in a compressed npz archive
+        """
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **{name: getattr(self, name) for name in _ARRAYS})
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data):
+        """
+        Rebuild the forest from the output of to_bytes
+        """
+        compact = cls()
+        with np.load(io.BytesIO(data)) as arrays:
+            for name in _ARRAYS:
+                setattr(compact, name, arrays[name])
+        compact.n_features_in_ = int(compact.n_features_in_)
+        compact.max_depth_ = int(compact.max_depth_)
+        return compact
+
+    def __getstate__(self):
+        # Pickled (for example by mlflow.sklearn.save_model) as the compressed archive
+        return {"compact_forest": self.to_bytes()}
+
+    def __setstate__(self, state):
+        self.__dict__.update(CompactForestRegressor.from_bytes(state["compact_forest"]).__dict__)
+
+
+_ARRAYS = [
+    "n_features_in_", "max_depth_", "features_used_", "roots_", "left_", "right_", "feature_", "threshold_", "value_"
+]
+
+
+def _floor_float32(x):
+    # Largest float32 not above each value: a float32 feature f satisfies f <= x if and only
+    # if it satisfies f <= _floor_float32(x), so the splits are the same as with float64
+    x32 = x.astype(np.float32)
+    above = x32.astype(np.float64) > x
+    x32[above] = np.nextafter(x32[above], np.float32(-np.inf))
+    return x32
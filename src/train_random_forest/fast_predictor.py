@@ -0,0 +1,287 @@
+"""
+Single-row predictions without the overhead of the sklearn pipeline. The fitted
+preprocessing is compiled into plain Python lookups (imputation values, category codes,
+reference dates, TF-IDF vocabulary and weights) and the trees of the forest into flat
+arrays, so that scoring one listing does not build a DataFrame nor go through the
+validation of each transformer
+"""
+import collections
+import functools
+import math
+
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import FunctionTransformer, OneHotEncoder, OrdinalEncoder
+
+from compact_forest import CompactForestRegressor
+from feature_engineering import DeltaDateTransformer, LandmarkDistance, _parse_days
+
+# Number of distinct dates whose conversion is memoized by each compiled DeltaDateTransformer,
+# so that a long-running server does not keep every date it was ever sent
+DATE_CACHE_SIZE = 4096
+
+
+class FastPredictor:
+    """
+    Compiled version of a fitted inference pipeline (the preprocessor built by
+    get_preprocessor followed by a RandomForestRegressor or a CompactForestRegressor),
+    built with from_pipeline. Its predictions are the same as the ones of the pipeline,
+    which can be checked with verify
+    """
+
+    def __init__(self, columns, branches, n_features, forest):
+        self.columns = columns
+        self.branches = branches
+        self.n_features = n_features
+        self.forest = forest
+
+    @classmethod
+    def from_pipeline(cls, sk_pipe):
+        """
+        :param sk_pipe: fitted Pipeline with a "preprocessor" ColumnTransformer and a forest
+        :return: the FastPredictor
+        """
+        preprocessor, model = sk_pipe.steps[0][1], sk_pipe.steps[-1][1]
+
+        branches = []
+        for name, transformer, columns in preprocessor.transformers_:
+            if transformer == "drop":
+                continue
+            steps = transformer.steps if isinstance(transformer, Pipeline) else [(name, transformer)]
+            branches.append((
+                list(columns),
+                [_compile_step(step) for _, step in steps],
+                preprocessor.output_indices_[name].start,
+            ))
+
+        return cls(list(preprocessor.feature_names_in_), branches, sum(
+            s.stop - s.start for s in preprocessor.output_indices_.values()
+        ), _ForestArrays(model))
+
+    def transform_one(self, record):
+        """
+        Features of a single row, like the output of the preprocessor
+
+        :param record: dictionary (or NumPy record) with the value of each column. Missing
+                       keys, None and NaN are missing values
+        :return: array of features
+        """
+        features = np.zeros(self.n_features)
+        for columns, steps, offset in self.branches:
+            values = [_get(record, column) for column in columns]
+            for step in steps:
+                values = step(values)
+            if isinstance(values, dict):
+                # Sparse output (the TF-IDF), only the non-zero features are written
+                for index, value in values.items():
+                    features[offset + index] = value
+            else:
+                features[offset:offset + len(values)] = values
+        return features
+
+    def predict_one(self, record):
+        """
+        :param record: dictionary (or NumPy record) with the value of each column
+        :return: the prediction, as a float
+        """
+        return self.forest.predict_one(self.transform_one(record))
+
+    def predict(self, records):
+        """
+        :param records: list of dictionaries, or NumPy record array
+        :return: array of predictions
+        """
+        return np.array([self.predict_one(record) for record in records])
+
+    def verify(self, sk_pipe, X):
+        """
+        Check that the predictions are identical to the ones of the pipeline, one row at a
+        time (the pipeline itself can give slightly different results for a row depending on
+        the batch it is part of, see LandmarkDistance)
+
+        :param sk_pipe: the pipeline the predictor was built from
+        :param X: DataFrame of rows to check
+        :return: largest absolute difference between the two predictions of a row (0.0 when
+                 they are identical)
+        """
+        expected = np.array([sk_pipe.predict(X.iloc[[i]])[0] for i in range(len(X))])
+        actual = self.predict(X.to_dict(orient="records"))
+        return float(np.max(np.abs(actual - expected), initial=0.0))
+
+
+class _ForestArrays:
+    # The nodes of all the trees in flat arrays, like CompactForestRegressor, with the leaf
+    # values of the original model so that the predictions are the same
+
+    def __init__(self, model):
+        if isinstance(model, RandomForestRegressor):
+            compact = CompactForestRegressor.from_forest(model)
+            self.value = np.concatenate([estimator.tree_.value[:, 0, 0] for estimator in model.estimators_])
+            self.compact = False
+        elif isinstance(model, CompactForestRegressor):
+            compact = model
+            self.value = model.value_
+            self.compact = True
+        else:
+            raise ValueError(f"Unsupported model {type(model).__name__}, expected a random forest")
+
+        # Thresholds rounded down to float32 take the same decisions on float32 features
+        self.features_used = compact.features_used_
+        self.roots = compact.roots_
+        self.left = compact.left_
+        self.right = compact.right_
+        self.feature = compact.feature_
+        self.threshold = compact.threshold_
+        self.max_depth = compact.max_depth_
+
+    def predict_one(self, features):
+        # The trees compare float32 features, like sklearn
+        x = features[self.features_used].astype(np.float32)
+        node = self.roots
+        for _ in range(self.max_depth):
+            node = np.where(x[self.feature[node]] <= self.threshold[node], self.left[node], self.right[node])
+        values = self.value[node]
+        if self.compact:
+            return float(values[None, :].mean(axis=1, dtype=np.float64)[0])
+        # RandomForestRegressor adds up the predictions of the trees one at a time
+        return sum(values.tolist()) / len(values)
+
+
+def _get(record, column):
+    try:
+        value = record[column]
+    except (KeyError, ValueError, IndexError):
+        return None
+    return value
+
+
+def _is_missing(value):
+    return value is None or (isinstance(value, float) and math.isnan(value))
+
+
+def _compile_step(step):
+    # Each compiled step maps the list of values of a row to the list of values of the next
+    # step
+    for step_type, compile_function in _COMPILERS.items():
+        if isinstance(step, step_type):
+            return compile_function(step)
+    raise ValueError(f"The fast predictor does not support {type(step).__name__}")
+
+
+def _compile_imputer(imputer):
+    if not (isinstance(imputer.missing_values, float) and math.isnan(imputer.missing_values)):
+        raise ValueError("The fast predictor only supports imputers of NaN values")
+    statistics = imputer.statistics_.tolist()
+    numeric = imputer.statistics_.dtype.kind in "fiub"
+
+    def impute(values):
+        values = [statistic if _is_missing(value) else value for value, statistic in zip(values, statistics)]
+        return [float(value) for value in values] if numeric else values
+
+    return impute
+
+
+def _compile_ordinal_encoder(encoder):
+    codes = [{category: float(code) for code, category in enumerate(categories)} for categories in encoder.categories_]
+    unknown_value = encoder.unknown_value if encoder.handle_unknown == "use_encoded_value" else None
+
+    def encode(values):
+        encoded = []
+        for value, column_codes in zip(values, codes):
+            if value in column_codes:
+                encoded.append(column_codes[value])
+            elif unknown_value is not None:
+                encoded.append(float(unknown_value))
+            else:
+                raise ValueError(f"Found unknown category {value!r} during transform")
+        return encoded
+
+    return encode
+
+
+def _compile_one_hot_encoder(encoder):
+    if encoder.drop_idx_ is not None or encoder._infrequent_enabled:
+        raise ValueError("The fast predictor does not support dropped or infrequent categories")
+    if encoder.handle_unknown != "ignore":
+        raise ValueError("The fast predictor only supports OneHotEncoder(handle_unknown='ignore')")
+    positions = [{category: i for i, category in enumerate(categories)} for categories in encoder.categories_]
+
+    def encode(values):
+        encoded = []
+        for value, column_positions in zip(values, positions):
+            one_hot = [0.0] * len(column_positions)
+            if value in column_positions:
+                one_hot[column_positions[value]] = 1.0
+            encoded.extend(one_hot)
+        return encoded
+
+    return encode
+
+
+def _compile_delta_date(transformer):
+    reference_days = transformer.reference_dates_.astype(np.int64).tolist()
+
+    @functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+    def parse_days(value):
+        return int(_parse_days([value], transformer.date_format)[0])
+
+    def delta_days(values):
+        return [float(reference - parse_days(value)) for value, reference in zip(values, reference_days)]
+
+    return delta_days
+
+
+def _compile_landmark_distance(transformer):
+    def distances(values):
+        return transformer.transform(np.array([values], dtype=float))[0].tolist()
+
+    return distances
+
+
+def _compile_function_transformer(transformer):
+    # Only the reshape to 1d that feeds the name to the TF-IDF, which is a no-op on one row
+    if transformer.func is not np.reshape:
+        raise ValueError("The fast predictor only supports FunctionTransformer(np.reshape)")
+    return lambda values: values
+
+
+def _compile_tfidf(vectorizer):
+    if vectorizer.binary or vectorizer.sublinear_tf or vectorizer.norm not in ("l2", None):
+        raise ValueError("The fast predictor only supports TfidfVectorizer with the default weighting")
+    analyzer = vectorizer.build_analyzer()
+    vocabulary = vectorizer.vocabulary_
+    idf = vectorizer.idf_.tolist() if vectorizer.use_idf else None
+    norm = vectorizer.norm
+
+    def tfidf(values):
+        (document,) = values
+        counts = collections.Counter(
+            vocabulary[token] for token in analyzer(document) if token in vocabulary
+        )
+        # Same operations, in the same order (by feature index), as sklearn on a CSR row
+        indices = sorted(counts)
+        weights = [counts[i] * idf[i] if idf is not None else float(counts[i]) for i in indices]
+        if norm == "l2":
+            total = 0.0
+            for weight in weights:
+                total += weight * weight
+            if total != 0.0:
+                total = math.sqrt(total)
+                weights = [weight / total for weight in weights]
+        return dict(zip(indices, weights))
+
+    return tfidf
+
+
+_COMPILERS = {
+    SimpleImputer: _compile_imputer,
+    OrdinalEncoder: _compile_ordinal_encoder,
+    OneHotEncoder: _compile_one_hot_encoder,
+    DeltaDateTransformer: _compile_delta_date,
+    LandmarkDistance: _compile_landmark_distance,
+    FunctionTransformer: _compile_function_transformer,
+    TfidfVectorizer: _compile_tfidf,
+}
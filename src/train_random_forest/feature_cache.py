@@ -0,0 +1,114 @@
+"""
+Disk cache of the output of the preprocessing. The fitted preprocessor and the transformed
+train and validation matrices are stored with joblib and memory-mapped when loaded, so
+experiments that only change the model do not run the preprocessing again
+"""
+import hashlib
+import logging
+import os
+import shutil
+import time
+
+import joblib
+import sklearn
+
+logger = logging.getLogger()
+
+# Source files whose changes invalidate the cache (the code of the custom transformers)
+_source_files = ["feature_engineering.py"]
+
+
+class FeatureCache:
+    """
+    Cache of the preprocessed features, with size-based LRU eviction. Each entry is a
+    directory named after its key, containing a features.joblib file
+    """
+
+    def __init__(self, cache_dir, max_size_mb):
+        """
+        :param cache_dir: directory where the entries are stored
+        :param max_size_mb: the least recently used entries are evicted above this size
+        """
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.max_size = max_size_mb * 1024 * 1024
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, digest, preprocessor, split_parameters):
+        """
+        Compute the key of the features
+
+        :param digest: digest of the W&B artifact containing the data
+        :param preprocessor: the preprocessor, not fitted yet. All its parameters are part
+                             of the key
+        :param split_parameters: parameters of the train/validation split (and of the
+                                 selection of the columns)
+        :return: hex digest identifying the features
+        """
+        h = hashlib.sha256()
+        h.update(digest.encode())
+        h.update(joblib.hash(preprocessor).encode())
+        h.update(joblib.hash(split_parameters).encode())
+        h.update(sklearn.__version__.encode())
+        for path in _source_files:
+            with open(path, "rb") as fp:
+                h.update(fp.read())
+        return h.hexdigest()
+
+    def load(self, key):
+        """
+        Load the features, if present
+
+        :param key: key returned by the key method
+        :return: dictionary saved by the save method (with memory-mapped arrays), or None
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        if not os.path.exists(entry_dir):
+            logger.info("Feature cache miss")
+            return None
+
+        logger.info(f"Feature cache hit, loading the preprocessed features from {entry_dir}")
+        # The modification time of the entry is its last use, for the eviction
+        os.utime(entry_dir)
+        return joblib.load(os.path.join(entry_dir, "features.joblib"), mmap_mode="r")
+
+    def save(self, key, features):
+        """
+        Save the features
+
+        :param key: key returned by the key method
+        :param features: dictionary with the fitted preprocessor, the matrices and the targets
+        """
+        entry_dir = os.path.join(self.cache_dir, key)
+        tmp_dir = f"{entry_dir}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        start = time.perf_counter()
+        # Not compressed, so that the arrays can be memory-mapped
+        joblib.dump(features, os.path.join(tmp_dir, "features.joblib"))
+        logger.info(f"Saved the preprocessed features to the cache in {time.perf_counter() - start:.1f} s")
+
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.rename(tmp_dir, entry_dir)
+
+        self._evict()
+
+    def _evict(self):
+        entries = [
+            os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if not name.endswith(".tmp")
+        ]
+        entries = [(os.path.getmtime(path), _dir_size(path), path) for path in entries]
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            logger.info(f"Evicting {os.path.basename(path)} from the feature cache")
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+
+
+def _dir_size(path):
+    return sum(
+        os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files
+    )
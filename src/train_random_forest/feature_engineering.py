@@ -1,5 +1,11 @@
 import pandas as pd
 import numpy as np
+from sklearn.base import BaseEstimator, TransformerMixin
+from sklearn.compose import ColumnTransformer
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import FunctionTransformer, OneHotEncoder, OrdinalEncoder
 
 
 def delta_date_feature(dates):
@@ -9,3 +15,296 @@ def delta_date_feature(dates):
     """
     date_sanitized = pd.DataFrame(dates).apply(pd.to_datetime)
     return date_sanitized.apply(lambda d: (d.max() -d).dt.days, axis=0).to_numpy()
+
+
+# Above this many distinct dates the memoized conversions are discarded, to bound memory
+_MAX_CACHED_DATES = 100_000
+
+
+class DeltaDateTransformer(BaseEstimator, TransformerMixin):
+    """
+    Fitted version of delta_date_feature: the most recent date of each column is computed
+    at fit time and stored, so the number of days between each date and that reference
+    does not depend on the batch being transformed (delta_date_feature used the most recent
+    date of the batch itself, so the same listing could get different values depending on
+    what it was scored with).
+
+    Dates are parsed with a fixed format first, falling back to pd.to_datetime for the
+    values that do not match it. A column has only a few thousand distinct dates, so each
+    distinct value is converted once and the conversion is remembered across calls.
+
+    :param date_format: format of the dates, used for the fast path of the parsing
+    """
+
+    def __init__(self, date_format="%Y-%m-%d"):
+        self.date_format = date_format
+
+    def fit(self, X, y=None):
+        X = pd.DataFrame(X)
+        self.n_features_in_ = X.shape[1]
+        self.reference_dates_ = np.array(
+            [self._to_days(X[column]).max() for column in X.columns], dtype="datetime64[D]"
+        )
+        return self
+
+    def transform(self, X):
+        X = pd.DataFrame(X)
+        if X.shape[1] != self.n_features_in_:
+            raise ValueError(f"X has {X.shape[1]} columns, but {self.n_features_in_} were seen during fit")
+
+        reference_days = self.reference_dates_.astype(np.int64)
+        return np.column_stack(
+            [reference_days[i] - self._to_days(X[column]) for i, column in enumerate(X.columns)]
+        )
+
+    def _to_days(self, values):
+        # Days since the epoch of each value. Only the distinct values that were never seen
+        # before are parsed
+        codes, uniques = pd.factorize(values, use_na_sentinel=False)
+
+        cache = self.__dict__.setdefault("_days_cache", {})
+        missing = [value for value in uniques if value not in cache]
+        if len(missing) > 0:
+            if len(cache) + len(missing) > _MAX_CACHED_DATES:
+                cache.clear()
+            cache.update(zip(missing, _parse_days(missing, self.date_format)))
+
+        return np.array([cache[value] for value in uniques], dtype=np.int64)[codes]
+
+    def get_feature_names_out(self, input_features=None):
+        if input_features is None:
+            return np.array([f"x{i}" for i in range(self.n_features_in_)], dtype=object)
+        return np.asarray(input_features, dtype=object)
+
+    def __getstate__(self):
+        # The memoized conversions are rebuilt on the fly, no need to pickle them
+        state = super().__getstate__()
+        state.pop("_days_cache", None)
+        return state
+
+
+def _parse_days(values, date_format):
+    values = pd.Series(values, dtype=object)
+    dates = pd.to_datetime(values, format=date_format, errors="coerce")
+    # Values in a different format are parsed the slow way (which raises for invalid dates,
+    # like delta_date_feature does)
+    failed = dates.isna()
+    if failed.any():
+        dates[failed] = pd.to_datetime(values[failed])
+    return dates.to_numpy().astype("datetime64[D]").astype(np.int64)
+
+
+# WGS-84 ellipsoid (the same used by geopy.distance.geodesic)
+_WGS84_A = 6378137.0
+_WGS84_F = 1 / 298.257223563
+_WGS84_B = (1 - _WGS84_F) * _WGS84_A
+# Mean Earth radius in meters (the same used by geopy.distance.great_circle)
+_EARTH_RADIUS = 6371009.0
+
+_METERS_PER_UNIT = {"km": 1000.0, "miles": 1609.344}
+
+
+def geodesic_distance(lat1, lon1, lat2, lon2, max_iter=200, tol=1e-12):
+    """
+    Distance in meters on the WGS-84 ellipsoid between arrays of points, using Vincenty's
+    inverse formula. All the points are processed at once with NumPy, and the result agrees
+    with geopy.distance.geodesic to well under a millimeter at city scale (the two methods
+    only differ for nearly antipodal points, where Vincenty's iteration may not converge)
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(
+        *[np.radians(np.asarray(v, dtype=float)) for v in (lat1, lon1, lat2, lon2)]
+    )
+    f = _WGS84_F
+    U1 = np.arctan((1 - f) * np.tan(lat1))
+    U2 = np.arctan((1 - f) * np.tan(lat2))
+    L = lon2 - lon1
+    sin_U1, cos_U1 = np.sin(U1), np.cos(U1)
+    sin_U2, cos_U2 = np.sin(U2), np.cos(U2)
+
+    lam = L.copy()
+    for _ in range(max_iter):
+        sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+        sin_sigma = np.hypot(cos_U2 * sin_lam, cos_U1 * sin_U2 - sin_U1 * cos_U2 * cos_lam)
+        cos_sigma = sin_U1 * sin_U2 + cos_U1 * cos_U2 * cos_lam
+        sigma = np.arctan2(sin_sigma, cos_sigma)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cos_U1 * cos_U2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            # Points on the equator have cos2_alpha == 0
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sin_U1 * sin_U2 / cos2_alpha)
+        C = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+        lam_prev = lam
+        lam = L + (1 - C) * f * sin_alpha * (
+            sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2))
+        )
+        # Written this way so that missing coordinates (NaN) do not prevent convergence
+        if not np.any(np.abs(lam - lam_prev) >= tol):
+            break
+
+    u2 = cos2_alpha * (_WGS84_A ** 2 - _WGS84_B ** 2) / _WGS84_B ** 2
+    A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+    B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+    delta_sigma = B * sin_sigma * (
+        cos_2sigma_m + B / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+            - B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)
+        )
+    )
+    return _WGS84_B * A * (sigma - delta_sigma)
+
+
+def great_circle_distance(lat1, lon1, lat2, lon2):
+    """
+    Distance in meters between arrays of points on a sphere (haversine formula). Faster
+    than geodesic_distance, but up to ~0.5% off because it ignores the Earth's flattening
+    """
+    lat1, lon1, lat2, lon2 = [np.radians(np.asarray(v, dtype=float)) for v in (lat1, lon1, lat2, lon2)]
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * _EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+class LandmarkDistance(BaseEstimator, TransformerMixin):
+    """
+    Transformer computing the distance of each point from a set of landmarks. The input
+    has two columns, latitude and longitude, and the output has one column per landmark.
+    It works on whole arrays at once, so it can be used in preprocessing scripts and as a
+    branch of the ColumnTransformer of the inference pipeline.
+
+    :param landmarks: dictionary mapping the name of each landmark to its (latitude, longitude)
+    :param method: "geodesic" (ellipsoidal, like geopy.distance.geodesic) or "great_circle"
+    :param unit: "km" or "miles"
+    """
+
+    def __init__(self, landmarks=None, method="geodesic", unit="km"):
+        self.landmarks = landmarks
+        self.method = method
+        self.unit = unit
+
+    def fit(self, X, y=None):
+        if self.method not in ("geodesic", "great_circle"):
+            raise ValueError(f"Unknown method {self.method}, use geodesic or great_circle")
+        if self.unit not in _METERS_PER_UNIT:
+            raise ValueError(f"Unknown unit {self.unit}, use one of {list(_METERS_PER_UNIT)}")
+        return self
+
+    def transform(self, X):
+        X = np.asarray(X, dtype=float)
+        lat, lon = X[:, [0]], X[:, [1]]
+        coordinates = np.array(list(self.landmarks.values()), dtype=float).reshape(-1, 2)
+
+        # Broadcasting computes the (n_points, n_landmarks) distance matrix in one go
+        distance = geodesic_distance if self.method == "geodesic" else great_circle_distance
+        return distance(lat, lon, coordinates[:, 0], coordinates[:, 1]) / _METERS_PER_UNIT[self.unit]
+
+    def get_feature_names_out(self, input_features=None):
+        return np.array([f"distance_to_{name}" for name in self.landmarks], dtype=object)
+
+
+def get_preprocessor(max_tfidf_features, landmarks=None, feature_format="dense", categorical_encoding="onehot"):
+    """
+    Build the preprocessing of the inference pipelines, shared by the models of the pipeline
+
+    :param max_tfidf_features: maximum number of words to consider for the TF-IDF of the name
+    :param landmarks: optional dictionary mapping landmark names to their (latitude, longitude),
+                      the distance from each landmark is added as a feature
+    :param feature_format: "dense" or "sparse" (see below)
+    :param categorical_encoding: "onehot" to one-hot encode neighbourhood_group, "ordinal" to
+                                 encode it as a single column of category codes
+    :return: tuple (preprocessor, processed_features) with the ColumnTransformer and the names
+             of the features (the TF-IDF of the name counts as one)
+    """
+    # Let's handle the categorical features first
+    # Ordinal categorical are categorical values for which the order is meaningful, for example
+    # for room type: 'Entire home/apt' > 'Private room' > 'Shared room'
+    ordinal_categorical = ["room_type"]
+    non_ordinal_categorical = ["neighbourhood_group"]
+    # NOTE: we do not need to impute room_type because the type of the room
+    # is mandatory on the websites, so missing values are not possible in production
+    # (nor during training). That is not true for neighbourhood_group
+    ordinal_categorical_preproc = OrdinalEncoder()
+
+    ######################################
+    # Build a pipeline with two steps:
+    # 1 - A SimpleImputer(strategy="most_frequent") to impute missing values
+    # 2 - A OneHotEncoder() step to encode the variable (or an OrdinalEncoder, see below)
+    # With feature_format "sparse" the one-hot encoding stays sparse like the TF-IDF, and the
+    # output of the preprocessing is a CSR matrix (the random forest accepts it as is, the
+    # gradient boosting does not). With "dense" the output is always a dense array
+    if feature_format not in ("dense", "sparse"):
+        raise ValueError(f"Unknown feature format {feature_format}, use dense or sparse")
+    sparse = feature_format == "sparse"
+    if categorical_encoding == "onehot":
+        non_ordinal_encoder = OneHotEncoder(handle_unknown='ignore', sparse_output=sparse)
+    elif categorical_encoding == "ordinal":
+        # For models handling categorical features natively, which need one column with the
+        # code of the category (unknown categories become missing values)
+        non_ordinal_encoder = OrdinalEncoder(handle_unknown="use_encoded_value", unknown_value=np.nan)
+    else:
+        raise ValueError(f"Unknown categorical encoding {categorical_encoding}, use onehot or ordinal")
+    non_ordinal_categorical_preproc = make_pipeline(
+        SimpleImputer(strategy="most_frequent"),
+        non_ordinal_encoder
+    )
+
+    # Let's impute the numerical columns to make sure we can handle missing values
+    # (note that we do not scale because tree-based models do not need that)
+    zero_imputed = [
+        "minimum_nights",
+        "number_of_reviews",
+        "reviews_per_month",
+        "calculated_host_listings_count",
+        "availability_365",
+        "longitude",
+        "latitude"
+    ]
+    zero_imputer = SimpleImputer(strategy="constant", fill_value=0)
+
+    # A MINIMAL FEATURE ENGINEERING step:
+    # we create a feature that represents the number of days passed since the last review
+    # First we impute the missing review date with an old date (because there hasn't been
+    # a review for a long time), and then we create a new feature from it. The most recent
+    # date is taken from the training data, so that predictions do not depend on the batch
+    date_imputer = make_pipeline(
+        SimpleImputer(strategy='constant', fill_value='2010-01-01'),
+        DeltaDateTransformer()
+    )
+
+    # Some minimal NLP for the "name" column
+    reshape_to_1d = FunctionTransformer(np.reshape, kw_args={"newshape": -1})
+    name_tfidf = make_pipeline(
+        SimpleImputer(strategy="constant", fill_value=""),
+        reshape_to_1d,
+        TfidfVectorizer(
+            binary=False,
+            max_features=max_tfidf_features,
+            stop_words='english'
+        ),
+    )
+
+    # Optionally, the distance of the listing from some landmarks (like Times Square),
+    # computed for all the rows at once
+    landmarks = landmarks or {}
+    landmark_distance = make_pipeline(
+        SimpleImputer(strategy="median"),
+        LandmarkDistance(landmarks)
+    )
+    landmark_transformers = [("landmark_distance", landmark_distance, ["latitude", "longitude"])] if landmarks else []
+    landmark_features = [f"distance_to_{name}" for name in landmarks]
+
+    # Let's put everything together
+    preprocessor = ColumnTransformer(
+        transformers=[
+            ("ordinal_cat", ordinal_categorical_preproc, ordinal_categorical),
+            ("non_ordinal_cat", non_ordinal_categorical_preproc, non_ordinal_categorical),
+            ("impute_zero", zero_imputer, zero_imputed),
+            ("transform_date", date_imputer, ["last_review"]),
+        ] + landmark_transformers + [
+            ("transform_name", name_tfidf, ["name"])
+        ],
+        remainder="drop",  # This drops the columns that we do not transform
+        sparse_threshold=1.0 if sparse else 0.0,
+    )
+
+    processed_features = ordinal_categorical + non_ordinal_categorical + zero_imputed + ["last_review"] + landmark_features + ["name"]
+
+    return preprocessor, processed_features
@@ -8,39 +8,36 @@ import argparse
 import logging
 import os
 import shutil
-import matplotlib.pyplot as plt
-
-import mlflow
+import time
 import json
 
-import pandas as pd
 import numpy as np
-from sklearn.compose import ColumnTransformer
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.impute import SimpleImputer
-from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import OrdinalEncoder, FunctionTransformer, OneHotEncoder
-
-import wandb
 from sklearn.ensemble import RandomForestRegressor
-from sklearn.metrics import mean_absolute_error
-from sklearn.pipeline import Pipeline, make_pipeline
+from sklearn.metrics import mean_absolute_error, r2_score
+from sklearn.pipeline import Pipeline
 
+from wandb_utils.artifact_store import open_store
+from wandb_utils.datasets import read_dataset
+from wandb_utils.publisher import ArtifactPublisher
+from wandb_utils.startup import add_profile_startup_argument
 
-def delta_date_feature(dates):
-    """
-    Given a 2d array containing dates (in any format recognized by pd.to_datetime), it returns the delta in days
-    between each date and the most recent date in its column
-    """
-    date_sanitized = pd.DataFrame(dates).apply(pd.to_datetime)
-    return date_sanitized.apply(lambda d: (d.max() -d).dt.days, axis=0).to_numpy()
+from feature_engineering import get_preprocessor
+from compact_forest import CompactForestRegressor, oob_tree_errors
+from fast_predictor import FastPredictor
+from feature_cache import FeatureCache
+
+# Imported by go only, so that failing on the arguments or building the inference pipeline
+# (see get_inference_pipeline) does not pay for them. Reported by --profile_startup
+DEFERRED_IMPORTS = ["wandb", "mlflow.sklearn", "matplotlib.pyplot", "sklearn.model_selection", "sweep"]
 
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
 logger = logging.getLogger()
 
 
-def go(args):
+def go(args, frames=None):
+    import mlflow.sklearn
+    import wandb
 
     run = wandb.init(job_type="train_random_forest")
     run.config.update(args)
@@ -53,43 +50,135 @@ def go(args):
     # Fix the random seed for the Random Forest, so we get reproducible results
     rf_config['random_state'] = args.random_seed
 
-    # Use run.use_artifact(...).file() to get the train and validation artifact
-    # and save the returned path in train_local_pat
-    trainval_local_path = run.use_artifact(args.trainval_artifact).file()
-   
-    X = pd.read_csv(trainval_local_path)
-    y = X.pop("price")  # this removes the column "price" from X and puts it into y
-
-    logger.info(f"Minimum price: {y.min()}, Maximum price: {y.max()}")
+    logger.info("Preparing sklearn pipeline")
 
-    X_train, X_val, y_train, y_val = train_test_split(
-        X, y, test_size=args.val_size, stratify=X[args.stratify_by], random_state=args.random_seed
+    landmarks = json.loads(args.landmarks)
+    sk_pipe, processed_features = get_inference_pipeline(
+        rf_config, args.max_tfidf_features, landmarks, args.feature_format
     )
 
-    logger.info("Preparing sklearn pipeline")
+    # Only the columns used by the inference pipeline (plus the target and the column used
+    # for stratification) are needed
+    stratify_columns = [args.stratify_by] if args.stratify_by != "none" else []
+    input_columns = [c for _, _, cols in sk_pipe["preprocessor"].transformers for c in cols]
+    columns = list(dict.fromkeys(input_columns + ["price"] + stratify_columns))
 
-    sk_pipe, processed_features = get_inference_pipeline(rf_config, args.max_tfidf_features)
+    # Use store.use_artifact(...).file() to get the train and validation artifact
+    # and save the returned path in train_local_pat
+    store = open_store(run)
+    trainval_artifact = store.use_artifact(args.trainval_artifact)
+    X_train = None
+
+    if args.sweep_config != "none":
+        from sweep import candidate_config, run_sweep
+
+        with open(args.sweep_config) as fp:
+            sweep_config = json.load(fp)
+
+        X_train, X_val, y_train, y_val = load_trainval(args, trainval_artifact, frames or {}, columns)
+        results, best_candidate = run_sweep(
+            lambda config, max_tfidf_features: get_inference_pipeline(
+                config, max_tfidf_features, landmarks, args.feature_format
+            ),
+            X_train, y_train, X_val, y_val, rf_config, args.max_tfidf_features, sweep_config
+        )
+        run.log({"sweep": wandb.Table(dataframe=results)})
+        run.summary["sweep_best"] = best_candidate
+        logger.info(f"Best candidate of the sweep: {best_candidate}")
+
+        # The best candidate goes through the same fitting and export as a single configuration
+        rf_config, max_tfidf_features = candidate_config(best_candidate, rf_config, args.max_tfidf_features)
+        sk_pipe, processed_features = get_inference_pipeline(
+            rf_config, max_tfidf_features, landmarks, args.feature_format
+        )
+
+    # The output of the preprocessing only depends on the data and on the preprocessing
+    # parameters, so experiments changing only the random forest can reuse it
+    feature_cache = None
+    features = None
+    if args.feature_cache_dir != "none":
+        feature_cache = FeatureCache(args.feature_cache_dir, args.feature_cache_max_size_mb)
+        key = feature_cache.key(
+            trainval_artifact.digest,
+            sk_pipe["preprocessor"],
+            {
+                "columns": columns,
+                "val_size": args.val_size,
+                "random_seed": args.random_seed,
+                "stratify_by": args.stratify_by,
+            },
+        )
+        features = feature_cache.load(key)
+
+    if features is None:
+        if X_train is None:
+            X_train, X_val, y_train, y_val = load_trainval(args, trainval_artifact, frames or {}, columns)
+
+        logger.info("Preprocessing")
+        preprocessor = sk_pipe["preprocessor"]
+        features = {
+            "preprocessor": preprocessor,
+            "X_train": preprocessor.fit_transform(X_train),
+            "y_train": y_train.to_numpy(),
+            "X_val": preprocessor.transform(X_val),
+            "y_val": y_val.to_numpy(),
+            "input_example": X_train.iloc[:5],
+        }
+        if feature_cache is not None:
+            feature_cache.save(key, features)
 
     # Then fit it to the X_train, y_train data
     logger.info("Fitting")
 
     ######################################
-    # Fit the pipeline sk_pipe by calling the .fit method on X_train and y_train
-    sk_pipe.fit(X_train, y_train)
+    # Fit the pipeline sk_pipe on X_train and y_train. The preprocessor is already fitted,
+    # so only the random forest is fitted on the transformed features
+    random_forest = sk_pipe["random_forest"]
+    random_forest.fit(features["X_train"], features["y_train"])
+    sk_pipe = Pipeline(
+        steps=[
+            ("preprocessor", features["preprocessor"]),
+            ("random_forest", random_forest)
+        ]
+    )
     ######################################
 
-    # Compute r2 and MAE
+    # Compute r2 and MAE. The validation set is transformed only once for both
     logger.info("Scoring")
-    r_squared = sk_pipe.score(X_val, y_val)
-
-    y_pred = sk_pipe.predict(X_val)
-    mae = mean_absolute_error(y_val, y_pred)
+    y_pred = random_forest.predict(features["X_val"])
+    r_squared = r2_score(features["y_val"], y_pred)
+    mae = mean_absolute_error(features["y_val"], y_pred)
 
     logger.info(f"Score: {r_squared}")
     logger.info(f"MAE: {mae}")
 
     logger.info("Exporting model")
 
+    # The compact export replaces the forest with flat float32 arrays, optionally keeping only
+    # the trees with the smallest out-of-bag error
+    export_pipe = sk_pipe
+    if args.export_format == "compact":
+        trees = None
+        if args.top_k_trees > 0:
+            tree_errors = oob_tree_errors(random_forest, features["X_train"], features["y_train"])
+            trees = np.argsort(tree_errors)[:args.top_k_trees]
+        compact_forest = CompactForestRegressor.from_forest(random_forest, trees)
+        export_pipe = Pipeline(
+            steps=[
+                ("preprocessor", features["preprocessor"]),
+                ("random_forest", compact_forest)
+            ]
+        )
+
+        y_pred_compact = compact_forest.predict(features["X_val"])
+        compact_r_squared = r2_score(features["y_val"], y_pred_compact)
+        compact_mae = mean_absolute_error(features["y_val"], y_pred_compact)
+        logger.info(f"Compact export with {compact_forest.n_trees} trees, score: {compact_r_squared}, "
+                    f"MAE: {compact_mae}")
+        run.summary['compact_n_trees'] = compact_forest.n_trees
+        run.summary['compact_r2_delta'] = compact_r_squared - r_squared
+        run.summary['compact_mae_delta'] = compact_mae - mae
+
     # Save model package in the MLFlow sklearn format
     if os.path.exists("random_forest_dir"):
         shutil.rmtree("random_forest_dir")
@@ -98,42 +187,101 @@ def go(args):
     # Save the sk_pipe pipeline as a mlflow.sklearn model in the directory "random_forest_dir"
     # HINT: use mlflow.sklearn.save_model
     mlflow.sklearn.save_model(
-        sk_pipe,
+        export_pipe,
         "random_forest_dir",
-        input_example = X_train.iloc[:5]
+        input_example = features["input_example"],
+        # The custom transformers and the compact forest are needed to load the model, the
+        # fast predictor is used by the serving of single rows
+        code_paths = ["feature_engineering.py", "compact_forest.py", "fast_predictor.py"]
     )
     ######################################
 
+    # Upload the model we just exported to the artifact store. The upload goes on in the
+    # background while the export is checked and the feature importance is plotted. If the
+    # step fails before the end, the pending upload is cancelled
+    with ArtifactPublisher(store) as publisher:
+        publisher.publish(
+            args.output_artifact,
+            'model_export',
+            'Trained ranfom forest artifact',
+            ['random_forest_dir'],
+            metadata = rf_config
+        )
 
-    # Upload the model we just exported to W&B
-    artifact = wandb.Artifact(
-        args.output_artifact,
-        type = 'model_export',
-        description = 'Trained ranfom forest artifact',
-        metadata = rf_config
-    )
-    artifact.add_dir('random_forest_dir')
-    run.log_artifact(artifact)
+        # The size of the export drives the upload time and the load time of the model
+        model_size = sum(
+            os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk("random_forest_dir") for f in files
+        )
+        start = time.perf_counter()
+        mlflow.sklearn.load_model("random_forest_dir")
+        load_time = time.perf_counter() - start
+        logger.info(f"Model size: {model_size / 1024 ** 2:.1f} MB, load time: {load_time:.2f} s")
+        run.summary['model_size_mb'] = model_size / 1024 ** 2
+        run.summary['model_load_s'] = load_time
+
+        # The single-row fast path must give the same predictions as the exported pipeline. It
+        # only supports some transformers, the model is still usable without it
+        try:
+            fast_predictor_diff = FastPredictor.from_pipeline(export_pipe).verify(export_pipe, features["input_example"])
+        except Exception:
+            logger.exception("The fast predictor cannot be built for this pipeline, skipping it")
+        else:
+            if fast_predictor_diff != 0.0:
+                logger.warning(f"The fast predictor differs from the pipeline by up to {fast_predictor_diff}")
+            run.summary['fast_predictor_max_diff'] = fast_predictor_diff
+
+        # Plot feature importance
+        fig_feat_imp = plot_feature_importance(sk_pipe, processed_features)
+
+        ######################################
+        # Here we save variable r_squared under the "r2" key
+        run.summary['r2'] = r_squared
+        # Now save the variable mae under the key "mae".
+        run.summary['mae'] = mae    
+        ######################################
+
+        # Upload to W&B the feture importance visualization
+        run.log(
+            {
+              "feature_importance": wandb.Image(fig_feat_imp),
+            }
+        )
 
-    # Plot feature importance
-    fig_feat_imp = plot_feature_importance(sk_pipe, processed_features)
+        # The following steps need the model export
+        run.summary['upload_saved_s'] = publisher.flush()
 
-    ######################################
-    # Here we save variable r_squared under the "r2" key
-    run.summary['r2'] = r_squared
-    # Now save the variable mae under the key "mae".
-    run.summary['mae'] = mae    
-    ######################################
 
-    # Upload to W&B the feture importance visualization
-    run.log(
-        {
-          "feature_importance": wandb.Image(fig_feat_imp),
-        }
+def load_trainval(args, trainval_artifact, frames, columns):
+    """
+    Read the train and validation dataset and split it
+
+    :param args: arguments of the step
+    :param trainval_artifact: the artifact with the dataset
+    :param frames: DataFrames of the artifacts produced in-process by the previous steps
+    :param columns: columns to read
+    :return: tuple (X_train, X_val, y_train, y_val)
+    """
+    if args.trainval_artifact in frames:
+        logger.info(f"Using in-memory artifact {args.trainval_artifact}")
+        X = frames[args.trainval_artifact][columns].copy()
+    else:
+        X = read_dataset(trainval_artifact.file(), columns=columns)
+
+    from sklearn.model_selection import train_test_split
+
+    y = X.pop("price")  # this removes the column "price" from X and puts it into y
+
+    logger.info(f"Minimum price: {y.min()}, Maximum price: {y.max()}")
+
+    stratify = X[args.stratify_by] if args.stratify_by != "none" else None
+    return train_test_split(
+        X, y, test_size=args.val_size, stratify=stratify, random_state=args.random_seed
     )
 
 
 def plot_feature_importance(pipe, feat_names):
+    import matplotlib.pyplot as plt
+
     # We collect the feature importance for all non-nlp features first
     feat_imp = pipe["random_forest"].feature_importances_[: len(feat_names)-1]
     # For the NLP feature we sum across all the TF-IDF dimensions into a global
@@ -149,73 +297,8 @@ def plot_feature_importance(pipe, feat_names):
     return fig_feat_imp
 
 
-def get_inference_pipeline(rf_config, max_tfidf_features):
-    # Let's handle the categorical features first
-    # Ordinal categorical are categorical values for which the order is meaningful, for example
-    # for room type: 'Entire home/apt' > 'Private room' > 'Shared room'
-    ordinal_categorical = ["room_type"]
-    non_ordinal_categorical = ["neighbourhood_group"]
-    # NOTE: we do not need to impute room_type because the type of the room
-    # is mandatory on the websites, so missing values are not possible in production
-    # (nor during training). That is not true for neighbourhood_group
-    ordinal_categorical_preproc = OrdinalEncoder()
-
-    ######################################
-    # Build a pipeline with two steps:
-    # 1 - A SimpleImputer(strategy="most_frequent") to impute missing values
-    # 2 - A OneHotEncoder() step to encode the variable
-    non_ordinal_categorical_preproc = make_pipeline(
-        SimpleImputer(strategy="most_frequent"),
-        OneHotEncoder(handle_unknown='ignore', sparse_output=False)
-    )
-
-    # Let's impute the numerical columns to make sure we can handle missing values
-    # (note that we do not scale because the RF algorithm does not need that)
-    zero_imputed = [
-        "minimum_nights",
-        "number_of_reviews",
-        "reviews_per_month",
-        "calculated_host_listings_count",
-        "availability_365",
-        "longitude",
-        "latitude"
-    ]
-    zero_imputer = SimpleImputer(strategy="constant", fill_value=0)
-
-    # A MINIMAL FEATURE ENGINEERING step:
-    # we create a feature that represents the number of days passed since the last review
-    # First we impute the missing review date with an old date (because there hasn't been
-    # a review for a long time), and then we create a new feature from it,
-    date_imputer = make_pipeline(
-        SimpleImputer(strategy='constant', fill_value='2010-01-01'),
-        FunctionTransformer(delta_date_feature, check_inverse=False, validate=False)
-    )
-
-    # Some minimal NLP for the "name" column
-    reshape_to_1d = FunctionTransformer(np.reshape, kw_args={"newshape": -1})
-    name_tfidf = make_pipeline(
-        SimpleImputer(strategy="constant", fill_value=""),
-        reshape_to_1d,
-        TfidfVectorizer(
-            binary=False,
-            max_features=max_tfidf_features,
-            stop_words='english'
-        ),
-    )
-
-    # Let's put everything together
-    preprocessor = ColumnTransformer(
-        transformers=[
-            ("ordinal_cat", ordinal_categorical_preproc, ordinal_categorical),
-            ("non_ordinal_cat", non_ordinal_categorical_preproc, non_ordinal_categorical),
-            ("impute_zero", zero_imputer, zero_imputed),
-            ("transform_date", date_imputer, ["last_review"]),
-            ("transform_name", name_tfidf, ["name"])
-        ],
-        remainder="drop",  # This drops the columns that we do not transform
-    )
-
-    processed_features = ordinal_categorical + non_ordinal_categorical + zero_imputed + ["last_review", "name"]
+def get_inference_pipeline(rf_config, max_tfidf_features, landmarks=None, feature_format="dense"):
+    preprocessor, processed_features = get_preprocessor(max_tfidf_features, landmarks, feature_format)
 
     # Create random forest
     logger.info(f"rf_config: {rf_config}")
@@ -293,6 +376,61 @@ if __name__ == "__main__":
         type=int
     )
 
+    parser.add_argument(
+        "--landmarks",
+        type=str,
+        help="JSON dict mapping a landmark name to its [latitude, longitude]. The distance from "
+        "each landmark is added as a feature",
+        default="{}",
+    )
+
+    parser.add_argument(
+        "--feature_format",
+        type=str,
+        choices=["dense", "sparse"],
+        help="Format of the preprocessed features. Use sparse with many TF-IDF features",
+        default="dense",
+    )
+
+    parser.add_argument(
+        "--sweep_config",
+        type=str,
+        help="Path to a JSON file describing a hyperparameter sweep (strategy, space, n_candidates "
+        "and n_workers). The best candidate is exported. Use 'none' to train the rf_config only",
+        default="none",
+    )
+
+    parser.add_argument(
+        "--feature_cache_dir",
+        type=str,
+        help="Directory where the preprocessed features are cached, or 'none' to not cache them",
+        default="none",
+    )
+
+    parser.add_argument(
+        "--feature_cache_max_size_mb",
+        type=int,
+        help="The least recently used entries of the feature cache are evicted above this size",
+        default=1024,
+    )
+
+    parser.add_argument(
+        "--export_format",
+        type=str,
+        choices=["pickle", "compact"],
+        help="How the forest is stored in the exported model: pickle for the RandomForestRegressor "
+        "itself, compact for flat float32 arrays (much smaller and faster to load)",
+        default="pickle",
+    )
+
+    parser.add_argument(
+        "--top_k_trees",
+        type=int,
+        help="With the compact export, keep only this many trees (the ones with the smallest "
+        "out-of-bag error). 0 keeps all the trees",
+        default=0,
+    )
+
     parser.add_argument(
         "--output_artifact",
         type=str,
@@ -300,6 +438,8 @@ if __name__ == "__main__":
         required=True,
     )
 
+    add_profile_startup_argument(parser, DEFERRED_IMPORTS)
+
     args = parser.parse_args()
 
     go(args)
@@ -0,0 +1,293 @@
+"""
+Hyperparameter sweep for the random forest. The candidates are fitted in a pool of
+processes, and the preprocessing is fitted only once for each distinct preprocessing
+configuration: the transformed matrices are shared by all the candidates using them.
+Besides grid and random search, successive halving spends most of the budget on the
+most promising candidates only
+"""
+import itertools
+import logging
+import math
+import time
+
+import mlflow
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed, effective_n_jobs
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.metrics import mean_absolute_error, r2_score
+from sklearn.model_selection import ParameterGrid, ParameterSampler
+
+logger = logging.getLogger()
+
+# Prefix of the keys of a candidate that are parameters of the RandomForestRegressor
+_RF_PREFIX = "random_forest."
+
+# Successive halving over n_estimators: the out-of-bag score of a forest of a few trees
+# varies a lot from one seed to the other, so the first round needs enough trees for the
+# ranking to mean something
+MIN_TREES = 20
+DEFAULT_MIN_TREES = 30
+
+
+def flatten_space(space):
+    """
+    Turn the search space from the configuration, like
+
+        {"max_tfidf_features": [5, 10], "random_forest": {"max_depth": [10, 15]}}
+
+    into the flat form used by ParameterGrid and ParameterSampler:
+
+        {"max_tfidf_features": [5, 10], "random_forest.max_depth": [10, 15]}
+
+    :param space: search space, as in modeling.sweep.space
+    :return: the flat search space
+    """
+    flat = {}
+    for name, values in space.items():
+        if name == "random_forest":
+            flat.update({f"{_RF_PREFIX}{param}": param_values for param, param_values in values.items()})
+        elif name == "max_tfidf_features":
+            flat[name] = values
+        else:
+            raise ValueError(f"Cannot sweep over {name}, use max_tfidf_features or random_forest")
+    return flat
+
+
+def get_candidates(space, strategy, n_candidates, random_seed):
+    """
+    List the candidates of the sweep
+
+    :param space: search space, as in modeling.sweep.space
+    :param strategy: "grid" for all the combinations, "random" for n_candidates random ones
+    :param n_candidates: number of candidates of a random search
+    :param random_seed: seed for the random search
+    :return: list of flat candidates (see flatten_space)
+    """
+    space = flatten_space(space)
+    if strategy == "grid":
+        return list(ParameterGrid(space))
+    elif strategy == "random":
+        # All the values are lists, so ParameterSampler samples without replacement and
+        # cannot return more candidates than the size of the grid
+        n_candidates = min(n_candidates, len(ParameterGrid(space)))
+        return list(ParameterSampler(space, n_iter=n_candidates, random_state=random_seed))
+    else:
+        raise ValueError(f"Unknown sweep strategy {strategy}, use grid or random")
+
+
+def candidate_config(candidate, rf_config, max_tfidf_features):
+    """
+    Apply the values of a candidate on top of the base configuration
+
+    :param candidate: flat candidate (see flatten_space)
+    :param rf_config: base configuration of the RandomForestRegressor
+    :param max_tfidf_features: base maximum number of TF-IDF features
+    :return: tuple (rf_config, max_tfidf_features) of the candidate
+    """
+    rf_config = dict(rf_config)
+    rf_config.update({
+        name[len(_RF_PREFIX):]: value for name, value in candidate.items() if name.startswith(_RF_PREFIX)
+    })
+    return rf_config, candidate.get("max_tfidf_features", max_tfidf_features)
+
+
+def _fit_candidate(rf_config, X_train, y_train, X_val, y_val):
+    # Runs in a worker process. The matrices are memory-mapped by joblib, so all the
+    # workers read the same copy
+    start = time.perf_counter()
+    random_forest = RandomForestRegressor(**rf_config).fit(X_train, y_train)
+    fit_time = time.perf_counter() - start
+
+    y_pred = random_forest.predict(X_val)
+    return {
+        "r2": r2_score(y_val, y_pred),
+        "mae": mean_absolute_error(y_val, y_pred),
+        "fit_time": fit_time,
+    }
+
+
+def _grow_candidate(random_forest, rf_config, resource, amount, X_train, y_train, random_seed):
+    # One round of successive halving for one candidate, in a worker process
+    start = time.perf_counter()
+    if resource == "n_estimators":
+        # With warm_start, fit only adds the new trees to the ones of the previous rounds
+        if random_forest is None:
+            random_forest = RandomForestRegressor(**{**rf_config, "warm_start": True})
+        random_forest.set_params(n_estimators=amount)
+        random_forest.fit(X_train, y_train)
+    else:
+        # The subsamples of successive rounds are nested, the same rows plus some more
+        rows = np.random.default_rng(random_seed).permutation(len(y_train))[:amount]
+        random_forest = RandomForestRegressor(**rf_config).fit(X_train[rows], y_train[rows])
+    fit_time = time.perf_counter() - start
+
+    scores = {"oob_score": random_forest.oob_score_, "fit_time": fit_time}
+    # The forests trained on a subsample are not needed in the next round, there is no
+    # need to send them back
+    return (random_forest if resource == "n_estimators" else None), scores
+
+
+def successive_halving(parallel, members, matrices, y_train, halving_config, random_seed):
+    """
+    Successive halving: all the candidates start with a small amount of the resource (trees
+    or training rows), and at each round only the best 1/factor of them go on with factor
+    times as much of it. The candidates are ranked by their out-of-bag score, so no
+    validation pass is needed
+
+    :param parallel: joblib Parallel instance used to fit the candidates
+    :param members: list of (candidate, rf_config, max_tfidf_features) tuples
+    :param matrices: dictionary mapping max_tfidf_features to the transformed training matrix
+    :param y_train: training target
+    :param halving_config: dictionary with resource ("n_estimators" or "n_samples"),
+                           min_resource (at least MIN_TREES trees) and factor
+    :param random_seed: seed for the subsamples
+    :return: list of (candidate, scores) tuples, from the best to the worst candidate
+    """
+    resource = halving_config.get("resource", "n_estimators")
+    factor = halving_config.get("factor", 3)
+    min_resource = halving_config.get("min_resource", DEFAULT_MIN_TREES)
+    if resource == "n_estimators":
+        if min_resource < MIN_TREES:
+            logger.warning(
+                f"Ranking candidates by out-of-bag score with {min_resource} trees is very noisy, "
+                f"use at least {MIN_TREES} (min_resource)"
+            )
+        if any(f"{_RF_PREFIX}n_estimators" in candidate for candidate, _, _ in members):
+            raise ValueError("Cannot sweep over n_estimators when it is the resource of successive halving")
+        max_resource = members[0][1].get("n_estimators", 100)
+    elif resource == "n_samples":
+        max_resource = len(y_train)
+    else:
+        raise ValueError(f"Unknown resource {resource}, use n_estimators or n_samples")
+
+    # The ranking relies on the out-of-bag score, which needs bootstrap samples
+    members = [
+        (candidate, {**rf_config, "oob_score": True, "bootstrap": True}, max_tfidf_features)
+        for candidate, rf_config, max_tfidf_features in members
+    ]
+    forests = [None] * len(members)
+    scores = [{"fit_time": 0.0} for _ in members]
+    survivors = list(range(len(members)))
+
+    for n_round in itertools.count():
+        amount = min(min_resource * factor ** n_round, max_resource)
+        logger.info(f"Successive halving round {n_round}: {len(survivors)} candidates with {resource}={amount}")
+
+        round_results = parallel(
+            delayed(_grow_candidate)(
+                forests[i], members[i][1], resource, amount, matrices[members[i][2]], y_train, random_seed
+            )
+            for i in survivors
+        )
+        for i, (random_forest, round_scores) in zip(survivors, round_results):
+            forests[i] = random_forest
+            scores[i] = {
+                "oob_score": round_scores["oob_score"],
+                resource: amount,
+                "fit_time": scores[i]["fit_time"] + round_scores["fit_time"],
+            }
+
+        if amount >= max_resource:
+            break
+
+        survivors.sort(key=lambda i: scores[i]["oob_score"], reverse=True)
+        survivors = survivors[:math.ceil(len(survivors) / factor)]
+        # The winner is trained with all of the resource by the step anyway
+        if len(survivors) == 1:
+            break
+
+    # The candidates that went further come first, then the ones with the best score
+    ranking = sorted(range(len(members)), key=lambda i: (scores[i][resource], scores[i]["oob_score"]), reverse=True)
+    return [(members[i][0], scores[i]) for i in ranking]
+
+
+def run_sweep(get_pipeline, X_train, y_train, X_val, y_val, rf_config, max_tfidf_features, sweep_config):
+    """
+    Fit and score all the candidates of the sweep
+
+    :param get_pipeline: function (rf_config, max_tfidf_features) -> (sk_pipe, processed_features)
+                         building the inference pipeline, whose "preprocessor" step is used
+    :param X_train: training features
+    :param y_train: training target
+    :param X_val: validation features
+    :param y_val: validation target
+    :param rf_config: base configuration of the RandomForestRegressor
+    :param max_tfidf_features: base maximum number of TF-IDF features
+    :param sweep_config: dictionary with strategy, space, n_candidates and n_workers (the
+                         number of processes, -1 for all the cores). With the "halving"
+                         strategy, the halving dictionary configures successive_halving
+    :return: tuple (results, best_candidate), where results is a DataFrame with one row per
+             candidate sorted from the best to the worst
+    """
+    random_seed = rf_config.get("random_state")
+    strategy = sweep_config.get("strategy", "grid")
+    # Successive halving starts from the whole grid, and discards most of it cheaply
+    candidates = get_candidates(
+        sweep_config["space"], "grid" if strategy == "halving" else strategy,
+        sweep_config.get("n_candidates", 20), random_seed
+    )
+    n_workers = effective_n_jobs(sweep_config.get("n_workers", -1))
+    logger.info(f"Sweeping over {len(candidates)} candidates with {n_workers} workers")
+
+    members = []
+    for candidate in candidates:
+        candidate_rf_config, candidate_max_tfidf_features = candidate_config(candidate, rf_config, max_tfidf_features)
+        if n_workers > 1:
+            # The parallelism is across candidates, each forest uses one core
+            candidate_rf_config["n_jobs"] = 1
+        members.append((candidate, candidate_rf_config, candidate_max_tfidf_features))
+
+    # The preprocessing is fitted once for each distinct max_tfidf_features
+    train_matrices, val_matrices = {}, {}
+    for _, _, candidate_max_tfidf_features in members:
+        if candidate_max_tfidf_features in train_matrices:
+            continue
+        logger.info(f"Preprocessing with max_tfidf_features={candidate_max_tfidf_features}")
+        start = time.perf_counter()
+        sk_pipe, _ = get_pipeline(rf_config, candidate_max_tfidf_features)
+        preprocessor = sk_pipe["preprocessor"]
+        train_matrices[candidate_max_tfidf_features] = preprocessor.fit_transform(X_train)
+        if strategy != "halving":
+            val_matrices[candidate_max_tfidf_features] = preprocessor.transform(X_val)
+        logger.info(f"Preprocessing took {time.perf_counter() - start:.1f} s")
+
+    y_train = np.asarray(y_train)
+    y_val = np.asarray(y_val)
+
+    with Parallel(n_jobs=n_workers) as parallel:
+        if strategy == "halving":
+            results = successive_halving(
+                parallel, members, train_matrices, y_train, sweep_config.get("halving", {}), random_seed
+            )
+        else:
+            scores = parallel(
+                delayed(_fit_candidate)(
+                    candidate_rf_config, train_matrices[candidate_max_tfidf_features], y_train,
+                    val_matrices[candidate_max_tfidf_features], y_val
+                )
+                for _, candidate_rf_config, candidate_max_tfidf_features in members
+            )
+            results = sorted(
+                [(candidate, score) for (candidate, _, _), score in zip(members, scores)],
+                key=lambda result: result[1]["r2"], reverse=True
+            )
+
+    log_candidates(results)
+
+    best_candidate = results[0][0]
+    return pd.DataFrame([{**candidate, **score} for candidate, score in results]), best_candidate
+
+
+def log_candidates(results):
+    """
+    Log each candidate of the sweep as a child run of the MLflow run of the step
+
+    :param results: list of (candidate, scores) tuples
+    """
+    # Within mlflow.run this resumes the run of the step, in-process it starts a new one
+    with mlflow.start_run(nested=mlflow.active_run() is not None):
+        for i, (candidate, scores) in enumerate(results):
+            with mlflow.start_run(run_name=f"candidate_{i}", nested=True):
+                mlflow.log_params(candidate)
+                mlflow.log_metrics(scores)
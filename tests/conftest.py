@@ -0,0 +1,11 @@
+"""
+The modules of a step import each other as top-level modules (mlflow.run and the in-process
+runner put the directory of the step on the path), so the tests do the same
+"""
+import os
+import sys
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, os.path.join(PROJECT_DIR, "components"))
+sys.path.insert(0, os.path.join(PROJECT_DIR, "src", "train_random_forest"))
@@ -0,0 +1,42 @@
+"""
+predict_batches on a test set without any row
+"""
+import math
+
+import pandas as pd
+import pytest
+from sklearn.linear_model import LinearRegression
+
+from wandb_utils.batch_inference import predict_batches
+from wandb_utils.datasets import iter_dataset
+
+
+@pytest.fixture
+def model():
+    X = pd.DataFrame({"minimum_nights": [1, 2, 3, 4], "number_of_reviews": [0, 5, 1, 2]})
+    return LinearRegression().fit(X, [50.0, 80.0, 120.0, 90.0])
+
+
+def test_header_only_test_set(tmp_path, model):
+    test_path = tmp_path / "test_data.csv"
+    test_path.write_text("id,minimum_nights,number_of_reviews,price\n")
+    output_path = str(tmp_path / "predictions.csv")
+
+    metrics = predict_batches(
+        iter_dataset(str(test_path), 100), model, None, id_column="id", output_path=output_path
+    )
+
+    assert math.isnan(metrics.mae) and math.isnan(metrics.r2)
+    predictions = pd.read_csv(output_path)
+    assert len(predictions) == 0
+    assert list(predictions.columns) == ["id", "prediction", "price"]
+
+
+def test_no_chunks(tmp_path, model):
+    # Like an empty Parquet file, whose batches iterator yields nothing
+    output_path = str(tmp_path / "predictions.csv")
+
+    metrics = predict_batches(iter([]), model, None, output_path=output_path)
+
+    assert math.isnan(metrics.mae)
+    assert list(pd.read_csv(output_path).columns) == ["prediction", "price"]
@@ -0,0 +1,54 @@
+"""
+FastPredictor.predict_one against the inference pipeline it is compiled from, on the rows of
+the sample shipped with get_data
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fast_predictor import FastPredictor
+from run import get_inference_pipeline
+
+SAMPLE = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "components", "get_data", "data", "sample1.csv"
+)
+
+RF_CONFIG = {"n_estimators": 10, "max_depth": 12, "random_state": 42, "n_jobs": 1}
+LANDMARKS = {"times_square": [40.758, -73.9855], "jfk": [40.6413, -73.7781]}
+
+
+@pytest.fixture(scope="module")
+def listings():
+    df = pd.read_csv(SAMPLE, nrows=600)
+    return df.drop(columns=["price"]), df["price"]
+
+
+@pytest.mark.parametrize("feature_format", ["dense", "sparse"])
+@pytest.mark.parametrize("landmarks", [None, LANDMARKS])
+def test_predict_one_matches_pipeline(listings, feature_format, landmarks):
+    X, y = listings
+    sk_pipe, _ = get_inference_pipeline(RF_CONFIG, 50, landmarks, feature_format)
+    sk_pipe.fit(X.iloc[:500], y.iloc[:500])
+
+    predictor = FastPredictor.from_pipeline(sk_pipe)
+    X_test = X.iloc[500:]
+    expected = np.array([sk_pipe.predict(X_test.iloc[[i]])[0] for i in range(len(X_test))])
+    actual = np.array([predictor.predict_one(record) for record in X_test.to_dict(orient="records")])
+
+    np.testing.assert_array_equal(actual, expected)
+
+
+def test_predict_one_missing_values(listings):
+    X, y = listings
+    sk_pipe, _ = get_inference_pipeline(RF_CONFIG, 50, LANDMARKS)
+    sk_pipe.fit(X, y)
+
+    # Missing name, date and neighbourhood group, like a sparse request to the server
+    row = X.iloc[[0]].copy()
+    row[["name", "last_review", "neighbourhood_group", "reviews_per_month"]] = np.nan
+    row = row.astype({"name": object, "last_review": object, "neighbourhood_group": object})
+
+    predictor = FastPredictor.from_pipeline(sk_pipe)
+    assert predictor.predict_one(row.to_dict(orient="records")[0]) == sk_pipe.predict(row)[0]
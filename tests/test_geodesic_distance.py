@@ -0,0 +1,48 @@
+"""
+geodesic_distance (Vincenty's formula, vectorized) against geopy (Karney's algorithm)
+"""
+import numpy as np
+import pytest
+
+geopy_distance = pytest.importorskip("geopy.distance")
+
+from feature_engineering import geodesic_distance  # noqa: E402
+
+# (latitude, longitude) pairs, in NYC and across the world
+NYC_PAIRS = [
+    ((40.758, -73.9855), (40.6413, -73.7781)),  # Times Square - JFK
+    ((40.7829, -73.9654), (40.7061, -73.9969)),  # Central Park - Brooklyn Bridge
+    ((40.5795, -74.1502), (40.8448, -73.8648)),  # Staten Island - Bronx
+    ((40.7128, -74.0060), (40.7128, -74.0060)),  # Same point
+    ((40.7128, -74.0060), (40.7129, -74.0060)),  # About 11 meters apart
+]
+FAR_PAIRS = [
+    ((40.7128, -74.0060), (51.5074, -0.1278)),  # New York - London
+    ((-33.8688, 151.2093), (-33.4489, -70.6693)),  # Sydney - Santiago
+    ((0.0, 0.0), (0.0, 90.0)),  # Along the equator
+    ((89.9, 0.0), (-89.9, 0.0)),  # Pole to pole
+    ((35.6762, 139.6503), (-34.6037, -58.3816)),  # Tokyo - Buenos Aires
+]
+
+
+def _check(pairs, tolerance_m):
+    lat1, lon1, lat2, lon2 = (np.array(values) for values in zip(*[(*a, *b) for a, b in pairs]))
+    distances = geodesic_distance(lat1, lon1, lat2, lon2)
+    expected = np.array([geopy_distance.geodesic(a, b).meters for a, b in pairs])
+    np.testing.assert_allclose(distances, expected, rtol=0, atol=tolerance_m)
+
+
+def test_nyc_distances_match_geopy():
+    # Well under a millimeter at city scale
+    _check(NYC_PAIRS, 1e-4)
+
+
+def test_far_apart_distances_match_geopy():
+    # Thousands of kilometers: Vincenty's series still agrees with Karney's to a millimeter
+    _check(FAR_PAIRS, 1e-3)
+
+
+def test_missing_coordinates_give_nan():
+    distances = geodesic_distance([40.7128, np.nan], [-74.0060, -74.0], 40.758, -73.9855)
+    assert np.isfinite(distances[0])
+    assert np.isnan(distances[1])
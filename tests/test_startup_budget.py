@@ -0,0 +1,60 @@
+"""
+Cold-start budget of the random forest step: importing its script and building the
+inference pipeline must stay fast, and must not import the dependencies that only the
+training needs (see --profile_startup of the steps)
+"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip("sklearn")
+pytest.importorskip("pandas")
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STEP_DIR = os.path.join(PROJECT_DIR, "src", "train_random_forest")
+
+# Seconds, measured in a fresh interpreter. Override with STARTUP_BUDGET_S on slow machines
+BUDGET_S = float(os.environ.get("STARTUP_BUDGET_S", 5.0))
+
+DEFERRED_MODULES = ["wandb", "mlflow", "matplotlib"]
+
+_COLD_START = """
+import json, sys, time
+start = time.perf_counter()
+from run import get_inference_pipeline
+get_inference_pipeline({"n_estimators": 10}, 10)
+elapsed = time.perf_counter() - start
+print(json.dumps({"elapsed_s": elapsed, "modules": sorted(sys.modules)}))
+"""
+
+
+@pytest.fixture(scope="module")
+def cold_start():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [os.path.join(PROJECT_DIR, "components")] + env.get("PYTHONPATH", "").split(os.pathsep)
+    )
+    completed = subprocess.run(
+        [sys.executable, "-c", _COLD_START],
+        cwd=STEP_DIR,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(completed.stdout.splitlines()[-1])
+
+
+def test_cold_start_within_budget(cold_start):
+    assert cold_start["elapsed_s"] < BUDGET_S, (
+        f"get_inference_pipeline took {cold_start['elapsed_s']:.2f} s from a cold start, "
+        f"the budget is {BUDGET_S} s"
+    )
+
+
+@pytest.mark.parametrize("module", DEFERRED_MODULES)
+def test_heavy_imports_deferred(cold_start, module):
+    assert module not in cold_start["modules"]
@@ -4,22 +4,39 @@ This script splits the provided dataframe in test and remainder
 """
 import argparse
 import logging
-import pandas as pd
-import wandb
+import os
 import tempfile
-from sklearn.model_selection import train_test_split
+
+from wandb_utils.artifact_store import open_store
+from wandb_utils.datasets import dataset_filename, read_dataset, write_dataset
+from wandb_utils.publisher import ArtifactPublisher
+from wandb_utils.startup import add_profile_startup_argument
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)-15s %(message)s")
 logger = logging.getLogger()
 
-def go(args):
+# Imported by go only, see --profile_startup
+DEFERRED_IMPORTS = ["wandb", "sklearn.model_selection"]
+
+
+def go(args, frames=None):
+    import wandb
+    from sklearn.model_selection import train_test_split
+
     run = wandb.init(project="nyc_airbnb", job_type="train_val_test_split")
     run.config.update(args)
+    store = open_store(run)
 
-    logger.info(f"Fetching artifact {args.input_artifact}")
-    artifact_local_path = run.use_artifact(args.input_artifact).file()
+    frames = frames or {}
+    if args.input_artifact in frames:
+        logger.info(f"Using in-memory artifact {args.input_artifact}")
+        store.use_artifact(args.input_artifact)
+        df = frames[args.input_artifact]
+    else:
+        logger.info(f"Fetching artifact {args.input_artifact}")
+        artifact_local_path = store.use_artifact(args.input_artifact).file()
 
-    df = pd.read_csv(artifact_local_path)
+        df = read_dataset(artifact_local_path)
 
     logger.info("Splitting trainval and test")
     trainval, test = train_test_split(
@@ -29,21 +46,22 @@ def go(args):
         stratify=df[args.stratify_by] if args.stratify_by != 'none' else None,
     )
 
-    # Save to output files and log as W&B artifacts
-    for df, k in zip([trainval, test], ['trainval', 'test']):
-        logger.info(f"Uploading {k}_data.csv dataset")
-        with tempfile.NamedTemporaryFile(prefix=f"{k}_data_", suffix=".csv", delete=False) as fp:
-            df.to_csv(fp.name, index=False)
-            artifact = wandb.Artifact(
-                name=f"{k}_data",
-                type="dataset",
-                description=f"{k} split of dataset"
-            )
-            artifact.add_file(fp.name)
-            run.log_artifact(artifact)
+    # Save to output files and log them as artifacts. The test split is written while the
+    # trainval one is uploaded, and the files are kept until the publisher is done with them.
+    # The file names are part of the digest of an artifact, so they must not change between
+    # runs for the same split to give the same version
+    splits = {"trainval_data": trainval, "test_data": test}
+    with tempfile.TemporaryDirectory() as tmp_dir, ArtifactPublisher(store) as publisher:
+        for df, k in zip([trainval, test], ['trainval', 'test']):
+            logger.info(f"Uploading {k}_data dataset")
+            filename = os.path.join(tmp_dir, dataset_filename(f"{k}_data.csv", args.artifact_format))
+            write_dataset(df, filename)
+            publisher.publish(f"{k}_data", "dataset", f"{k} split of dataset", [filename])
 
     run.finish()
 
+    return splits
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Split test and remainder")
     parser.add_argument("input_artifact", type=str, help="Input artifact to split")
@@ -56,5 +74,9 @@ if __name__ == "__main__":
     parser.add_argument(
         "--stratify_by", type=str, help="Column to use for stratification", default='none', required=False
     )
+    parser.add_argument(
+        "--artifact_format", type=str, help="Format of the output files (csv or parquet)", default='csv', required=False
+    )
+    add_profile_startup_argument(parser, DEFERRED_IMPORTS)
     args = parser.parse_args()
     go(args)